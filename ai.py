@@ -1,109 +1,344 @@
 # ai.py
 import time
 import json
+import asyncio
 from utils import log_error
-import anthropic
 from config import (
     OAI_TOKEN,
     ENABLE_API_CALL_LOGGING,
     COST_PER_TOKEN_HAIKU,
     COST_PER_TOKEN_SONNET,
     DEFAULT_MODEL,
-    PREMIUM_MODEL
+    PREMIUM_MODEL,
+    LLM_TIMEOUT
 )
 from utils import log_error
-from token_utils import anthropic_token_count
+from token_utils import estimate_message_tokens, estimate_text_tokens, calibrate_estimator, content_text
+from llm_client import create_message, stream_message
+from prompts import build_messages, add_live_context, context_window
+from api_log import api_log_writer
+from scheduler import llm_scheduler, Priority
+from storage import UserStore
+
+# Prompt cache pricing relative to the base input token price.
+CACHE_WRITE_COST_MULTIPLIER = 1.25
+CACHE_READ_COST_MULTIPLIER = 0.1
 
 
 def log_api_call(user_id: str, payload: dict, response_json: dict):
+    """
+    Queues a JSON Lines record of an API call for the background log writer
+    (api_log.py), so no file I/O happens on the caller's path. Message and
+    completion contents are replaced with their lengths.
+    """
     from config import ENABLE_API_CALL_LOGGING
     if not ENABLE_API_CALL_LOGGING:
         return
     try:
-        # Create sanitized copies of the payload and response
-        sanitized_payload = payload.copy()
-        if "messages" in sanitized_payload:
-            # Replace message content with length indicators
-            sanitized_payload["messages"] = [
-                {
-                    "role": msg["role"],
-                    "content": f"[{len(msg['content'])} chars]"
-                } for msg in sanitized_payload["messages"]
-            ]
-
-        sanitized_response = response_json.copy()
-        if "completion" in sanitized_response:
-            sanitized_response["completion"] = f"[{len(sanitized_response['completion'])} chars]"
-
-        with open("anthropic_api_calls.log", "a", encoding="utf-8") as f:
-            f.write("=== Anthropic API Call ===\n")
-            f.write(f"User ID: {user_id}\n")
-            f.write(f"Model: {payload.get('model', 'unknown')}\n")
-            f.write(f"Timestamp: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"Messages count: {len(payload.get('messages', []))}\n")
-            f.write(f"Temperature: {payload.get('temperature', 'default')}\n")
-            f.write(f"Max tokens: {payload.get('max_tokens', 'default')}\n")
-            f.write(f"Usage - Prompt tokens: {response_json.get('usage', {}).get('prompt_tokens', 'unknown')}\n")
-            f.write("\n\n")
+        api_log_writer.submit({
+            "timestamp": time.strftime('%Y-%m-%d %H:%M:%S'),
+            "user_id": user_id,
+            "model": payload.get("model", "unknown"),
+            "status": response_json.get("status", "ok"),
+            "error": response_json.get("error"),
+            "stream": response_json.get("stream", False),
+            "latency_ms": response_json.get("latency_ms"),
+            "first_token_ms": response_json.get("first_token_ms"),
+            "messages_count": len(payload.get("messages", [])),
+            "system_chars": len(content_text(payload.get("system", ""))),
+            "message_chars": [len(content_text(msg["content"])) for msg in payload.get("messages", [])],
+            "completion_chars": len(response_json.get("completion", "")),
+            "temperature": payload.get("temperature"),
+            "max_tokens": payload.get("max_tokens"),
+            "usage": response_json.get("usage", {}),
+            "cost": response_json.get("cost")
+        })
     except Exception as e:
         log_error(f"Error logging API call: {e}")
 
 
+def _log_api_error(user_id: str, payload: dict, error: Exception, started: float, stream: bool = False):
+    log_api_call(user_id, payload, {
+        "status": "error",
+        "error": f"{type(error).__name__}: {error}",
+        "stream": stream,
+        "latency_ms": round((time.monotonic() - started) * 1000, 1)
+    })
+
+
+def _usage_tokens(msg_obj):
+    """Total tokens billed for a response (input, cache and output), or None if unknown."""
+    usage = getattr(msg_obj, "usage", None)
+    if usage is None:
+        return None
+    return sum(getattr(usage, field, None) or 0 for field in (
+        "input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"
+    ))
+
+
+def _record_usage(
+        user_id: str,
+        user_dict: dict,
+        model: str,
+        payload: dict,
+        msg_obj,
+        completion_text: str,
+        estimated_prompt_tokens: int,
+        verbose: bool = False,
+        timing: dict = None
+):
+    """
+    Token accounting for a finished request, taken from the response usage block
+    (no extra API calls): calibrates the local estimator, logs the call, adds to
+    the user's token usage and prints the verbose summary.
+    timing holds latency fields for the API log (latency_ms, first_token_ms, stream).
+    """
+    # input_tokens excludes the tokens read from or written to the prompt cache.
+    usage = getattr(msg_obj, "usage", None)
+    uncached_tokens = getattr(usage, "input_tokens", None)
+    completion_tokens = getattr(usage, "output_tokens", None)
+    cache_read_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+    if uncached_tokens is None:
+        uncached_tokens = estimated_prompt_tokens
+        prompt_tokens = estimated_prompt_tokens
+    else:
+        prompt_tokens = uncached_tokens + cache_read_tokens + cache_write_tokens
+        calibrate_estimator(model, payload["system"], payload["messages"], prompt_tokens)
+    if completion_tokens is None:
+        completion_tokens = estimate_text_tokens(completion_text, model)
+
+    total_tokens = prompt_tokens + completion_tokens
+
+    # Calculate cost, pricing cache reads and writes relative to base input tokens.
+    billable_tokens = (
+        uncached_tokens
+        + completion_tokens
+        + cache_write_tokens * CACHE_WRITE_COST_MULTIPLIER
+        + cache_read_tokens * CACHE_READ_COST_MULTIPLIER
+    )
+    if model == PREMIUM_MODEL:
+        cost = billable_tokens * COST_PER_TOKEN_SONNET
+    else:
+        cost = billable_tokens * COST_PER_TOKEN_HAIKU
+
+    # Create a serializable response object for logging
+    response_json = {
+        "id": getattr(msg_obj, "id", "unknown"),
+        "model": getattr(msg_obj, "model", model),
+        "completion": completion_text,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "estimated_prompt_tokens": estimated_prompt_tokens,
+            "cache_read_input_tokens": cache_read_tokens,
+            "cache_creation_input_tokens": cache_write_tokens
+        },
+        "cost": round(cost, 8),
+        **(timing or {})
+    }
+
+    # Log the API call with serializable objects
+    log_api_call(user_id, payload, response_json)
+
+    # Update user's cumulative token usage.
+    if isinstance(user_dict, UserStore):
+        user_dict.add_token_usage(user_id, total_tokens)
+    else:
+        user_dict[user_id]["token_usage"] = user_dict[user_id].get("token_usage", 0) + total_tokens
+
+    if verbose:
+        log_error(
+            f"[Verbose] API Call to model: {model}\n"
+            f"System prompt length: {len(content_text(payload['system']))} chars\n"
+            f"Conv history length: {len(payload['messages'])} messages\n"
+            f"Response length: {len(completion_text)} chars\n" 
+            f"Tokens used: {prompt_tokens} + {completion_tokens} = {total_tokens} "
+            f"(estimated prompt: {estimated_prompt_tokens})\n"
+            f"Prompt cache: {cache_read_tokens} read, {cache_write_tokens} written\n"
+            f"Estimated cost: ${cost:.6f}"
+        )
+
+
+class ClaudeStream:
+    """
+    Async iterator over the text deltas of a streamed reply, returned by
+    call_claude(stream=True). The request starts when iteration begins and is
+    read by a background task as fast as the API sends it, so its scheduler
+    slot is released as soon as generation finishes, however slowly the
+    consumer shows the text (e.g. at a simulated typing pace). Once the
+    upstream stream ends, .text holds the full reply and token usage has been
+    recorded. Generation is bounded by timeout (default LLM_TIMEOUT) from the
+    moment the scheduler admits the request. Errors, including
+    asyncio.TimeoutError, are raised to the consumer, since part of the reply
+    may already have been shown.
+    """
+
+    def __init__(self, request: dict, timeout: float, on_finish, on_error=None,
+                 priority: int = Priority.CHANNEL_REPLY, estimated_tokens: int = 0, max_queue_wait: float = None):
+        self.request = request
+        self.timeout = timeout
+        self.max_queue_wait = max_queue_wait
+        self.first_token = None  # monotonic time of the first delta
+        self.priority = priority
+        self.estimated_tokens = estimated_tokens
+        self.on_finish = on_finish
+        self.on_error = on_error
+        self.text = ""
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        queue = asyncio.Queue()  # text deltas, then None when done or the exception
+        producer = asyncio.get_running_loop().create_task(self._produce(queue))
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            producer.cancel()  # no-op once finished; stops the request if the consumer gave up
+
+    async def _read(self, queue: asyncio.Queue, parts: list):
+        """Streams the reply into queue and parts; returns the final message."""
+        async with stream_message(timeout=self.timeout, **self.request) as stream:
+            async for delta in stream.text_stream:
+                if self.first_token is None:
+                    self.first_token = time.monotonic()
+                parts.append(delta)
+                queue.put_nowait(delta)
+            return await stream.get_final_message()
+
+    async def _produce(self, queue: asyncio.Queue):
+        parts = []
+        started = time.monotonic()
+        self.first_token = None
+        try:
+            async with llm_scheduler.slot(self.request["model"], self.priority, self.estimated_tokens,
+                                          self.max_queue_wait) as ticket:
+                started = time.monotonic()
+                final_message = await asyncio.wait_for(
+                    self._read(queue, parts), self.timeout if self.timeout is not None else LLM_TIMEOUT
+                )
+                ticket.settle(_usage_tokens(final_message))
+        except Exception as e:
+            if self.on_error:
+                self.on_error(e, started)
+            queue.put_nowait(e)
+            return
+        self.text = "".join(parts)
+        try:
+            self.on_finish(final_message, self.text, {
+                "stream": True,
+                "latency_ms": round((time.monotonic() - started) * 1000, 1),
+                "first_token_ms": round((self.first_token - started) * 1000, 1) if self.first_token else None,
+                "queue_ms": round(ticket.wait * 1000, 1)
+            })
+        finally:
+            queue.put_nowait(None)
+
 
 async def call_claude(
         user_id: str,
         user_dict: dict,
         model: str,
-        system_prompt: str,
+        system_prompt,
         user_content: str = None,
         temperature: float = 1.0,
         max_tokens: int = 1000,
-        verbose: bool = False
+        verbose: bool = False,
+        timeout: float = None,
+        live_context: str = None,
+        stream: bool = False,
+        priority: int = Priority.CHANNEL_REPLY,
+        conversation: list = None,
+        max_queue_wait: float = None
 ):
     """
     Calls Anthropic's messages.create endpoint.
-      - system: top-level system prompt.
+      - system: top-level system prompt, a string or blocks from prompts.build_system_prompt.
       - messages: conversation history (only user/assistant roles).
+      - conversation: turns to send instead of the user's conversation_history
+        (e.g. a one-off summarization request); usage is still recorded on the user.
+        Either way only the most recent turns within the model's context budget
+        are sent (prompts.context_window).
       - If user_content is provided, appends it as a user message.
+      - live_context: volatile context (e.g. recent channel messages), placed after
+        every prompt cache breakpoint so it never invalidates the cached prefix.
+      - timeout: per-call request timeout in seconds (defaults to LLM_TIMEOUT). It
+        starts when the scheduler sends the request, not while it is queued.
+      - stream: return a ClaudeStream of text deltas instead of waiting for the
+        complete response.
+      - priority: scheduler.Priority class; the request waits in the central
+        scheduler until its priority, concurrency and rate limits allow it.
+      - max_queue_wait: give up (as a failed request) if the scheduler hasn't
+        admitted the request within this many seconds; None waits indefinitely.
+    The request goes through the shared async client in llm_client, so it never
+    blocks the event loop.
     Returns an object with .choices[0].message["content"] containing a plain text string.
     """
     if user_id not in user_dict:
         user_dict[user_id] = {
             "token_usage": 0,
             "premium": False,
-            "conversation_history": []
+            "conversation_history": [],
+            "core_memories": ""
         }
-    conversation = user_dict[user_id]["conversation_history"]
+    if conversation is None:
+        conversation = user_dict[user_id]["conversation_history"]
 
     # Append new user message if provided.
     if user_content:
         conversation.append({"role": "user", "content": user_content})
 
-    # Count prompt tokens.
-    prompt_tokens = anthropic_token_count(model, system_prompt, conversation)
+    # Assemble the request: the recent turns that fit the context budget,
+    # cache breakpoints on the history, live context last.
+    conversation = context_window(conversation, model)
+    messages = build_messages(conversation, live_context)
+    system_prompt = add_live_context(system_prompt, conversation, live_context)
+
+    # Estimate prompt tokens locally; the exact count comes from the response usage.
+    estimated_prompt_tokens = estimate_message_tokens(model, system_prompt, messages)
+    # Tokens reserved in the scheduler's tokens-per-minute bucket until usage is known.
+    reserved_tokens = estimated_prompt_tokens + max_tokens
+
+    # The request payload, also used for logging
+    payload = {
+        "model": model,
+        "system": system_prompt,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "top_p": 1
+    }
+
+    if stream:
+        def on_finish(final_message, completion_text, timing):
+            _record_usage(user_id, user_dict, model, payload, final_message,
+                          completion_text, estimated_prompt_tokens, verbose, timing)
 
+        def on_error(error, started):
+            _log_api_error(user_id, payload, error, started, stream=True)
+        return ClaudeStream(payload, timeout, on_finish, on_error, priority, reserved_tokens, max_queue_wait)
+
+    started = time.monotonic()
     try:
-        client = anthropic.Anthropic(api_key=OAI_TOKEN)
-
-        # Create the request payload for logging
-        payload = {
-            "model": model,
-            "system": system_prompt,
-            "messages": conversation,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "top_p": 1
+        async with llm_scheduler.slot(model, priority, reserved_tokens, max_queue_wait) as ticket:
+            started = time.monotonic()
+            msg_obj = await asyncio.wait_for(
+                create_message(timeout=timeout, **payload),
+                timeout=timeout if timeout is not None else LLM_TIMEOUT
+            )
+            ticket.settle(_usage_tokens(msg_obj))
+        timing = {
+            "latency_ms": round((time.monotonic() - started) * 1000, 1),
+            "queue_ms": round(ticket.wait * 1000, 1)
         }
 
-        msg_obj = client.messages.create(
-            model=model,
-            system=system_prompt,
-            messages=conversation,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=1
-        )
-
         # Extract completion_text from msg_obj
         completion_text = ""
         if hasattr(msg_obj, "content"):
@@ -113,22 +348,10 @@ async def call_claude(
                 ])
             else:
                 completion_text = str(msg_obj.content)
-
-        # Create a serializable response object for logging
-        response_json = {
-            "id": getattr(msg_obj, "id", "unknown"),
-            "model": getattr(msg_obj, "model", model),
-            "completion": completion_text,
-            "usage": {
-                "prompt_tokens": prompt_tokens
-            }
-        }
-
-        # Log the API call with serializable objects
-        log_api_call(user_id, payload, response_json)
     except Exception as e:
         log_error(f"Error in call_claude: {e}")
-        return _fake_response("Error calling Anthropic. Please try again later.")
+        _log_api_error(user_id, payload, e, started)
+        return _fake_response("Error calling Anthropic. Please try again later.", error=True)
 
     # Extract plain text if completion_text is a list of TextBlocks or has a 'text' attribute.
     if isinstance(completion_text, list):
@@ -142,40 +365,17 @@ async def call_claude(
         # Otherwise, assume it's already a string.
         completion_text = str(completion_text)
 
-    # Count completion tokens.
-    completion_tokens = anthropic_token_count(
-        model,
-        "",
-        [{"role": "assistant", "content": completion_text}]
-    )
-    total_tokens = prompt_tokens + completion_tokens
-
-    # Calculate cost.
-    if model == PREMIUM_MODEL:
-        cost = total_tokens * COST_PER_TOKEN_SONNET
-    else:
-        cost = total_tokens * COST_PER_TOKEN_HAIKU
-
-    # Update user's cumulative token usage.
-    user_dict[user_id]["token_usage"] = user_dict[user_id].get("token_usage", 0) + total_tokens
-
-    if verbose:
-        log_error(
-            f"[Verbose] API Call to model: {model}\n"
-            f"System prompt length: {len(system_prompt)} chars\n"
-            f"Conv history length: {len(conversation)} messages\n"
-            f"Response length: {len(completion_text)} chars\n" 
-            f"Tokens used: {prompt_tokens} + {completion_tokens} = {total_tokens}\n"
-            f"Estimated cost: ${cost:.6f}"
-        )
+    _record_usage(user_id, user_dict, model, payload, msg_obj,
+                  completion_text, estimated_prompt_tokens, verbose, timing)
 
     return _fake_response(completion_text)
 
 
-def _fake_response(text: str):
+def _fake_response(text: str, error: bool = False):
     """
     Returns an object with .choices[0].message["content"].
-    This mimics the OpenAI-like response style.
+    This mimics the OpenAI-like response style. .error is True when the text
+    is the fallback message for a failed request rather than a completion.
     """
 
     class FakeChoice:
@@ -185,5 +385,6 @@ def _fake_response(text: str):
     class FakeResponse:
         def __init__(self, content):
             self.choices = [FakeChoice(content)]
+            self.error = error
 
     return FakeResponse(text)
@@ -0,0 +1,155 @@
+# api_log.py
+import os
+import re
+import glob
+import gzip
+import json
+import time
+import shutil
+import asyncio
+
+from config import (
+    API_LOG_FILE,
+    API_LOG_QUEUE_SIZE,
+    API_LOG_BATCH_SIZE,
+    API_LOG_FLUSH_INTERVAL,
+    API_LOG_MAX_BYTES,
+    API_LOG_ROTATE_INTERVAL,
+    API_LOG_COMPRESS,
+    API_LOG_BACKUP_COUNT
+)
+from utils import log_error
+
+# Suffix of rotated files: the rotation time, plus .gz when compressed.
+_BACKUP_SUFFIX = re.compile(r"\.\d{8}-\d{6}-\d{3}(\.gz)?")
+_DROP_LOG_EVERY = 1000  # log the first dropped record and then every this many
+
+
+class ApiLogWriter:
+    """
+    Background writer for the API call log.
+
+    Records are queued without blocking the caller and written by a background
+    task in batches, as JSON Lines, from a worker thread. When the queue is full
+    new records are dropped (counted, logged now and then, and shown by the
+    admin status command) instead of stalling the event loop.
+    The file is rotated by size and/or age, optionally gzip-compressed, and only
+    the newest backup_count rotated files are kept.
+    """
+
+    def __init__(self, path: str, queue_size: int, batch_size: int, flush_interval: float,
+                 max_bytes: int, rotate_interval: float, compress: bool, backup_count: int):
+        self.path = path
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.backup_count = backup_count
+        self.written = 0
+        self.dropped = 0
+        self._queue = None
+        self._task = None
+        self._opened_at = time.time()
+
+    def submit(self, record: dict) -> bool:
+        """Queues a record for writing. Returns False if it was dropped."""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except asyncio.QueueFull:
+            if self.dropped % _DROP_LOG_EVERY == 0:
+                log_error(f"API call log queue is full ({self.queue_size} records); "
+                          f"{self.dropped + 1} dropped so far")
+            self.dropped += 1
+            return False
+
+    async def _run(self):
+        # A None record (queued by close) flushes the current batch and stops.
+        while True:
+            record = await self._queue.get()
+            if record is None:
+                return
+            batch = [record]
+            # Collect more records for up to flush_interval, or until the batch is full.
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if record is None:
+                    await self._write(batch)
+                    return
+                batch.append(record)
+            await self._write(batch)
+
+    async def _write(self, batch: list):
+        lines = "".join(json.dumps(record, default=str) + "\n" for record in batch)
+        try:
+            await asyncio.to_thread(self._write_lines, lines)
+            self.written += len(batch)
+        except Exception as e:
+            log_error(f"Error writing API call log: {e}")
+
+    def _write_lines(self, lines: str):
+        if self._should_rotate():
+            self._rotate()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    def _should_rotate(self) -> bool:
+        if not os.path.exists(self.path):
+            self._opened_at = time.time()
+            return False
+        if self.max_bytes and os.path.getsize(self.path) >= self.max_bytes:
+            return True
+        return bool(self.rotate_interval) and time.time() - self._opened_at >= self.rotate_interval
+
+    def _rotate(self):
+        now = time.time()
+        rotated = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now % 1 * 1000):03d}"
+        os.replace(self.path, rotated)
+        self._opened_at = time.time()
+        if self.compress:
+            with open(rotated, "rb") as src, gzip.open(f"{rotated}.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+        backups = sorted(
+            backup for backup in glob.glob(f"{glob.escape(self.path)}.*")
+            if _BACKUP_SUFFIX.fullmatch(backup[len(self.path):])
+        )
+        for old in backups[:-self.backup_count] if self.backup_count else []:
+            os.remove(old)
+
+    def summary(self) -> str:
+        """One-line summary for the admin status command."""
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return f"{self.written} written, {self.dropped} dropped, {queued} queued"
+
+    async def close(self):
+        """Writes any queued records and stops the background task."""
+        if self._task is None or self._task.done():
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+
+api_log_writer = ApiLogWriter(
+    path=API_LOG_FILE,
+    queue_size=API_LOG_QUEUE_SIZE,
+    batch_size=API_LOG_BATCH_SIZE,
+    flush_interval=API_LOG_FLUSH_INTERVAL,
+    max_bytes=API_LOG_MAX_BYTES,
+    rotate_interval=API_LOG_ROTATE_INTERVAL,
+    compress=API_LOG_COMPRESS,
+    backup_count=API_LOG_BACKUP_COUNT
+)
@@ -0,0 +1,122 @@
+# bench/fake_discord.py
+"""
+Minimal stand-ins for the discord.py objects the message pipeline touches
+(messages, authors, guilds, text and DM channels), so messages can be fed to
+on_message without a gateway connection.
+"""
+import itertools
+import datetime
+from collections import deque
+
+import discord
+
+_ids = itertools.count(10_000)
+
+
+def next_id() -> int:
+    return next(_ids)
+
+
+class FakeUser:
+    def __init__(self, name: str, bot: bool = False, user_id: int = None):
+        self.id = user_id if user_id is not None else next_id()
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.mention = f"<@{self.id}>"
+        self.roles = []
+
+    def __repr__(self):
+        return f"<FakeUser {self.name}>"
+
+
+class FakeGuild:
+    def __init__(self, name: str):
+        self.id = next_id()
+        self.name = name
+
+
+class FakeMessage:
+    def __init__(self, content: str, author: FakeUser, channel, guild: FakeGuild = None):
+        self.id = next_id()
+        self.content = content
+        self.clean_content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.edits = 0
+
+    async def edit(self, content: str = None, **kwargs):
+        if content is not None:
+            self.content = self.clean_content = content
+        self.edits += 1
+        self.channel._notify("edit", self)
+
+    async def delete(self, **kwargs):
+        if self in self.channel.messages:
+            self.channel.messages.remove(self)
+        self.channel._notify("delete", self)
+
+
+class _Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class _ChannelMixin:
+    """Shared send/history behaviour. on_event(kind, message) observes sends, edits and deletes."""
+
+    def _setup(self, bot_user: FakeUser, history_size: int, on_event):
+        self.bot_user = bot_user
+        self.messages = deque(maxlen=history_size)
+        self.sent = 0
+        self.on_event = on_event
+
+    def _notify(self, kind: str, message: FakeMessage):
+        if self.on_event is not None:
+            self.on_event(kind, message)
+
+    def receive(self, content: str, author: FakeUser) -> FakeMessage:
+        """Creates an incoming message from author and records it in the history."""
+        message = FakeMessage(content, author, self, getattr(self, "guild", None))
+        self.messages.append(message)
+        return message
+
+    async def send(self, content: str = None, **kwargs) -> FakeMessage:
+        message = FakeMessage(content or "", self.bot_user, self, getattr(self, "guild", None))
+        self.messages.append(message)
+        self.sent += 1
+        self._notify("send", message)
+        return message
+
+    def typing(self):
+        return _Typing()
+
+    async def history(self, limit: int = 100):
+        """Yields recent messages, newest first, like discord.py."""
+        for message in list(reversed(self.messages))[:limit]:
+            yield message
+
+
+class FakeTextChannel(_ChannelMixin):
+    def __init__(self, name: str, guild: FakeGuild, bot_user: FakeUser, history_size: int = 50, on_event=None):
+        self.id = next_id()
+        self.name = name
+        self.guild = guild
+        self._setup(bot_user, history_size, on_event)
+
+
+class FakeDMChannel(_ChannelMixin, discord.DMChannel):
+    """Subclasses discord.DMChannel so the pipeline's isinstance checks treat it as a DM."""
+
+    def __init__(self, recipient: FakeUser, bot_user: FakeUser, history_size: int = 50, on_event=None):
+        self.id = next_id()
+        self.recipients = [recipient]
+        self._setup(bot_user, history_size, on_event)
+
+    def __repr__(self):
+        return f"<FakeDMChannel {self.recipients[0].name}>"
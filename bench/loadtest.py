@@ -0,0 +1,305 @@
+# bench/loadtest.py
+"""
+Load test for the message pipeline, without Discord or a real API key.
+
+Starts the mock Anthropic server, imports the bot with its API base URL
+pointed at the mock, and replays synthetic traffic from N users across M
+channels (plus DMs) into on_message at a target rate. Reports per-stage
+latency percentiles, throughput and peak RSS.
+
+Run from the repository root:
+    python -m bench.loadtest --users 50 --channels 5 --rate 10 --duration 60
+    python -m bench.loadtest --set enable_streaming_replies=false --json before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+from collections import defaultdict
+
+from bench.mock_anthropic import MockAnthropicServer, add_server_arguments
+from bench.fake_discord import FakeUser, FakeGuild, FakeTextChannel, FakeDMChannel
+
+_WORDS = (
+    "hey so what do you think about the new update I was reading about "
+    "caching and latency yesterday and honestly it seems pretty wild right"
+).split()
+
+# Pipeline functions in main that are timed as stages (name in report -> attribute).
+_STAGES = {
+    "should_reply": "should_reply",
+    "detect_entities": "detect_entities",
+    "reply": "process_user_message",
+}
+
+
+def percentile(samples: list, pct: float) -> float:
+    """Nearest-rank percentile of samples (0 for an empty list)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+def peak_rss_mib() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+class StageTimer:
+    """Wraps async pipeline functions and records how long each call takes."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def wrap(self, name: str, func):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.samples[name].append(time.perf_counter() - start)
+        return timed
+
+    def record(self, name: str, seconds: float):
+        self.samples[name].append(seconds)
+
+
+class ReplyTracker:
+    """Matches the bot's replies to the messages of the turn they answer."""
+
+    def __init__(self, timer: StageTimer):
+        self.timer = timer
+        self.sent_at = {}  # message id -> send time, until answered
+        self.turns = {}  # (channel id, author mention) -> message ids of the latest turn
+        self.replies = 0
+        self.edits = 0
+
+    def message_sent(self, message):
+        self.sent_at[message.id] = time.perf_counter()
+
+    def turn_started(self, burst):
+        key = (burst.message.channel.id, burst.message.author.mention)
+        self.turns[key] = [m.id for m in burst.messages]
+
+    def on_event(self, kind: str, message):
+        if kind == "edit":
+            self.edits += 1
+            return
+        if kind == "delete":
+            return
+        mention = message.content.split(" ", 1)[0]
+        answered = self.turns.pop((message.channel.id, mention), None)
+        if not answered:
+            return  # a continuation page or an error message
+        self.replies += 1
+        now = time.perf_counter()
+        for message_id in answered:
+            if message_id in self.sent_at:
+                self.timer.record("first_reply", now - self.sent_at.pop(message_id))
+
+    def unanswered(self) -> int:
+        return len(self.sent_at)
+
+
+def configure_environment(args, base_url: str, workdir: str):
+    """Points the bot at the mock server and keeps its files out of the repo."""
+    os.environ.update({
+        "ANTHROPIC_BASE_URL": base_url,
+        "ANTHROPIC_API_KEY": "bench",
+        "discord_token": "bench",
+        "api_log_file": os.path.join(workdir, "api_calls.log"),
+        "decision_cache_file": "",
+    })
+    for setting in args.set:
+        key, _, value = setting.partition("=")
+        os.environ[key] = value
+
+
+def make_content(bot_name: str, mention_fraction: float) -> str:
+    words = [random.choice(_WORDS) for _ in range(random.randint(4, 25))]
+    if random.random() < mention_fraction:
+        words.insert(random.randint(0, len(words)), bot_name)
+    return " ".join(words)
+
+
+async def drive(args, main, tracker: ReplyTracker, bot_user: FakeUser):
+    """Replays Poisson arrivals at args.rate messages per second for args.duration seconds."""
+    guild = FakeGuild("bench-guild")
+    channels = [FakeTextChannel(f"channel-{i}", guild, bot_user, on_event=tracker.on_event)
+                for i in range(args.channels)]
+    users = [FakeUser(f"user{i}", bot=random.random() < args.bot_fraction) for i in range(args.users)]
+    dms = {}
+
+    async def send(channel, author):
+        message = channel.receive(make_content(main.DEFAULT_NAME, args.mention_fraction), author)
+        tracker.message_sent(message)
+        await main.on_message(message)
+
+    sent = 0
+    deadline = time.perf_counter() + args.duration
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(random.expovariate(args.rate))
+        author = random.choice(users)
+        if not author.bot and random.random() < args.dm_fraction:
+            channel = dms.get(author.id)
+            if channel is None:
+                channel = dms[author.id] = FakeDMChannel(author, bot_user, on_event=tracker.on_event)
+        else:
+            channel = random.choice(channels)
+        burst = random.randint(2, 4) if random.random() < args.burst_fraction else 1
+        for i in range(burst):
+            if i:
+                await asyncio.sleep(random.uniform(0.1, 0.5))
+            await send(channel, author)
+            sent += 1
+    return sent
+
+
+async def run(args) -> dict:
+    server = MockAnthropicServer(
+        latency=args.latency, error_rate=args.error_rate, reply_words=args.reply_words,
+        chunk_delay=args.chunk_delay, yes_rate=args.yes_rate, entity_rate=args.entity_rate,
+        port=args.port
+    )
+    await server.start()
+    workdir = tempfile.mkdtemp(prefix="hypermask-bench-")
+    configure_environment(args, server.base_url, workdir)
+
+    # Importing main reads config.env from the repository root; afterwards the
+    # bot's working files (user_info.pickle, logs) go to the temporary directory.
+    import main
+    from utils import logger
+    from llm_client import close_client
+    from api_log import api_log_writer
+    os.chdir(workdir)
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+
+    timer = StageTimer()
+    tracker = ReplyTracker(timer)
+    for name, attribute in _STAGES.items():
+        setattr(main, attribute, timer.wrap(name, getattr(main, attribute)))
+    main.user_data_saver.save = timer.wrap("save_user_data", main.user_data_saver.save)
+    main.summarizer.summarize = timer.wrap("summarize", main.summarizer.summarize)
+    process_message = timer.wrap("turn", main.process_message)
+
+    async def tracked_process_message(message, burst):
+        tracker.turn_started(burst)
+        await process_message(message, burst)
+
+    main.process_message = tracked_process_message
+    bot_user = FakeUser(main.DEFAULT_NAME, bot=True)
+    main.bot._connection.user = bot_user
+    main.log_channel = FakeTextChannel("bot-log", FakeGuild("log-guild"), bot_user)
+    await main.load_user_data()  # on_ready's user data phase; turns wait for it
+
+    started = time.perf_counter()
+    sent = await drive(args, main, tracker, bot_user)
+    send_window = time.perf_counter() - started
+
+    # Let in-flight turns and the summaries they queued finish.
+    drain_deadline = time.perf_counter() + args.drain_timeout
+    while ((main.message_coalescer.open_turns() or main.summarizer.pending)
+           and time.perf_counter() < drain_deadline):
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+
+    await main.summarizer.close()
+    await main.user_data_saver.flush()
+    await main.user_data.close()
+    await api_log_writer.close()
+    await close_client()
+    await server.stop()
+
+    return {
+        "settings": {k: v for k, v in vars(args).items() if k != "json"},
+        "messages_sent": sent,
+        "send_seconds": round(send_window, 2),
+        "elapsed_seconds": round(elapsed, 2),
+        "replies": tracker.replies,
+        "unanswered_messages": tracker.unanswered(),
+        "message_edits": tracker.edits,
+        "throughput_msgs_per_s": round(sent / elapsed, 2) if elapsed else 0.0,
+        "throughput_replies_per_s": round(tracker.replies / elapsed, 2) if elapsed else 0.0,
+        "api_requests": server.requests,
+        "api_errors": server.errors,
+        "peak_rss_mib": round(peak_rss_mib(), 1),
+        "stages": {
+            name: {
+                "count": len(samples),
+                "p50": round(percentile(samples, 50), 4),
+                "p95": round(percentile(samples, 95), 4),
+                "p99": round(percentile(samples, 99), 4),
+                "max": round(max(samples), 4),
+            }
+            for name, samples in sorted(timer.samples.items())
+        },
+        "scheduler": main.llm_scheduler.metrics()["classes"],
+        "coalescer": main.message_coalescer.summary(),
+        "decision_cache": main.decision_cache.summary(),
+        "user_data_saves": main.user_data_saver.metrics(),
+        "summaries": main.summarizer.summary(),
+        "journal": {"entries": main.user_data.journal.seq, "batches": main.user_data.journal.batches},
+    }
+
+
+def print_report(result: dict):
+    print(f"\nMessages sent:   {result['messages_sent']} in {result['send_seconds']}s "
+          f"(finished after {result['elapsed_seconds']}s)")
+    print(f"Replies:         {result['replies']} ({result['unanswered_messages']} messages unanswered, "
+          f"{result['message_edits']} streaming edits)")
+    print(f"Throughput:      {result['throughput_msgs_per_s']} msgs/s, {result['throughput_replies_per_s']} replies/s")
+    print(f"API requests:    {result['api_requests']} ({result['api_errors']} errors)")
+    print(f"Peak RSS:        {result['peak_rss_mib']} MiB")
+    print(f"Coalescer:       {result['coalescer']}")
+    print(f"Decision cache:  {result['decision_cache']}")
+    print(f"Summaries:       {result['summaries']}")
+    print(f"User data saves: {result['user_data_saves']['requests']} requests in "
+          f"{result['user_data_saves']['saves']} saves ({result['user_data_saves']['failures']} failed)")
+    print(f"Journal:         {result['journal']['entries']} entries in {result['journal']['batches']} fsync'd batches")
+    print(f"\n{'stage':<16}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name, s in result["stages"].items():
+        print(f"{name:<16}{s['count']:>7}{s['p50']:>10.3f}{s['p95']:>10.3f}{s['p99']:>10.3f}{s['max']:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="Number of simulated users")
+    parser.add_argument("--channels", type=int, default=3, help="Number of public channels")
+    parser.add_argument("--rate", type=float, default=5.0, help="Target messages per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to send messages for")
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="Seconds to wait for open turns")
+    parser.add_argument("--dm-fraction", type=float, default=0.2, help="Fraction of human messages sent as DMs")
+    parser.add_argument("--bot-fraction", type=float, default=0.1, help="Fraction of users that are bots")
+    parser.add_argument("--mention-fraction", type=float, default=0.3, help="Fraction of messages naming the bot")
+    parser.add_argument("--burst-fraction", type=float, default=0.1, help="Fraction of sends that are 2-4 quick messages")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the mock API server")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducible traffic")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override a config.env setting for this run (repeatable)")
+    parser.add_argument("--json", default=None, help="Also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Keep the bot's INFO logging")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.json:
+        args.json = os.path.abspath(args.json)  # the run changes into a temporary directory
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# bench/mock_anthropic.py
+"""
+Local stand-in for the Anthropic Messages API, used by the load test.
+
+Serves POST /v1/messages (plain and streaming) and
+POST /v1/messages/count_tokens with a configurable latency distribution and
+error rate. Requests are recognised by their max_tokens so the bot's
+pipeline gets plausible answers: should_reply votes (max_tokens <= 5) get
+"yes"/"no", entity detection (max_tokens 50) gets a JSON array, and anything
+else gets a reply of roughly reply_words words.
+
+Run standalone with:
+    python -m bench.mock_anthropic --port 8765 --latency lognormal:0.8,0.5
+"""
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+_WORDS = (
+    "the quick brown fox jumps over a lazy dog while we talk about memory "
+    "tokens caching latency discord channels friends stories and weather"
+).split()
+
+_ERRORS = (
+    (429, "rate_limit_error", "Number of request tokens has exceeded your per-minute rate limit"),
+    (500, "api_error", "Internal server error"),
+    (529, "overloaded_error", "Overloaded"),
+)
+
+
+def parse_latency(spec: str):
+    """
+    Parses a latency distribution into a callable returning seconds.
+      fixed:S            always S
+      uniform:A,B        uniform between A and B
+      exp:MEAN           exponential with the given mean
+      lognormal:MED,SIG  log-normal with median MED and shape SIG
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1 / values[0])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class MockAnthropicServer:
+    def __init__(self, latency: str = "lognormal:0.8,0.5", error_rate: float = 0.0,
+                 reply_words: int = 60, chunk_delay: float = 0.02, yes_rate: float = 0.7,
+                 entity_rate: float = 0.0, host: str = "127.0.0.1", port: int = 8765):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.reply_words = reply_words
+        self.chunk_delay = chunk_delay
+        self.yes_rate = yes_rate
+        self.entity_rate = entity_rate
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self.streams = 0
+        self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def _answer(self, body: dict) -> str:
+        max_tokens = body.get("max_tokens", 0)
+        if max_tokens <= 5:
+            return "yes" if random.random() < self.yes_rate else "no"
+        if max_tokens == 50:
+            return '["Alice"]' if random.random() < self.entity_rate else "[]"
+        count = max(1, int(random.gauss(self.reply_words, self.reply_words / 4)))
+        return " ".join(random.choice(_WORDS) for _ in range(count)).capitalize() + "."
+
+    @staticmethod
+    def _prompt_tokens(body: dict) -> int:
+        return max(1, len(json.dumps(body.get("system", ""))) // 4 + len(json.dumps(body.get("messages", []))) // 4)
+
+    async def messages(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self.latency())
+        if random.random() < self.error_rate:
+            self.errors += 1
+            status, kind, text = random.choice(_ERRORS)
+            return web.json_response(
+                {"type": "error", "error": {"type": kind, "message": text}}, status=status
+            )
+
+        text = self._answer(body)
+        usage = {
+            "input_tokens": self._prompt_tokens(body),
+            "output_tokens": max(1, len(text) // 4),
+            "cache_read_input_tokens": 0,
+            "cache_creation_input_tokens": 0,
+        }
+        message = {
+            "id": f"msg_mock_{self.requests}", "type": "message", "role": "assistant",
+            "model": body.get("model", "mock"), "stop_reason": "end_turn", "stop_sequence": None,
+        }
+        if not body.get("stream"):
+            return web.json_response({**message, "content": [{"type": "text", "text": text}], "usage": usage})
+
+        self.streams += 1
+        response = web.StreamResponse(headers={"content-type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def event(kind: str, data: dict):
+            await response.write(f"event: {kind}\ndata: {json.dumps({'type': kind, **data})}\n\n".encode())
+
+        await event("message_start", {"message": {
+            **message, "content": [], "stop_reason": None, "usage": {**usage, "output_tokens": 1}
+        }})
+        await event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        words = text.split(" ")
+        for i in range(0, len(words), 4):
+            chunk = " ".join(words[i:i + 4]) + (" " if i + 4 < len(words) else "")
+            await event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": chunk}})
+            await asyncio.sleep(self.chunk_delay)
+        await event("content_block_stop", {"index": 0})
+        await event("message_delta", {
+            "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+            "usage": {"output_tokens": usage["output_tokens"]}
+        })
+        await event("message_stop", {})
+        return response
+
+    async def count_tokens(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.requests += 1
+        return web.json_response({"input_tokens": self._prompt_tokens(body)})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/v1/messages", self.messages)
+        app.router.add_post("/v1/messages/count_tokens", self.count_tokens)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def _serve(args):
+    server = MockAnthropicServer(
+        latency=args.latency, error_rate=args.error_rate, reply_words=args.reply_words,
+        chunk_delay=args.chunk_delay, yes_rate=args.yes_rate, entity_rate=args.entity_rate,
+        host=args.host, port=args.port
+    )
+    await server.start()
+    print(f"Mock Anthropic API listening on {server.base_url}")
+    started = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(f"{server.requests} requests, {server.errors} errors in {time.monotonic() - started:.0f}s")
+    finally:
+        await server.stop()
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", default="lognormal:0.8,0.5",
+                        help="Latency distribution: fixed:S, uniform:A,B, exp:MEAN or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with an error")
+    parser.add_argument("--reply-words", type=int, default=60, help="Average words per reply")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="Seconds between streamed chunks")
+    parser.add_argument("--yes-rate", type=float, default=0.7, help="Fraction of should_reply votes that are yes")
+    parser.add_argument("--entity-rate", type=float, default=0.0,
+                        help="Fraction of entity detections that name another entity first")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_server_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,121 @@
+# bench/record_codecs.py
+"""
+Benchmark of the user record formats: the pickled dicts of earlier releases
+(history as a plain list of turn dicts, normalized into a ConversationHistory
+on load as the store does) against records.encode_record with each codec and
+compression level.
+
+Generates synthetic users (conversation histories of varying length, core
+memories), then encodes and decodes every one of them in each format and
+reports total encode/decode time and stored size. Users are generated and
+measured in chunks, so memory stays flat at 100k users.
+
+Run from the repository root:
+    python -m bench.record_codecs
+    python -m bench.record_codecs --users 1000 10000 --json codecs.json
+"""
+import json
+import time
+import pickle
+import random
+import argparse
+
+from history import ConversationHistory
+from records import CODECS, get_codec, normalize_record, encode_record, decode_record
+
+_WORDS = (
+    "hey so what do you think about the new update I was reading about caching and latency yesterday "
+    "honestly it seems pretty wild right remember that I like tea and my cat is called Miso"
+).split()
+_CHUNK = 1000
+
+
+def make_user(rng: random.Random) -> dict:
+    """One synthetic record: mostly short histories, some long ones, as in a real user table."""
+    turns = min(int(rng.expovariate(1 / 20)) + 1, 200)
+    history = ConversationHistory(
+        {"role": "user" if i % 2 == 0 else "assistant",
+         "content": " ".join(rng.choice(_WORDS) for _ in range(rng.randint(4, 120)))}
+        for i in range(turns)
+    )
+    history.units()
+    return {
+        "token_usage": rng.randint(0, 2_000_000),
+        "premium": rng.random() < 0.05,
+        "conversation_history": history,
+        "core_memories": "\n".join(
+            "- " + " ".join(rng.choice(_WORDS) for _ in range(rng.randint(5, 20)))
+            for _ in range(rng.randint(0, 30))
+        ),
+    }
+
+
+def legacy_pickle(record: dict) -> bytes:
+    """A record as earlier releases pickled it: the history as a plain list of turn dicts."""
+    legacy = {k: v for k, v in record.items() if k != "core_memory_times"}
+    legacy["conversation_history"] = list(record["conversation_history"])
+    return pickle.dumps(legacy, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def formats() -> dict:
+    """name -> (encode, decode) for every format available here."""
+    result = {"pickle": (legacy_pickle, lambda blob: normalize_record(pickle.loads(blob)))}
+    for name in CODECS:
+        try:
+            codec = get_codec(name)
+        except ValueError:
+            continue  # optional dependency not installed
+        for level in (0, 1, 6):
+            result[f"{name}+zlib{level}" if level else name] = (
+                lambda record, codec=codec, level=level: encode_record(record, codec, level),
+                decode_record,
+            )
+    return result
+
+
+def run(users: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    results = {name: {"encode_s": 0.0, "decode_s": 0.0, "bytes": 0} for name in formats()}
+    for start in range(0, users, _CHUNK):
+        chunk = [make_user(rng) for _ in range(min(_CHUNK, users - start))]
+        for name, (encode, decode) in formats().items():
+            t0 = time.perf_counter()
+            blobs = [encode(record) for record in chunk]
+            t1 = time.perf_counter()
+            for blob in blobs:
+                decode(blob)
+            t2 = time.perf_counter()
+            results[name]["encode_s"] += t1 - t0
+            results[name]["decode_s"] += t2 - t1
+            results[name]["bytes"] += sum(len(blob) for blob in blobs)
+    return results
+
+
+def print_report(users: int, results: dict):
+    baseline = results["pickle"]
+    print(f"\n{users} users")
+    print(f"{'format':<16}{'encode s':>10}{'decode s':>10}{'us/user':>10}{'MiB':>9}{'size':>8}")
+    for name, r in results.items():
+        per_user = (r["encode_s"] + r["decode_s"]) / users * 1e6
+        print(f"{name:<16}{r['encode_s']:>10.2f}{r['decode_s']:>10.2f}{per_user:>10.0f}"
+              f"{r['bytes'] / 2**20:>9.1f}{r['bytes'] / baseline['bytes']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000], help="User counts to test")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the synthetic users")
+    parser.add_argument("--json", default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    report = {}
+    for users in args.users:
+        report[users] = run(users, args.seed)
+        print_report(users, report[users])
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# coalescer.py
+import asyncio
+
+from utils import log_info, log_error
+
+
+class Burst:
+    """Messages from one author in one channel that are answered as a single turn."""
+
+    def __init__(self, key):
+        self.key = key
+        self.messages = []
+        self.task = None
+        self.timer = None
+        self.committed = False
+        self.superseded = False
+
+    @property
+    def message(self):
+        """The latest message of the burst; replies and context are based on it."""
+        return self.messages[-1]
+
+    @property
+    def content(self) -> str:
+        """The burst's messages merged into one turn, one message per line."""
+        lines = (m.clean_content.strip() for m in self.messages)
+        return "\n".join(line for line in lines if line)
+
+    def commit(self):
+        """
+        Marks the reply as being sent. From here on a new message from the same
+        author starts a new turn instead of cancelling this one.
+        """
+        self.committed = True
+
+
+class MessageCoalescer:
+    """
+    Debounce stage between on_message and message processing.
+
+    Messages are grouped per (author, channel): each new message restarts a
+    window of `window` seconds, and when it expires the whole burst is handed
+    to `handler` as one turn. If the author writes again while an earlier turn
+    is still being generated (not yet committed), that turn is cancelled and
+    its messages are folded into the new burst. Turns for the same author and
+    channel are processed one at a time, in order.
+    """
+
+    def __init__(self, window: float, handler):
+        self.window = window
+        self.handler = handler  # async callable(burst)
+        self._pending = {}  # key -> burst waiting out its window
+        self._active = {}  # key -> burst being processed
+        self._locks = {}  # key -> lock serializing turns
+        self.received = 0
+        self.dispatched = 0
+        self.superseded = 0
+
+    def submit(self, message):
+        """Adds a message to its author's current burst (or starts a new one)."""
+        key = (message.author.id, message.channel.id)
+        self.received += 1
+        burst = self._pending.get(key)
+        if burst is None:
+            burst = self._pending[key] = Burst(key)
+            active = self._active.get(key)
+            if active is not None and not active.committed and not active.superseded:
+                self._supersede(active, burst)
+        else:
+            burst.timer.cancel()
+        burst.messages.append(message)
+        burst.timer = asyncio.get_running_loop().call_later(self.window, self._dispatch, key)
+
+    def _supersede(self, active: Burst, burst: Burst):
+        active.superseded = True
+        burst.messages.extend(active.messages)
+        self.superseded += 1
+        log_info(f"Superseding in-flight reply for author {active.key[0]} in channel {active.key[1]}")
+        if active.task is not None:
+            active.task.cancel()
+
+    def _dispatch(self, key):
+        burst = self._pending.pop(key)
+        self._active[key] = burst
+        self.dispatched += 1
+        burst.task = asyncio.create_task(self._run(burst))
+
+    async def _run(self, burst: Burst):
+        lock = self._locks.setdefault(burst.key, asyncio.Lock())
+        try:
+            async with lock:
+                if not burst.superseded:
+                    await self.handler(burst)
+        except asyncio.CancelledError:
+            pass  # superseded; the messages are answered by the newer turn
+        except Exception as e:
+            log_error(f"Error processing coalesced messages: {e}")
+        finally:
+            if self._active.get(burst.key) is burst:
+                del self._active[burst.key]
+            if not lock.locked() and burst.key not in self._active and burst.key not in self._pending:
+                self._locks.pop(burst.key, None)
+
+    def open_turns(self) -> int:
+        """Number of turns waiting out their window or being processed."""
+        return len(self._pending) + len(self._active)
+
+    def summary(self) -> str:
+        """One-line summary for the admin status command."""
+        return (
+            f"{self.received} messages in {self.dispatched} turns, "
+            f"{self.superseded} superseded, {self.open_turns()} open"
+        )
+
@@ -5,6 +5,9 @@ from discord.ui import View, Button
 from config import DEFAULT_MODEL, PREMIUM_MODEL, CORE_PROMPT
 from utils import log_error, toggle_verbose
 from ai import call_claude  # Import needed for reroll
+from scheduler import Priority
+from prompts import build_system_prompt, context_window
+from memory_index import relevant_memories
 
 # Global dictionary to track active reroll views by user ID.
 active_reroll_views = {}
@@ -152,6 +155,7 @@ class ForgetLastView(View):
 
     @discord.ui.button(label="Forget Selected", style=discord.ButtonStyle.danger, emoji="🗑️")
     async def forget_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.user_data.prefetch(self.user_id)
         conversation = self.user_data.get(self.user_id, {}).get("conversation_history", [])
         
         if not self.selected_indexes:
@@ -159,16 +163,11 @@ class ForgetLastView(View):
             return
             
         # Get the actual indexes in the conversation history
-        indexes_to_remove = [self.messages_to_forget[i] for i in self.selected_indexes]
-        indexes_to_remove.sort(reverse=True)  # Sort in reverse to remove from the end first
+        indexes_to_remove = {self.messages_to_forget[i] for i in self.selected_indexes}
         
-        # Remove the selected messages
-        for idx in indexes_to_remove:
-            if 0 <= idx < len(conversation):
-                del conversation[idx]
-        
-        # Update the conversation history
-        self.user_data[self.user_id]["conversation_history"] = conversation
+        # Update the conversation history without the selected messages
+        conversation = [msg for idx, msg in enumerate(conversation) if idx not in indexes_to_remove]
+        self.user_data.set_history(self.user_id, conversation)
         
         # Update the message and disable the view
         await self.original_message.edit(
@@ -179,6 +178,7 @@ class ForgetLastView(View):
 
     async def update_message(self, interaction: discord.Interaction):
         """Update the message to show which messages are selected."""
+        await self.user_data.prefetch(self.user_id)
         conversation = self.user_data.get(self.user_id, {}).get("conversation_history", [])
         
         # Build the message content
@@ -272,7 +272,8 @@ def setup_commands(bot: commands.Bot, user_data: dict):
             @discord.ui.button(label="Yes, Reset Everything", style=discord.ButtonStyle.danger)
             async def confirm_button(self, interaction: discord.Interaction, button: discord.ui.Button):
                 # Keep core memories but clear conversation history
-                user_data[user_id]["conversation_history"] = []
+                await user_data.prefetch(user_id)
+                user_data.set_history(user_id, [])
                 await interaction.response.send_message(
                     "✅ Your conversation history has been reset. Core memories remain intact.", ephemeral=True)
                 self.stop()
@@ -297,6 +298,7 @@ def setup_commands(bot: commands.Bot, user_data: dict):
         if user_id not in user_data:
             await interaction.response.send_message("No conversation history found.", ephemeral=True)
             return
+        await user_data.prefetch(user_id)
             
         conversation = user_data[user_id].get("conversation_history", [])
         if not conversation:
@@ -359,28 +361,27 @@ def setup_commands(bot: commands.Bot, user_data: dict):
             }
 
         # Add the memory to core memories
-        current_memories = user_data[user_id].get("core_memories", "")
-        user_data[user_id]["core_memories"] = f"{current_memories}\n- {memory}"
+        await user_data.prefetch(user_id)
+        user_data.append_core_memories(user_id, f"\n- {memory}")
 
         await interaction.response.send_message("I'll remember that.", ephemeral=True)
 
     @bot.tree.command(name="status", description="Check your status with the bot.")
     async def status(interaction: discord.Interaction):
         user_id = str(interaction.user.id)
-        if user_id not in user_data:
+        # Read from the stats index: the record itself isn't loaded
+        stats = user_data.metadata(user_id)
+        if stats is None:
             await interaction.response.send_message("No data found for you.", ephemeral=True)
             return
 
-        token_usage = user_data[user_id].get("token_usage", 0)
-        premium_status = "Premium" if user_data[user_id].get("premium", False) else "Standard"
-        conversation_length = len(user_data[user_id].get("conversation_history", []))
-        newline='\n'
+        premium_status = "Premium" if stats["premium"] else "Standard"
         await interaction.response.send_message(
             f"Status:\n"
             f"- Plan: {premium_status}\n"
-            f"- Token usage: {token_usage:,} tokens\n"
-            f"- Conversation length: {conversation_length} messages\n"
-            f"- Core memories: {len(user_data[user_id].get('core_memories', '').split(newline))} entries",
+            f"- Token usage: {stats['token_usage']:,} tokens\n"
+            f"- Conversation length: {stats['conversation_length']} messages\n"
+            f"- Core memories: {stats['core_memory_entries']} entries",
             ephemeral=True
         )
 
@@ -403,16 +404,17 @@ def setup_commands(bot: commands.Bot, user_data: dict):
     @app_commands.describe(context="Additional context to include (optional).")
     async def reroll(interaction: discord.Interaction, context: str = None):
         user_id = str(interaction.user.id)
+        await user_data.prefetch(user_id)
         conv_history = user_data.get(user_id, {}).get("conversation_history", [])
         if not conv_history:
             await interaction.response.send_message("No conversation history available to reroll.", ephemeral=True)
             return
 
-        # Remove the last assistant message if it exists.
-        if conv_history[-1]["role"] == "assistant":
-            temp_history = conv_history[:-1]
-        else:
-            temp_history = conv_history[:]
+        # Remove the last assistant message if it exists, and keep only the
+        # turns that fit the context budget rather than copying the whole history.
+        model = PREMIUM_MODEL if user_data[user_id].get("premium", False) else DEFAULT_MODEL
+        end = len(conv_history) - 1 if conv_history[-1]["role"] == "assistant" else len(conv_history)
+        temp_history = context_window(conv_history, model, end=end)
 
         if context:
             temp_history.append({
@@ -420,9 +422,14 @@ def setup_commands(bot: commands.Bot, user_data: dict):
                 "content": "[OOC]: " + context + "\nIf you respond to this context, please use [OOC] tags."
             })
 
-        core_mem = user_data[user_id].get("core_memories", "")
-        system_text = f"{CORE_PROMPT}\n\nCore Memories:\n{core_mem}"
-        model = PREMIUM_MODEL if user_data[user_id].get("premium", False) else DEFAULT_MODEL
+        # Pinned core memories stay in the cached system prompt; the ones
+        # relevant to this exchange go after the history.
+        recent_turns = temp_history[-3:]
+        core_mem, relevant_mem = relevant_memories(
+            user_id, user_data[user_id], "\n".join(str(t["content"]) for t in recent_turns)
+        )
+        system_text = build_system_prompt(CORE_PROMPT, core_mem)
+        live_context = f"Relevant core memories:\n{relevant_mem}" if relevant_mem else None
 
         temp_user_data = {
             user_id: {
@@ -443,7 +450,9 @@ def setup_commands(bot: commands.Bot, user_data: dict):
                     user_content=None,
                     temperature=1.0,
                     max_tokens=1250,
-                    verbose=False
+                    verbose=False,
+                    live_context=live_context,
+                    priority=Priority.REROLL
                 )
             return new_response.choices[0].message["content"]
 
@@ -461,7 +470,9 @@ def setup_commands(bot: commands.Bot, user_data: dict):
                 user_content=None,
                 temperature=1.0,
                 max_tokens=1250,
-                verbose=False
+                verbose=False,
+                live_context=live_context,
+                priority=Priority.REROLL
             )
         result = response.choices[0].message["content"]
 
@@ -44,16 +44,37 @@ CORE_MEMORY_DUMP_PROMPT = os.environ.get("core_memory_dump", "Create comprehensi
 # Memory settings
 ENABLE_CORE_MEMORY_PICKLE_LOG = os.environ.get("enable_core_memory_pickle_log", "true").lower() == "true"
 CORE_MEMORY_PICKLE_DIR = os.environ.get("core_memory_pickle_dir", "./")
+CORE_MEMORY_ARCHIVE_RETENTION_DAYS = float(os.environ.get("core_memory_archive_retention_days", "0"))  # 0 = keep forever
+CORE_MEMORY_ARCHIVE_MAX_PER_USER = int(os.environ.get("core_memory_archive_max_per_user", "100"))  # 0 = no limit
 CONVERSATION_TOKEN_THRESHOLD = int(os.environ.get("conversation_token_threshold", "25000"))
 CORE_MEMORY_TOKEN_THRESHOLD = int(os.environ.get("core_memory_token_threshold", "25000"))
+CORE_MEMORY_PROMPT_TOKENS = int(os.environ.get("core_memory_prompt_tokens", "2000"))  # 0 sends all core memories
+CORE_MEMORY_TOP_K = int(os.environ.get("core_memory_top_k", "20"))
+CORE_MEMORY_PINNED = int(os.environ.get("core_memory_pinned", "5"))
+SUMMARIZATION_CONCURRENCY = int(os.environ.get("summarization_concurrency", "2"))  # Background summaries at once
+SUMMARY_CHUNK_TOKENS = int(os.environ.get("summary_chunk_tokens", "8000"))  # 0 summarizes in one request
+HISTORY_COMPRESS_AFTER_TURNS = int(os.environ.get("history_compress_after_turns", "20"))  # 0 disables compression
+HISTORY_COMPRESS_MIN_BYTES = int(os.environ.get("history_compress_min_bytes", "256"))
 
 # Bot reply settings
 BOT_REPLY_THRESHOLD = int(os.environ.get("bot_reply_threshold", "3"))
 YES_NO_VOTE_COUNT = int(os.environ.get("yes_no_vote_count", "3"))
 VOTING_MODEL = os.environ.get("voting_model", "claude-3-5-haiku-20241022")
+COALESCE_WINDOW_SECONDS = float(os.environ.get("coalesce_window_seconds", "1.5"))  # Debounce window for message bursts
 
 # File paths
 USER_DATA_FILE = os.environ.get("user_data_file", "user_info.pickle")
+USER_DATA_BACKEND = os.environ.get("user_data_backend", "sqlite").lower()  # "sqlite" or "pickle"
+USER_DATA_DB = os.environ.get("user_data_db", "user_data.sqlite3")
+USER_DATA_CODEC = os.environ.get("user_data_codec", "json").lower()  # "json" or "msgpack"
+USER_DATA_COMPRESSION_LEVEL = int(os.environ.get("user_data_compression_level", "0"))  # zlib level, 0 = off
+USER_DATA_READ_PICKLE = os.environ.get("user_data_read_pickle", "false").lower() == "true"  # Legacy pickled rows
+USER_DATA_CACHE_MB = float(os.environ.get("user_data_cache_mb", "64"))  # Loaded user records kept in memory, 0 = all
+USER_DATA_SAVE_WINDOW = float(os.environ.get("user_data_save_window", "5"))  # Seconds to gather save requests
+USER_DATA_JOURNAL = os.environ.get("user_data_journal", "user_data.journal")
+JOURNAL_FLUSH_INTERVAL = float(os.environ.get("journal_flush_interval", "0.05"))  # Group-commit window in seconds
+JOURNAL_COMPACT_BYTES = int(os.environ.get("journal_compact_bytes", str(8 * 1024 * 1024)))
+JOURNAL_COMPACT_INTERVAL = float(os.environ.get("journal_compact_interval", "600"))  # Seconds
 API_LOG_FILE = os.environ.get("api_log_file", "anthropic_api_calls.log")
 VERBOSE_LOGGING = os.environ.get("VERBOSE_LOGGING", False)
 
@@ -63,9 +84,17 @@ REROLL_TIMEOUT_SECONDS = int(os.environ.get("reroll_timeout_seconds", "60"))
 # LLM settings
 DEFAULT_MAX_TOKENS = int(os.environ.get("default_max_tokens", "1250"))
 DEFAULT_TEMPERATURE = float(os.environ.get("default_temperature", "1.0"))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("context_token_budget", "12000"))  # 0 sends the whole history
+PREMIUM_CONTEXT_TOKEN_BUDGET = int(os.environ.get("premium_context_token_budget", "20000"))
 
 # Discord settings
 MAX_MESSAGE_LENGTH = int(os.environ.get("max_message_length", "2000"))
+COMMAND_TREE_HASH_FILE = os.environ.get("command_tree_hash_file", "command_tree.hash")  # Empty syncs on every start
+NICKNAME_EDIT_CONCURRENCY = int(os.environ.get("nickname_edit_concurrency", "4"))
+
+# Streaming replies
+ENABLE_STREAMING_REPLIES = os.environ.get("enable_streaming_replies", "true").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.environ.get("stream_edit_interval", "1.0"))  # Seconds between message edits
 
 # Periodic tasks
 SAVE_INTERVAL_MINUTES = int(os.environ.get("save_interval_minutes", "1"))
@@ -74,9 +103,39 @@ SAVE_INTERVAL_MINUTES = int(os.environ.get("save_interval_minutes", "1"))
 SHOULD_REPLY_TIMEOUT = float(os.environ.get("should_reply_timeout", "10"))
 SUMMARIZE_TIMEOUT = float(os.environ.get("summarize_timeout", "30"))
 LLM_TIMEOUT = float(os.environ.get("llm_timeout", "60"))
+ENTITY_DETECTION_TIMEOUT = float(os.environ.get("entity_detection_timeout", "3"))
+CLASSIFIER_QUEUE_TIMEOUT = float(os.environ.get("classifier_queue_timeout", "10"))  # Max queue wait for votes/entity detection
+
+# Anthropic client settings
+LLM_MAX_CONCURRENCY = int(os.environ.get("llm_max_concurrency", "8"))  # Max in-flight API requests
+LLM_CLASSIFIER_SLOTS = int(os.environ.get("llm_classifier_slots", "2"))  # Extra in-flight slots only classifiers use
+LLM_MAX_CONNECTIONS = int(os.environ.get("llm_max_connections", "20"))  # HTTP connection pool size
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("llm_max_keepalive_connections", "10"))
+LLM_MAX_RETRIES = int(os.environ.get("llm_max_retries", "2"))
+
+# Request scheduling (0 = unlimited)
+LLM_RATE_LIMITS = os.environ.get("llm_rate_limits", "")  # JSON: {"model": {"rpm": 50, "tpm": 40000}}
+DEFAULT_RPM_LIMIT = int(os.environ.get("default_rpm_limit", "0"))
+DEFAULT_TPM_LIMIT = int(os.environ.get("default_tpm_limit", "0"))
 
 # Sharding configuration
 SHARD_COUNT = int(os.environ.get("shard_count", "1"))
 
+# Decision cache (should_reply votes and entity detection)
+DECISION_CACHE_TTL = float(os.environ.get("decision_cache_ttl", "600"))  # Seconds
+DECISION_CACHE_MAX_ENTRIES = int(os.environ.get("decision_cache_max_entries", "5000"))
+DECISION_CACHE_MAX_BYTES = int(os.environ.get("decision_cache_max_bytes", str(4 * 1024 * 1024)))
+DECISION_CACHE_FILE = os.environ.get("decision_cache_file", "decision_cache.json")  # Empty disables persistence
+
+# Prompt caching
+ENABLE_PROMPT_CACHING = os.environ.get("enable_prompt_caching", "true").lower() == "true"
+
 # Logging configuration
 ENABLE_API_CALL_LOGGING = os.environ.get("enable_api_call_logging", "false").lower() == "true"
+API_LOG_QUEUE_SIZE = int(os.environ.get("api_log_queue_size", "1000"))  # Records dropped when full
+API_LOG_BATCH_SIZE = int(os.environ.get("api_log_batch_size", "100"))
+API_LOG_FLUSH_INTERVAL = float(os.environ.get("api_log_flush_interval", "1.0"))  # Seconds
+API_LOG_MAX_BYTES = int(os.environ.get("api_log_max_bytes", str(10 * 1024 * 1024)))  # 0 disables size rotation
+API_LOG_ROTATE_INTERVAL = float(os.environ.get("api_log_rotate_interval", "0"))  # Seconds, 0 disables
+API_LOG_COMPRESS = os.environ.get("api_log_compress", "true").lower() == "true"
+API_LOG_BACKUP_COUNT = int(os.environ.get("api_log_backup_count", "5"))  # 0 keeps all rotated files
@@ -0,0 +1,141 @@
+# decision_cache.py
+import os
+import re
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+import aiofiles
+
+from config import (
+    DECISION_CACHE_TTL,
+    DECISION_CACHE_MAX_ENTRIES,
+    DECISION_CACHE_MAX_BYTES,
+    DECISION_CACHE_FILE
+)
+from utils import log_info, log_error
+
+_ENTRY_OVERHEAD_BYTES = 200  # rough per-entry cost of the dict slot, tuple and key
+
+
+class DecisionCache:
+    """
+    Bounded in-memory cache for classifier decisions (should_reply votes and
+    entity detection), so repeated content is answered without an API call.
+
+    Entries expire after ttl seconds and the least recently used entries are
+    evicted once max_entries or max_bytes is exceeded. Values must be JSON
+    serializable so the cache can optionally be persisted across restarts.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int, path: str = ""):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self._entries = OrderedDict()  # key -> (expires_at, value, size)
+        self._bytes = 0
+        self.hits = {}  # kind -> count
+        self.misses = {}
+
+    @staticmethod
+    def make_key(kind: str, *parts) -> str:
+        """
+        Builds a cache key from everything a decision depends on. Parts are
+        normalized (case and whitespace) so trivially different reposts match.
+        """
+        normalized = [re.sub(r"\s+", " ", str(p or "")).strip().lower() for p in parts]
+        digest = hashlib.sha256("\x1f".join(normalized).encode("utf-8")).hexdigest()
+        return f"{kind}:{digest}"
+
+    def get(self, key: str):
+        """Returns the cached value for key, or None on a miss."""
+        kind = key.split(":", 1)[0]
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.time():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses[kind] = self.misses.get(kind, 0) + 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits[kind] = self.hits.get(kind, 0) + 1
+        return entry[1]
+
+    def put(self, key: str, value, expires_at: float = None):
+        if key in self._entries:
+            self._remove(key)
+        size = len(key) + len(json.dumps(value)) + _ENTRY_OVERHEAD_BYTES
+        self._entries[key] = (expires_at or time.time() + self.ttl, value, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        hits = sum(self.hits.values())
+        misses = sum(self.misses.values())
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "by_kind": {
+                kind: {"hits": self.hits.get(kind, 0), "misses": self.misses.get(kind, 0)}
+                for kind in sorted(set(self.hits) | set(self.misses))
+            }
+        }
+
+    def summary(self) -> str:
+        """One-line summary for the admin status command."""
+        s = self.stats()
+        kinds = ", ".join(f"{k} {v['hits']}/{v['hits'] + v['misses']}" for k, v in s["by_kind"].items())
+        return (
+            f"{s['entries']} entries ({s['bytes'] / 1024:.0f} KiB), "
+            f"hit rate {s['hit_rate']:.0%} ({s['hits']} hits, {s['misses']} misses)"
+            + (f" [{kinds}]" if kinds else "")
+        )
+
+    async def load(self):
+        """Loads unexpired entries from the persistence file, if one is configured."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            async with aiofiles.open(self.path, "r", encoding="utf-8") as f:
+                data = json.loads(await f.read())
+            now = time.time()
+            for key, expires_at, value in data:
+                if expires_at > now:
+                    self.put(key, value, expires_at)
+            log_info(f"Decision cache loaded: {len(self._entries)} entries.")
+        except Exception as e:
+            log_error(f"Failed to load decision cache: {e}")
+
+    async def save(self):
+        """Writes unexpired entries to the persistence file, if one is configured."""
+        if not self.path:
+            return
+        now = time.time()
+        data = [[key, expires_at, value]
+                for key, (expires_at, value, _) in self._entries.items() if expires_at > now]
+        tmp_path = f"{self.path}.tmp"
+        try:
+            async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+                await f.write(json.dumps(data))
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log_error(f"Failed to save decision cache: {e}")
+
+
+# Shared cache for should_reply votes and entity detection.
+decision_cache = DecisionCache(
+    ttl=DECISION_CACHE_TTL,
+    max_entries=DECISION_CACHE_MAX_ENTRIES,
+    max_bytes=DECISION_CACHE_MAX_BYTES,
+    path=DECISION_CACHE_FILE
+)
@@ -0,0 +1,255 @@
+# history.py
+import zlib
+from array import array
+from collections.abc import MutableSequence
+
+from config import HISTORY_COMPRESS_AFTER_TURNS, HISTORY_COMPRESS_MIN_BYTES
+from token_utils import content_units
+
+# Role names by code. Turns store the code; unknown roles are added as seen.
+_ROLES = ["user", "assistant"]
+_ROLE_CODES = {role: code for code, role in enumerate(_ROLES)}
+
+
+def _role_code(role: str) -> int:
+    code = _ROLE_CODES.get(role)
+    if code is None:
+        code = _ROLE_CODES[role] = len(_ROLES)
+        _ROLES.append(role)
+    return code
+
+
+class _Packed(bytes):
+    """A zlib-compressed turn content (UTF-8)."""
+    __slots__ = ()
+
+
+class ConversationHistory(MutableSequence):
+    """
+    A user's conversation turns, stored compactly.
+
+    Drop-in replacement for the list of {"role", "content"} dicts: indexing,
+    slicing and iteration still produce such dicts (built on access), and
+    append/insert/del/len work as on a list. Internally each turn is a role
+    byte, its content, and its estimator units (token_utils.content_units),
+    computed once per turn so units() is O(1).
+
+    Contents of turns more than compress_after turns from the end are
+    zlib-compressed when at least compress_min_bytes long and compression
+    saves space; they are decompressed transparently on access.
+    """
+
+    __slots__ = ("_roles", "_contents", "_units", "_units_total", "_unknown_units", "_checked",
+                 "compress_after", "compress_min_bytes")
+
+    def __init__(self, turns=(), compress_after: int = HISTORY_COMPRESS_AFTER_TURNS,
+                 compress_min_bytes: int = HISTORY_COMPRESS_MIN_BYTES):
+        self._roles = bytearray()
+        self._contents = []
+        self._units = array("i")  # -1 until computed
+        self._units_total = 0  # sum of the computed units
+        self._unknown_units = 0
+        self._checked = 0  # turns before this index have been considered for compression
+        self.compress_after = compress_after
+        self.compress_min_bytes = compress_min_bytes
+        for turn in turns:
+            # Units of existing turns are computed on first use, not on load.
+            self._roles.append(_role_code(turn["role"]))
+            self._contents.append(turn["content"])
+            self._units.append(-1)
+            self._unknown_units += 1
+        self._compress_old()
+
+    # Sequence protocol
+
+    def __len__(self):
+        return len(self._roles)
+
+    def _content(self, index: int):
+        content = self._contents[index]
+        if type(content) is _Packed:
+            return zlib.decompress(content).decode("utf-8")
+        return content
+
+    def _turn(self, index: int) -> dict:
+        return {"role": _ROLES[self._roles[index]], "content": self._content(index)}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._turn(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("conversation history index out of range")
+        return self._turn(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._turn(i)
+
+    def __setitem__(self, index, turn):
+        if isinstance(index, slice):
+            turns = list(self)
+            turns[index] = turn
+            self._reset(turns)
+            return
+        if index < 0:
+            index += len(self)
+        self._forget_units(index)
+        self._roles[index] = _role_code(turn["role"])
+        self._contents[index] = turn["content"]
+        self._set_units(index, content_units(turn["content"]))
+        self._checked = min(self._checked, index)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            indexes = range(*index.indices(len(self)))
+            if not indexes:
+                return
+            for i in indexes:
+                self._forget_units(i)
+            first = min(indexes[0], indexes[-1])
+        else:
+            if index < 0:
+                index += len(self)
+            self._forget_units(index)
+            first = index
+        del self._roles[index]
+        del self._contents[index]
+        del self._units[index]
+        self._checked = min(self._checked, first)
+
+    def insert(self, index: int, turn: dict):
+        if index < 0:
+            index = max(0, index + len(self))
+        index = min(index, len(self))
+        units = content_units(turn["content"])
+        self._roles.insert(index, _role_code(turn["role"]))
+        self._contents.insert(index, turn["content"])
+        self._units.insert(index, units)
+        self._units_total += units
+        self._checked = min(self._checked, index)
+        self._compress_old()
+
+    def append(self, turn: dict):
+        self.insert(len(self), turn)
+
+    def __repr__(self):
+        return f"ConversationHistory({len(self)} turns, {self.units()} units)"
+
+    def _reset(self, turns: list):
+        self.__init__(turns, self.compress_after, self.compress_min_bytes)
+
+    # Token accounting
+
+    def _forget_units(self, index: int):
+        units = self._units[index]
+        if units < 0:
+            self._unknown_units -= 1
+        else:
+            self._units_total -= units
+
+    def _set_units(self, index: int, units: int):
+        self._units[index] = units
+        self._units_total += units
+
+    def turn_units(self, index: int) -> int:
+        """Estimator units of one turn (content plus message overhead)."""
+        if index < 0:
+            index += len(self)
+        units = self._units[index]
+        if units < 0:
+            units = content_units(self._content(index))
+            self._unknown_units -= 1
+            self._set_units(index, units)
+        return units
+
+    def units(self) -> int:
+        """Estimator units of the whole history; convert with token_utils.units_to_tokens."""
+        if self._unknown_units:
+            for i in range(len(self)):
+                if self._units[i] < 0:
+                    self.turn_units(i)
+        return self._units_total
+
+    # Compression
+
+    def _compress_old(self):
+        if self.compress_after <= 0:
+            return
+        end = len(self) - self.compress_after
+        for i in range(self._checked, max(end, 0)):
+            content = self._contents[i]
+            if type(content) is str and len(content) >= self.compress_min_bytes:
+                raw = content.encode("utf-8")
+                packed = zlib.compress(raw)
+                if len(packed) < len(raw):
+                    self._contents[i] = _Packed(packed)
+        self._checked = max(self._checked, end)
+
+    # Conversion
+
+    def messages(self, start: int = 0, end: int = None) -> list:
+        """The turns from start to end as API messages ({"role", "content"} dicts)."""
+        return [self._turn(i) for i in range(*slice(start, end).indices(len(self)))]
+
+    def columns(self) -> tuple:
+        """(role names, contents as text, units with -1 where unknown): the turns as plain lists."""
+        roles = [_ROLES[code] for code in self._roles]
+        contents = [self._content(i) for i in range(len(self))]
+        return roles, contents, self._units.tolist()
+
+    @classmethod
+    def from_columns(cls, roles: list, contents: list, units: list = None) -> "ConversationHistory":
+        """
+        Inverse of columns(); units may be omitted to compute them on first use.
+        Old turns are compressed on the next append rather than here, so
+        reading a record that is never changed costs no compression.
+        """
+        if units is None:
+            units = [-1] * len(roles)
+        if not len(roles) == len(contents) == len(units):
+            raise ValueError("conversation history columns differ in length")
+        history = cls()
+        history._roles = bytearray(_role_code(role) for role in roles)
+        history._contents = list(contents)
+        history._units = array("i", units)
+        history._units_total = sum(u for u in history._units if u >= 0)
+        history._unknown_units = sum(1 for u in history._units if u < 0)
+        return history
+
+    def copy(self) -> "ConversationHistory":
+        """Cheap copy: the arrays are copied, the contents are shared."""
+        other = ConversationHistory.__new__(ConversationHistory)
+        other._roles = bytearray(self._roles)
+        other._contents = list(self._contents)
+        other._units = array("i", self._units)
+        other._units_total = self._units_total
+        other._unknown_units = self._unknown_units
+        other._checked = self._checked
+        other.compress_after = self.compress_after
+        other.compress_min_bytes = self.compress_min_bytes
+        return other
+
+    def __getstate__(self):
+        return {
+            "roles": [_ROLES[code] for code in sorted(set(self._roles))],
+            "codes": bytes(self._roles),
+            "contents": self._contents,
+            "units": self._units.tobytes(),
+            "checked": self._checked,
+        }
+
+    def __setstate__(self, state):
+        # Role codes are per process, so they are stored with their names.
+        names = {code: name for code, name in zip(sorted(set(state["codes"])), state["roles"])}
+        self._roles = bytearray(_role_code(names[code]) for code in state["codes"])
+        self._contents = state["contents"]
+        self._units = array("i")
+        self._units.frombytes(state["units"])
+        self._units_total = sum(u for u in self._units if u >= 0)
+        self._unknown_units = sum(1 for u in self._units if u < 0)
+        self._checked = state["checked"]
+        self.compress_after = HISTORY_COMPRESS_AFTER_TURNS
+        self.compress_min_bytes = HISTORY_COMPRESS_MIN_BYTES
+
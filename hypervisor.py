@@ -4,7 +4,9 @@ from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Any
 
 from ai import call_claude
-from config import DEFAULT_MODEL
+from scheduler import Priority
+from prompts import build_system_prompt
+from config import DEFAULT_MODEL, LLM_TIMEOUT
 from utils import log_error
 
 
@@ -57,7 +59,7 @@ class Hypervisor:
     # -----------------------------------------------------
     async def _query_character(self, character: Character, message: str, history: List[Dict[str, str]]) -> str:
         """Send the message to the character's LLM and return the response text."""
-        system_prompt = character.prompt
+        system_prompt = build_system_prompt(character.prompt)
         try:
             result = await call_claude(
                 user_id=character.name,
@@ -68,6 +70,8 @@ class Hypervisor:
                 temperature=1.0,
                 max_tokens=500,
                 verbose=False,
+                timeout=LLM_TIMEOUT,
+                priority=Priority.CHANNEL_REPLY,
             )
             return result.choices[0].message["content"].strip()
         except Exception as e:
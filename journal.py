@@ -0,0 +1,141 @@
+# journal.py
+import os
+import json
+import asyncio
+
+from utils import log_error
+
+
+class Journal:
+    """
+    Append-only log of user-data mutations, one JSON object per line.
+
+    append() assigns the next sequence number and buffers the entry without
+    blocking; a background task writes buffered entries in batches, each batch
+    followed by a single fsync (group commit). Compaction rotates the file to
+    path + ".old", which is deleted once the store has saved a snapshot that
+    covers it; entries still present at startup are replayed.
+    """
+
+    def __init__(self, path: str, flush_interval: float, fsync: bool = True):
+        self.path = path
+        self.old_path = f"{path}.old"
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.seq = 0
+        self.bytes_written = 0
+        self.batches = 0
+        self._buffer = []
+        self._wakeup = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._task = None
+        self._closing = False
+
+    def append(self, entry: dict) -> int:
+        """Buffers a mutation and returns its sequence number."""
+        self.seq += 1
+        entry["seq"] = self.seq
+        self._buffer.append(json.dumps(entry, separators=(",", ":"), default=str) + "\n")
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+        return self.seq
+
+    async def _run(self):
+        while not self._closing:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self._closing:
+                # Let entries from the same burst share one write and fsync.
+                await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Writes and fsyncs everything buffered so far."""
+        if not self._buffer:
+            return
+        async with self._write_lock:
+            lines, self._buffer = "".join(self._buffer), []
+            try:
+                await asyncio.to_thread(self._write, lines)
+                self.bytes_written += len(lines)
+                self.batches += 1
+            except Exception as e:
+                log_error(f"Error writing user data journal: {e}")
+                self._buffer.insert(0, lines)
+
+    def _write(self, lines: str):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def size(self) -> int:
+        """Bytes in the current journal file (not counting unflushed entries)."""
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    async def rotate(self):
+        """
+        Flushes, then moves the current file aside so new entries start a fresh
+        one. If an earlier rotated file was never discarded (its snapshot
+        failed), the current entries are added to it instead.
+        """
+        await self.flush()
+        async with self._write_lock:
+            await asyncio.to_thread(self._rotate)
+
+    def _rotate(self):
+        if not os.path.exists(self.path):
+            return
+        if os.path.exists(self.old_path):
+            with open(self.path, "r", encoding="utf-8") as src, open(self.old_path, "a", encoding="utf-8") as dst:
+                dst.write(src.read())
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.old_path)
+
+    def discard_rotated(self):
+        """Deletes the rotated file once a snapshot covering it has been saved."""
+        try:
+            os.remove(self.old_path)
+        except FileNotFoundError:
+            pass
+
+    def read(self, after_seq: int = 0) -> list:
+        """
+        Returns the entries with seq > after_seq from the rotated and current
+        files, in order, and moves self.seq past everything found. A torn last
+        line (from a crash mid-write) is skipped.
+        """
+        entries = []
+        for path in (self.old_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        log_error(f"Skipping unreadable journal line in {path}")
+                        continue
+                    self.seq = max(self.seq, entry["seq"])
+                    if entry["seq"] > after_seq:
+                        entries.append(entry)
+        self.seq = max(self.seq, after_seq)
+        return entries
+
+    async def close(self):
+        """Writes buffered entries and stops the background task."""
+        if self._task is not None and not self._task.done():
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+        self._task = None
+        await self.flush()
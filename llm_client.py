@@ -0,0 +1,91 @@
+# llm_client.py
+import contextlib
+import anthropic
+from config import (
+    OAI_TOKEN,
+    LLM_TIMEOUT,
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_KEEPALIVE_CONNECTIONS,
+    LLM_MAX_RETRIES
+)
+from utils import log_info
+
+# Process-wide client, created lazily on first use so that it binds to the
+# running event loop. How many requests are in flight is up to the caller:
+# every request goes through scheduler.llm_scheduler first.
+_client = None
+
+
+def _connection_limits():
+    """
+    Builds the connection pool limits for the shared HTTP client.
+    The limits class is taken from the SDK defaults so we use whatever HTTP
+    library the installed anthropic package was built against.
+    """
+    limits_cls = type(anthropic.DEFAULT_CONNECTION_LIMITS)
+    return limits_cls(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=anthropic.DEFAULT_CONNECTION_LIMITS.keepalive_expiry
+    )
+
+
+def get_client() -> anthropic.AsyncAnthropic:
+    """
+    Returns the shared AsyncAnthropic client, creating it on first use.
+    All callers share one connection pool, so TLS sessions are reused.
+    """
+    global _client
+    if _client is None:
+        _client = anthropic.AsyncAnthropic(
+            api_key=OAI_TOKEN,
+            timeout=LLM_TIMEOUT,
+            max_retries=LLM_MAX_RETRIES,
+            http_client=anthropic.DefaultAsyncHttpxClient(limits=_connection_limits())
+        )
+        log_info(f"Created shared Anthropic client (pool {LLM_MAX_CONNECTIONS})")
+    return _client
+
+
+async def create_message(timeout: float = None, **kwargs):
+    """
+    Calls messages.create on the shared client. timeout overrides the
+    client default (LLM_TIMEOUT) for this call only.
+    """
+    client = get_client()
+    return await client.messages.create(
+        timeout=timeout if timeout is not None else LLM_TIMEOUT,
+        **kwargs
+    )
+
+
+@contextlib.asynccontextmanager
+async def stream_message(timeout: float = None, **kwargs):
+    """
+    Opens a messages.stream on the shared client.
+    """
+    client = get_client()
+    async with client.messages.stream(
+        timeout=timeout if timeout is not None else LLM_TIMEOUT,
+        **kwargs
+    ) as stream:
+        yield stream
+
+
+async def count_tokens(timeout: float = None, **kwargs):
+    """
+    Calls messages.count_tokens on the shared client.
+    """
+    client = get_client()
+    return await client.beta.messages.count_tokens(
+        timeout=timeout if timeout is not None else LLM_TIMEOUT,
+        **kwargs
+    )
+
+
+async def close_client():
+    """Closes the shared client and its connection pool (used on shutdown)."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
@@ -2,12 +2,11 @@
 import discord
 import json
 import time
+import hashlib
 import random
 from discord.ext import commands, tasks
-import pickle
 import os
 import logging
-import aiofiles
 import re
 import asyncio
 
@@ -21,21 +20,41 @@ from config import (
     PREMIUM_MODEL,
     CORE_PROMPT,
     SHOULD_REPLY_TIMEOUT,
+    CLASSIFIER_QUEUE_TIMEOUT,
     SUMMARIZE_TIMEOUT,
+    SUMMARIZATION_CONCURRENCY,
     LLM_TIMEOUT,
+    ENTITY_DETECTION_TIMEOUT,
     TYPING_SPEED_CPM,
     MAX_TYPING_TIME,
     MIN_TYPING_TIME,
     TYPING_VARIANCE,
     VERBOSE_LOGGING,
     REPLY_COOLDOWN,
-    BOT_REPLY_THRESHOLD
+    BOT_REPLY_THRESHOLD,
+    MAX_MESSAGE_LENGTH,
+    ENABLE_STREAMING_REPLIES,
+    STREAM_EDIT_INTERVAL,
+    COALESCE_WINDOW_SECONDS,
+    USER_DATA_SAVE_WINDOW,
+    USER_DATA_CACHE_MB,
+    COMMAND_TREE_HASH_FILE,
+    NICKNAME_EDIT_CONCURRENCY
 )
 
-from utils import log_info, log_error, send_large_message
+from utils import log_info, log_error, send_large_message, send_streaming_message
 from commands import setup_commands
 from ai import call_claude
-from memory import maybe_summarize_conversation
+from llm_client import close_client
+from prompts import build_system_prompt
+from decision_cache import decision_cache
+from api_log import api_log_writer
+from scheduler import llm_scheduler, Priority
+from coalescer import MessageCoalescer
+from memory import SummarizationWorker
+from memory_index import relevant_memories
+from memory_archive import core_memory_archive
+from storage import UserStore, SaveCoordinator, create_backend, create_journal
 
 # Global to prevent errors, log_channel should be set by on_ready
 log_channel = None
@@ -61,10 +80,19 @@ bot_reply_lock = asyncio.Lock()
 # Key: channel ID, Value: list of messages (each as a dict with author and content)
 channel_context = {}
 
+# Merges bursts of messages from one author in one channel into a single turn.
+message_coalescer = MessageCoalescer(
+    COALESCE_WINDOW_SECONDS,
+    lambda burst: process_message(burst.message, burst)
+)
+
 async def get_yes_no_votes(message, is_bot=False, vote_count=3):
     """
     Ask Claude-3-5-haiku for multiple yes/no votes with recent conversation context.
     Uses an extremely strict prompt to ensure only yes/no responses.
+    Votes run concurrently and stop early once one option has a strict majority,
+    so the returned list may hold fewer than vote_count votes; the decision
+    computed from it is the same as from the full set.
     Respects the VERBOSE_LOGGING setting from config.
     """
     # Import at function level to ensure we get the current value
@@ -148,6 +176,14 @@ async def get_yes_no_votes(message, is_bot=False, vote_count=3):
         f"Do not include ANY other text, punctuation, or explanation."
     )
 
+    # Identical content, context and penalty state get the same decision, so
+    # serve repeats from the decision cache instead of voting again.
+    cache_key = decision_cache.make_key("vote", bot_name, message.clean_content, recent_context, penalty)
+    cached_votes = decision_cache.get(cache_key)
+    if cached_votes is not None:
+        log_info(f"Vote cache hit for: '{message.clean_content[:50]}...' -> {cached_votes}")
+        return list(cached_votes)
+
     # Log that we're starting voting - always log to console
     log_info(f"Starting vote for: '{message.clean_content[:50]}...'")
     
@@ -167,6 +203,7 @@ async def get_yes_no_votes(message, is_bot=False, vote_count=3):
     
     votes = []
     vote_details = []
+    vote_errors = []
     
     # Dummy user dict for API call
     dummy_user_dict = {
@@ -177,7 +214,9 @@ async def get_yes_no_votes(message, is_bot=False, vote_count=3):
         }
     }
 
-    for i in range(vote_count):
+    async def cast_vote(i):
+        """Runs one vote; returns (vote, detail, latency in seconds)."""
+        vote_start = time.time()
         try:
             response = await call_claude(
                 user_id="system_vote",
@@ -187,27 +226,58 @@ async def get_yes_no_votes(message, is_bot=False, vote_count=3):
                 user_content="",  # Content is in the system prompt
                 temperature=1.0,
                 max_tokens=5,
-                verbose=False
+                verbose=False,
+                timeout=SHOULD_REPLY_TIMEOUT,
+                priority=Priority.CLASSIFIER,
+                max_queue_wait=CLASSIFIER_QUEUE_TIMEOUT
             )
+            latency = time.time() - vote_start
+            if response.error:
+                # Failed or timed out: the fallback text is not a vote, and the
+                # decision must not be cached.
+                log_error(f"Vote {i+1} failed ({latency:.2f}s)")
+                vote_errors.append(i)
+                return "abstain", f"Vote {i+1}: ABSTAIN (error)", latency
             
             vote_raw = response.choices[0].message["content"].strip().lower()
-            log_info(f"Vote {i+1} raw response: '{vote_raw}'")
+            log_info(f"Vote {i+1} raw response: '{vote_raw}' ({latency:.2f}s)")
             
             # Be very strict in parsing - only accept exact "yes" or "no"
             if vote_raw == "yes":
-                votes.append("yes")
-                vote_details.append(f"Vote {i+1}: YES")
+                return "yes", f"Vote {i+1}: YES", latency
             elif vote_raw == "no":
-                votes.append("no")
-                vote_details.append(f"Vote {i+1}: NO")
+                return "no", f"Vote {i+1}: NO", latency
             else:
-                votes.append("abstain")
-                vote_details.append(f"Vote {i+1}: ABSTAIN (invalid: '{vote_raw}')")
+                return "abstain", f"Vote {i+1}: ABSTAIN (invalid: '{vote_raw}')", latency
                 
         except Exception as e:
             log_error(f"Error in vote {i+1}: {e}")
-            votes.append("abstain")
-            vote_details.append(f"Vote {i+1}: ABSTAIN (error)")
+            vote_errors.append(i)
+            return "abstain", f"Vote {i+1}: ABSTAIN (error)", time.time() - vote_start
+
+    # Dispatch all votes concurrently. As soon as one option holds a strict
+    # majority of vote_count the decision can no longer change, so the
+    # remaining in-flight votes are cancelled.
+    majority = vote_count // 2 + 1
+    vote_tasks = [asyncio.create_task(cast_vote(i)) for i in range(vote_count)]
+    try:
+        for next_vote in asyncio.as_completed(vote_tasks):
+            vote, detail, latency = await next_vote
+            votes.append(vote)
+            vote_details.append(f"{detail} ({latency:.2f}s)")
+            if max(votes.count(option) for option in ("yes", "no", "abstain")) >= majority:
+                break
+    finally:
+        pending = [task for task in vote_tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    if len(votes) < vote_count:
+        vote_details.append(f"{vote_count - len(votes)} vote(s) cancelled after majority was reached")
+
+    # Only cache decisions that were not affected by API errors
+    if not vote_errors:
+        decision_cache.put(cache_key, votes)
 
     # Count votes
     yes_count = votes.count("yes")
@@ -306,6 +376,10 @@ async def detect_entities(message, bot_name, max_retries=2):
     
     # Normalize bot_name for comparison
     normalized_bot_name = bot_name.lower().strip()
+
+    # Reuse the entities detected for identical content, if still cached
+    cache_key = decision_cache.make_key("entities", bot_name, content)
+    cached_entities = decision_cache.get(cache_key)
     
     # Create a focused prompt for entity detection
     prompt = f"""Your task is to analyze the given message and identify entities (characters, bots, or users) 
@@ -338,23 +412,27 @@ ONLY RETURN THE JSON ARRAY, NO OTHER TEXT."""
         }
     }
 
-    # Try with retries
-    for attempt in range(max_retries + 1):
+    # Try with retries (no API calls at all on a cache hit)
+    attempts = max_retries + 1 if cached_entities is None else 0
+    for attempt in range(attempts):
         try:
-            # Call Claude with a timeout
-            response = await asyncio.wait_for(
-                call_claude(
-                    user_id="entity_detection",
-                    user_dict=dummy_user_dict,
-                    model="claude-3-5-haiku-20241022",
-                    system_prompt=prompt,
-                    user_content=content,
-                    temperature=0.1,  # Very low temperature for consistency
-                    max_tokens=50,
-                    verbose=False
-                ),
-                timeout=3.0  # 3-second timeout to prevent blocking
+            # Call Claude; the timeout starts once the scheduler sends the request
+            response = await call_claude(
+                user_id="entity_detection",
+                user_dict=dummy_user_dict,
+                model="claude-3-5-haiku-20241022",
+                system_prompt=prompt,
+                user_content=content,
+                temperature=0.1,  # Very low temperature for consistency
+                max_tokens=50,
+                verbose=False,
+                timeout=ENTITY_DETECTION_TIMEOUT,
+                priority=Priority.CLASSIFIER,
+                max_queue_wait=CLASSIFIER_QUEUE_TIMEOUT
             )
+            if response.error:
+                # Failed or timed out: retry, and never cache the fallback text's result
+                raise RuntimeError(response.choices[0].message["content"])
             
             response_text = response.choices[0].message["content"].strip()
             
@@ -376,6 +454,7 @@ ONLY RETURN THE JSON ARRAY, NO OTHER TEXT."""
                     # Validate each entity is a string
                     entities = [str(e) for e in entities if e]
                     
+                    decision_cache.put(cache_key, entities)
                     break  # Successfully parsed, exit retry loop
                 else:
                     # No valid JSON found, try again or use empty list
@@ -396,14 +475,6 @@ ONLY RETURN THE JSON ARRAY, NO OTHER TEXT."""
                     break
                 continue  # Try again
                 
-        except asyncio.TimeoutError:
-            log_error(f"Entity detection timed out on attempt {attempt+1}")
-            # If all retries failed, use empty list
-            if attempt == max_retries:
-                entities = []
-                break
-            continue  # Try again
-            
         except Exception as e:
             log_error(f"Error in entity detection attempt {attempt+1}: {e}")
             # If all retries failed, use empty list
@@ -412,6 +483,9 @@ ONLY RETURN THE JSON ARRAY, NO OTHER TEXT."""
                 break
             continue  # Try again
     
+    if cached_entities is not None:
+        entities = list(cached_entities)
+
     # If all retries failed or entities is still not defined
     if 'entities' not in locals():
         entities = []
@@ -440,30 +514,40 @@ ONLY RETURN THE JSON ARRAY, NO OTHER TEXT."""
     return references_others_first, first_entity, entities
 
 
-user_data = {}
-USER_DATA_FILE = "user_info.pickle"
+# User records, persisted per user by the backend chosen with user_data_backend.
+# Conversation and memory changes go to the journal as they happen; records
+# are read on first use and cold ones dropped beyond user_data_cache_mb.
+user_data = UserStore(create_backend(), create_journal(), int(USER_DATA_CACHE_MB * 1024 * 1024))
+
+# Set once load_user_data has run. Turns wait for it, so messages that arrive
+# while the bot is still starting up are not answered from an empty store.
+user_data_ready = asyncio.Event()
 
 async def load_user_data():
-    global user_data
     try:
-        async with aiofiles.open(USER_DATA_FILE, "rb") as f:
-            data = await f.read()
-            loaded_data = pickle.loads(data)
-            user_data.clear()
-            user_data.update(loaded_data)
-        log_info("User data loaded successfully.")
+        await user_data.load()
+        log_info(f"User data loaded successfully ({len(user_data)} users, {user_data.backend.name} backend).")
     except Exception as e:
         log_error(f"Failed to load user data: {e}")
-        user_data.clear()
+    finally:
+        user_data_ready.set()
 
 async def save_user_data():
-    global user_data
+    """Writes the users that changed since the last save, compacting the journal when due."""
     try:
-        async with aiofiles.open(USER_DATA_FILE, "wb") as f:
-            await f.write(pickle.dumps(user_data, protocol=pickle.HIGHEST_PROTOCOL))
+        await user_data.save()
+        await user_data.maybe_compact()
     except Exception as e:
         log_error(f"Error saving user data: {e}")
 
+# Every place that changes user data asks this for a save; requests within
+# user_data_save_window are written together, one save at a time.
+user_data_saver = SaveCoordinator(save_user_data, USER_DATA_SAVE_WINDOW)
+
+# Conversations over conversation_token_threshold are summarized here, after
+# the reply has been sent, so no reply waits for a summary.
+summarizer = SummarizationWorker(user_data, SUMMARIZATION_CONCURRENCY, SUMMARIZE_TIMEOUT)
+
 
 setup_commands(bot, user_data)
 
@@ -505,6 +589,24 @@ def calculate_typing_time(response_text):
         
     return typing_time
 
+def typing_reveal():
+    """
+    Returns a reveal pace for streamed replies that matches calculate_typing_time:
+    nothing is shown before MIN_TYPING_TIME, text then appears at TYPING_SPEED_CPM
+    (with variance), and everything is shown once MAX_TYPING_TIME has passed.
+    """
+    variation = random.uniform(1 - TYPING_VARIANCE, 1 + TYPING_VARIANCE)
+    chars_per_second = TYPING_SPEED_CPM / 60 / variation
+
+    def reveal(elapsed):
+        if elapsed >= MAX_TYPING_TIME:
+            return None
+        if elapsed < MIN_TYPING_TIME:
+            return 0
+        return int(elapsed * chars_per_second)
+
+    return reveal
+
 # Helper function to safely send to log channel
 async def send_to_log_channel(message, level="INFO", force=False):
     """
@@ -568,12 +670,19 @@ async def process_admin_commands(message: discord.Message):
             )
             await log_channel.send(f"***Shutting down Claude's Mask ({DEFAULT_NAME})***")
             await bot.change_presence(status=discord.Status.invisible)
-            # Save user data before shutting down
+            # Save user data and fold the journal in before shutting down
             try:
-                await save_user_data()
+                await summarizer.close()
+                await user_data_saver.flush()
+                await user_data.close()
                 log_info("User data saved before shutdown")
             except Exception as e:
                 log_error(f"Failed to save user data before shutdown: {e}")
+            await decision_cache.save()
+            if core_memory_archive is not None:
+                core_memory_archive.close()
+            await api_log_writer.close()
+            await close_client()
             await bot.close()
             return
         else:
@@ -583,15 +692,9 @@ async def process_admin_commands(message: discord.Message):
     elif cmd == "user" and len(split) > 1 and split[1].lower() == "data?":
         if len(split) > 2:
             target_user_id = split[2]
-            data = user_data.get(target_user_id)
-            if data:
-                # Create a sanitized version for display (no actual conversation content)
-                sanitized_data = {
-                    "token_usage": data.get("token_usage", 0),
-                    "premium": data.get("premium", False),
-                    "conversation_length": len(data.get("conversation_history", [])),
-                    "core_memories_bytes": len(data.get("core_memories", "")),
-                }
+            # Sanitized metadata for display (no actual conversation content)
+            sanitized_data = user_data.metadata(target_user_id)
+            if sanitized_data:
                 msg = f"User data for {target_user_id}:\n```{sanitized_data}```"
                 await send_large_message(log_channel, msg)
             else:
@@ -600,20 +703,71 @@ async def process_admin_commands(message: discord.Message):
             await send_large_message(log_channel, "Usage: user data? [user_id]")
         return
 
-    # Add command to list all users
+    # List users one page at a time: list users [premium] [tokens|history|memories] [page]
     elif cmd == "list" and len(split) > 1 and split[1].lower() == "users":
-        user_list = [f"ID: {user_id}, Premium: {data.get('premium', False)}, Tokens: {data.get('token_usage', 0)}"
-                     for user_id, data in user_data.items()]
-        user_count = len(user_list)
-        msg = f"Total users: {user_count}\n"
-
-        # Send in chunks to avoid message length limits
-        chunk_size = 20
-        for i in range(0, len(user_list), chunk_size):
-            chunk = user_list[i:i + chunk_size]
-            chunk_msg = "\n".join(chunk)
-            await send_large_message(log_channel, f"Users {i + 1}-{i + len(chunk)}:\n```{chunk_msg}```")
+        sort_fields = {"tokens": "token_usage", "history": "conversation_length", "memories": "core_memories_bytes"}
+        field, premium_only, page = "token_usage", False, 1
+        for arg in split[2:]:
+            arg = arg.lower()
+            if arg.isdigit():
+                page = max(1, int(arg))
+            elif arg == "premium":
+                premium_only = True
+            elif arg in sort_fields:
+                field = sort_fields[arg]
+            else:
+                await log_channel.send("Usage: list users [premium] [tokens|history|memories] [page]")
+                return
 
+        # The stats index keeps users sorted, so a page costs the same however many users there are
+        page_size = 20
+        total = user_data.count_users(premium_only)
+        pages = max(1, (total + page_size - 1) // page_size)
+        rows = user_data.top_users(field, (page - 1) * page_size, page_size, premium_only)
+        user_list = [f"ID: {user_id}, Premium: {data['premium']}, Tokens: {data['token_usage']}, "
+                     f"Messages: {data['conversation_length']}, Memories: {data['core_memory_entries']}"
+                     for user_id, data in rows]
+        msg = f"{'Premium users' if premium_only else 'Total users'}: {total} (by {field}, page {page}/{pages})\n"
+        if user_list:
+            msg += "```" + "\n".join(user_list) + "```"
+        await send_large_message(log_channel, msg)
+        return
+
+    # Browse a user's archived core memories: history, show and diff
+    elif cmd == "memory" and len(split) > 2 and split[1].lower() in ("history", "show", "diff"):
+        if core_memory_archive is None:
+            await log_channel.send("The core memory archive is disabled (enable_core_memory_pickle_log=false).")
+            return
+        sub = split[1].lower()
+        try:
+            if sub == "history":
+                entries = await core_memory_archive.entries(split[2])
+                if not entries:
+                    await log_channel.send(f"No archived core memories for user {split[2]}.")
+                    return
+                lines = [f"#{e['id']}  {time.strftime('%Y-%m-%d %H:%M', time.gmtime(e['created_at']))} UTC  {e['size']} bytes"
+                         for e in entries]
+                await send_large_message(log_channel, f"Archived core memories for {split[2]} (newest first):\n```" + "\n".join(lines) + "```")
+            elif sub == "show":
+                entry = await core_memory_archive.get(int(split[2]))
+                if entry is None:
+                    await log_channel.send(f"No archived core memories with id {split[2]}.")
+                    return
+                await send_large_message(log_channel, f"Core memories #{entry['id']} of user {entry['user_id']}:\n```{entry['text']}```")
+            else:
+                old_id = int(split[2])
+                if len(split) > 3 and split[3].lower() != "current":
+                    diff = await core_memory_archive.diff(old_id, int(split[3]))
+                else:
+                    entry = await core_memory_archive.get(old_id)
+                    if entry is None:
+                        raise KeyError(old_id)
+                    await user_data.prefetch(entry["user_id"])
+                    current = user_data.get(entry["user_id"], {}).get("core_memories", "")
+                    diff = await core_memory_archive.diff(old_id, current=current)
+                await send_large_message(log_channel, f"```diff\n{diff or '(no changes)'}```")
+        except (ValueError, KeyError):
+            await log_channel.send("Usage: memory history [user_id] | memory show [id] | memory diff [id] [id|current]")
         return
 
     # Add command to toggle premium for a user
@@ -621,11 +775,12 @@ async def process_admin_commands(message: discord.Message):
         if len(split) > 1:
             target_user_id = split[1]
             if target_user_id in user_data:
+                await user_data.prefetch(target_user_id)
                 current_status = user_data[target_user_id].get("premium", False)
-                user_data[target_user_id]["premium"] = not current_status
+                user_data.set_premium(target_user_id, not current_status)
                 new_status = "enabled" if not current_status else "disabled"
                 await log_channel.send(f"Premium status for user {target_user_id} {new_status}.")
-                await save_user_data()
+                user_data_saver.request("premium")
             else:
                 await log_channel.send(f"User {target_user_id} not found.")
         else:
@@ -675,11 +830,28 @@ async def process_admin_commands(message: discord.Message):
             f"• Reply Cooldown: {REPLY_COOLDOWN}s\n"
             f"• Bot Reply Threshold: {BOT_REPLY_THRESHOLD}\n"
             f"• Verbose Logging: {'Enabled' if config.VERBOSE_LOGGING else 'Disabled'}\n"
-            f"• Users in DB: {len(user_data)}\n"
+            f"• Users in DB: {len(user_data)} ({user_data.count_users(premium_only=True)} premium)\n"
+            f"• User Storage: {user_data.summary()}\n"
+            f"• User Data Saves: {user_data_saver.summary()}\n"
+            f"• Summaries: {summarizer.summary()}\n"
+            f"• Decision Cache: {decision_cache.summary()}\n"
+            f"• LLM Scheduler: {llm_scheduler.summary()}\n"
+            f"• Message Coalescing: {message_coalescer.summary()}\n"
+            f"• API Call Log: {api_log_writer.summary() if config.ENABLE_API_CALL_LOGGING else 'disabled'}\n"
+            f"• Core Memory Archive: {await core_memory_archive.summary() if core_memory_archive else 'disabled'}\n"
             f"• Uptime: {(time.time() - bot.uptime) if hasattr(bot, 'uptime') else 'Unknown':.1f}s"
         )
         await log_channel.send(status_text)
 
+    # Force a slash command sync, e.g. after Discord lost the commands
+    elif cmd == "sync" and len(split) > 1 and split[1].lower() == "commands":
+        try:
+            await sync_commands(force=True)
+            await log_channel.send("Slash commands synced.")
+        except Exception as e:
+            await log_channel.send(f"Slash command sync failed: {e}")
+        return
+
     # Add this to your process_admin_commands function
     elif cmd == "testlog":
         test_message = "This is a test log message to verify log channel functionality."
@@ -690,24 +862,23 @@ async def process_admin_commands(message: discord.Message):
         
 
 # message processing as separate async function
-async def process_message(message: discord.Message):
+async def process_message(message: discord.Message, burst):
+    """
+    Handles one turn: a burst of messages from the same author, answered in
+    reply to the latest one (message). Cancelled if the author writes again
+    before the reply is sent.
+    """
+    await user_data_ready.wait()
     try:
         # For non-DM messages, check if we should reply
         if not isinstance(message.channel, discord.DMChannel):
-            # Use a timeout to limit the time spent checking if we should reply
-            try:
-                should_reply_result = await asyncio.wait_for(
-                    should_reply(message),
-                    timeout=SHOULD_REPLY_TIMEOUT
-                )
-                if not should_reply_result:
-                    return
-            except asyncio.TimeoutError:
-                log_error(f"should_reply timed out for message {message.id}")
+            # Each vote is bounded by should_reply_timeout once it is sent;
+            # time spent queued in the scheduler doesn't count against it.
+            if not await should_reply(message):
                 return
 
-        # Get the clean message content and skip if empty
-        content = message.clean_content.strip()
+        # Get the merged message content and skip if empty
+        content = burst.content
         if not content:
             return
 
@@ -745,11 +916,8 @@ async def process_message(message: discord.Message):
         # Only do entity detection for non-DM channels and substantive messages
         if not isinstance(message.channel, discord.DMChannel) and len(content) > 15:
             try:
-                # Set a timeout for the entire entity detection process
-                references_others_first, first_entity, all_entities = await asyncio.wait_for(
-                    detect_entities(message, DEFAULT_NAME),
-                    timeout=4.0  # 4-second timeout for the entire detection process
-                )
+                # Each detection call is bounded by entity_detection_timeout once it is sent
+                references_others_first, first_entity, all_entities = await detect_entities(message, DEFAULT_NAME)
                 
                 # Log the detection results
                 entity_detection_time = time.time() - entity_detection_start
@@ -819,11 +987,6 @@ async def process_message(message: discord.Message):
                     )
                     await send_to_log_channel(wait_decision)
                     
-            except asyncio.TimeoutError:
-                error_msg = "Entity detection timed out, continuing without waiting"
-                log_error(error_msg)
-                # Force error logs regardless of verbose setting
-                await send_to_log_channel(f"❌ **Entity Detection Error**\n{error_msg}", force=True)
             except Exception as e:
                 error_msg = f"Error in entity detection: {e}"
                 log_error(error_msg)
@@ -833,7 +996,7 @@ async def process_message(message: discord.Message):
         
         # Process the message and generate a response
         try:
-            await process_user_message(message, content)
+            await process_user_message(message, content, burst)
         except Exception as e:
             log_error(f"Error processing message: {e}")
             try:
@@ -844,11 +1007,54 @@ async def process_message(message: discord.Message):
         log_error(f"Error in process_message: {e}")
 
 
+async def stream_reply(message, user_id, model, system_text, live_context, priority, on_start=None):
+    """
+    Streams the reply into the channel as it is generated and returns the full
+    text. Replies to bots in public channels are paced at the simulated typing
+    speed, like the non-streaming path. on_start is called before the first
+    chunk is sent.
+    """
+    stream = await call_claude(
+        user_id=user_id,
+        user_dict=user_data,
+        model=model,
+        system_prompt=system_text,
+        user_content=None,
+        temperature=DEFAULT_TEMPERATURE,
+        max_tokens=DEFAULT_MAX_TOKENS,
+        verbose=False,
+        timeout=LLM_TIMEOUT,
+        live_context=live_context,
+        stream=True,
+        priority=priority
+    )
+    reveal = None
+    if not isinstance(message.channel, discord.DMChannel) and message.author.bot:
+        reveal = typing_reveal()
+
+    async def deltas():
+        async for delta in stream:
+            if on_start is not None:
+                on_start()
+            yield delta
+
+    async with message.channel.typing():
+        return await send_streaming_message(
+            message.channel,
+            deltas(),
+            prefix=f"{message.author.mention} ",
+            max_length=MAX_MESSAGE_LENGTH,
+            edit_interval=STREAM_EDIT_INTERVAL,
+            reveal=reveal
+        )
+
+
 # Extract core message processing logic
 # Modify how we build system prompt in process_user_message function
 
-async def process_user_message(message, content):
+async def process_user_message(message, content, burst):
     user_id = str(message.author.id)
+    await user_data.prefetch(user_id)
     if user_id not in user_data:
         user_data[user_id] = {
             "token_usage": 0,
@@ -857,20 +1063,18 @@ async def process_user_message(message, content):
             "core_memories": ""
         }
     
-    # Use a timeout for the summarization to prevent blocking
-    try:
-        await asyncio.wait_for(
-            maybe_summarize_conversation(user_id, user_data),
-            timeout=SUMMARIZE_TIMEOUT
-        )
-    except asyncio.TimeoutError:
-        log_error(f"Summarization timed out for user {user_id}")
-    
     # Append the user message to the conversation history
-    user_data[user_id]["conversation_history"].append({"role": "user", "content": content})
+    user_turn = {"role": "user", "content": content}
+    turn_index = len(user_data[user_id]["conversation_history"])
+    user_data.append_turn(user_id, user_turn)
     
     # ===== ENHANCED CONTEXT BUILDING =====
-    core_mem = user_data[user_id].get("core_memories", "")
+    # Pinned core memories go in the system prompt; the ones relevant to this
+    # message and the exchange before it go in the live context.
+    recent_turns = user_data[user_id]["conversation_history"][-3:]
+    core_mem, relevant_mem = relevant_memories(
+        user_id, user_data[user_id], "\n".join(str(t["content"]) for t in recent_turns)
+    )
     
     # Get current channel info
     current_channel_id = str(message.channel.id)
@@ -920,23 +1124,34 @@ async def process_user_message(message, content):
         
         external_context = "\n".join(context_lines)
     
-    # Build the system prompt
-    system_text = f"{channel_context_header}\n"
+    # Build the prompt from most static to least static: the character prompt and
+    # core memories form the cached system prefix, and the live channel context
+    # goes after the conversation so it never invalidates the prompt cache.
+    system_text = build_system_prompt(CORE_PROMPT, core_mem)
+    live_context = channel_context_header
+    if relevant_mem:
+        live_context += f"\nRelevant core memories:\n{relevant_mem}"
     if external_context:
-        system_text += f"External Context:\n{external_context}\n"
-    system_text += f"{CORE_PROMPT}\n\nCore Memories:\n{core_mem}"
+        live_context += f"\nExternal Context:\n{external_context}"
     
     # Choose the appropriate model
     model_to_use = PREMIUM_MODEL if user_data[user_id].get("premium", False) else DEFAULT_MODEL
+    # DMs are scheduled ahead of channel replies
+    priority = Priority.DM_REPLY if isinstance(message.channel, discord.DMChannel) else Priority.CHANNEL_REPLY
     
-    # Rest of the function remains the same...
     # Make API call with typing indicator
     typing_task = None
     try:
-        # First, make the API call with typing indicator
-        async with message.channel.typing():
-            response = await asyncio.wait_for(
-                call_claude(
+        if ENABLE_STREAMING_REPLIES:
+            # Stream the reply into the channel while it is generated. Generation
+            # is bounded by llm_timeout once admitted, the typing pace by max_typing_time.
+            result = await stream_reply(message, user_id, model_to_use, system_text, live_context, priority,
+                                        on_start=burst.commit)
+        else:
+            # First, make the API call with typing indicator
+            # (the timeout starts once the scheduler sends the request)
+            async with message.channel.typing():
+                response = await call_claude(
                     user_id=user_id,
                     user_dict=user_data,
                     model=model_to_use,
@@ -944,15 +1159,16 @@ async def process_user_message(message, content):
                     user_content=None,
                     temperature=DEFAULT_TEMPERATURE,
                     max_tokens=DEFAULT_MAX_TOKENS,
-                    verbose=False
-                ),
-                timeout=LLM_TIMEOUT
-            )
-        
-        result = response.choices[0].message["content"]
+                    verbose=False,
+                    timeout=LLM_TIMEOUT,
+                    live_context=live_context,
+                    priority=priority
+                )
+            result = response.choices[0].message["content"]
+        burst.commit()
         
         # Append the assistant's reply to the conversation history
-        user_data[user_id]["conversation_history"].append({"role": "assistant", "content": result})
+        user_data.append_turn(user_id, {"role": "assistant", "content": result})
 
         # Record that we replied to this bot if it's a bot message
         if message.author.bot:
@@ -967,7 +1183,9 @@ async def process_user_message(message, content):
             last_replied_to[channel_id][author_id] = time.time()
         
         # Calculate realistic typing time based on response length (only in public channels)
-        if not isinstance(message.channel, discord.DMChannel) and message.author.bot:
+        # Streamed replies are already paced by typing_reveal.
+        if (not ENABLE_STREAMING_REPLIES and not isinstance(message.channel, discord.DMChannel)
+                and message.author.bot):
             typing_time = calculate_typing_time(result)
             
             # Start extended typing in background
@@ -980,7 +1198,8 @@ async def process_user_message(message, content):
         
         # Send response with error handling
         try:
-            await send_large_message(message.channel, f"{message.author.mention} {result}")
+            if not ENABLE_STREAMING_REPLIES:
+                await send_large_message(message.channel, f"{message.author.mention} {result}")
         except Exception as e:
             log_error(f"Error sending message: {e}")
             try:
@@ -988,18 +1207,26 @@ async def process_user_message(message, content):
             except:
                 pass
             
+    except asyncio.CancelledError:
+        # Superseded by a newer message before the reply was sent; the newer
+        # turn repeats this content, so drop the unanswered user turn.
+        history = user_data[user_id]["conversation_history"]
+        if len(history) == turn_index + 1 and history[-1] == user_turn:
+            user_data.truncate_history(user_id, turn_index)
+        raise
+        
     except asyncio.TimeoutError:
         log_error(f"LLM call timed out for user {user_id}")
         result = "I apologize, but I'm having trouble thinking right now. Could you please try again in a moment?"
         # Append the error message to the conversation history
-        user_data[user_id]["conversation_history"].append({"role": "assistant", "content": result})
+        user_data.append_turn(user_id, {"role": "assistant", "content": result})
         await message.channel.send(f"{message.author.mention} {result}")
         
     except Exception as e:
         log_error(f"Error in LLM call: {e}")
         result = "I encountered an unexpected issue. Please try again later."
         # Append the error message to the conversation history
-        user_data[user_id]["conversation_history"].append({"role": "assistant", "content": result})
+        user_data.append_turn(user_id, {"role": "assistant", "content": result})
         await message.channel.send(f"{message.author.mention} {result}")
         
     finally:
@@ -1010,12 +1237,10 @@ async def process_user_message(message, content):
                 await typing_task
             except asyncio.CancelledError:
                 pass
-    
-    # Save user data with error handling
-    try:
-        await save_user_data()
-    except Exception as e:
-        log_error(f"Error saving user data: {e}")
+    # The turns are already journaled; this saves token usage with the next batch.
+    user_data_saver.request("reply")
+    # Summarize in the background if the conversation has grown too long.
+    summarizer.request(user_id)
 
 
 
@@ -1065,41 +1290,89 @@ async def heartbeat_check():
 async def before_heartbeat():
     await bot.wait_until_ready()
 
-@bot.event
-async def on_ready():
-    global log_channel
-    log_channel = bot.get_channel(LOG_CHANNEL_ID)
-    bot.uptime = time.time()
-    
-    if log_channel:
-        # Startup message includes DEFAULT_NAME in parentheses.
-        await log_channel.send(f"Claude's Mask ({DEFAULT_NAME}) is online!")
-        await log_channel.send("Loading user data...")
-        
-    try:
-        await load_user_data()
-        if log_channel:
-            await log_channel.send("User data loaded successfully!")
-    except Exception as e:
-        if log_channel:
-            await log_channel.send(f"Error loading user data: {e}")
-    
-    log_info("Claude's Mask is online!")
+def command_tree_hash() -> str:
+    """Hash of the slash command payload tree.sync() would send to Discord."""
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    data = json.dumps([bot.application_id, payload], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
 
+async def sync_commands(force: bool = False) -> bool:
+    """
+    Syncs the slash commands with Discord, unless they are unchanged since the
+    last successful sync (hash stored in command_tree_hash_file). The sync
+    endpoint is heavily rate limited, so restarts should not call it for
+    nothing. Returns True if a sync was made.
+    """
+    tree_hash = command_tree_hash()
+    if not force and COMMAND_TREE_HASH_FILE:
+        try:
+            with open(COMMAND_TREE_HASH_FILE, "r", encoding="utf-8") as f:
+                if f.read().strip() == tree_hash:
+                    log_info("Slash commands unchanged since the last sync; skipping sync.")
+                    return False
+        except OSError:
+            pass
     synced = await bot.tree.sync()
     log_info(f"Synced {len(synced)} slash commands.")
-    await bot.change_presence(status=discord.Status.online)
+    if COMMAND_TREE_HASH_FILE:
+        try:
+            with open(COMMAND_TREE_HASH_FILE, "w", encoding="utf-8") as f:
+                f.write(tree_hash)
+        except OSError as e:
+            log_error(f"Failed to store the command tree hash: {e}")
+    return True
+
+async def update_nicknames() -> int:
+    """
+    Sets the bot's nickname to DEFAULT_NAME in the guilds where it differs,
+    nickname_edit_concurrency guilds at a time. Returns the number changed.
+    """
+    semaphore = asyncio.Semaphore(max(1, NICKNAME_EDIT_CONCURRENCY))
 
-    for guild in bot.guilds:
-        member = guild.get_member(bot.user.id)
-        if member:
+    async def edit(member: discord.Member) -> bool:
+        async with semaphore:
             try:
                 await member.edit(nick=f"{DEFAULT_NAME}")
+                return True
             except Exception as e:
-                log_error(f"Failed to update nickname in guild {guild.id}: {e}")
-    
-    # Send admin commands reference to log channel
-    if log_channel:
+                log_error(f"Failed to update nickname in guild {member.guild.id}: {e}")
+                return False
+
+    members = [guild.get_member(bot.user.id) for guild in bot.guilds]
+    results = await asyncio.gather(*(edit(m) for m in members if m and m.nick != DEFAULT_NAME))
+    return sum(results)
+
+async def timed_phase(name: str, coro, timings: dict):
+    """Awaits one startup phase, recording its duration; failures are logged, not raised."""
+    started = time.perf_counter()
+    try:
+        return await coro
+    except Exception as e:
+        log_error(f"Startup phase {name} failed: {e}")
+    finally:
+        timings[name] = time.perf_counter() - started
+
+# on_ready fires again after Discord reconnects; startup must only run once.
+startup_done = False
+
+@bot.event
+async def on_ready():
+    global log_channel, startup_done
+    log_channel = bot.get_channel(LOG_CHANNEL_ID)
+    if startup_done:
+        log_info("Reconnected to Discord.")
+        return
+    startup_done = True
+    bot.uptime = time.time()
+    log_info("Claude's Mask is online!")
+    heartbeat_check.start()
+
+    async def announce():
+        if not log_channel:
+            return
+        # Startup message includes DEFAULT_NAME in parentheses.
+        await log_channel.send(f"Claude's Mask ({DEFAULT_NAME}) is online!")
+        # Send admin commands reference to log channel
         command_reference = (
             f"**📋 {DEFAULT_NAME} Admin Command Reference**\n\n"
             "**Bot Control Commands:**\n"
@@ -1108,12 +1381,16 @@ async def on_ready():
             "`verbose off` - Disable detailed logging to this channel\n"
             "`verbose` - Toggle verbose logging on/off\n"
             "`status` - Show current bot status and settings\n"
-            "`testlog` - Test log channel functionality\n\n"
+            "`testlog` - Test log channel functionality\n"
+            "`sync commands` - Sync the slash commands with Discord\n\n"
             
             "**User Management Commands:**\n"
             "`user data? [user_id]` - Show data for a specific user\n"
             "`premium [user_id]` - Toggle premium status for a user\n"
-            "`list users` - List all users with basic stats\n\n"
+            "`list users [premium] [tokens|history|memories] [page]` - List users, largest first\n"
+            "`memory history [user_id]` - List a user's archived core memories\n"
+            "`memory show [id]` - Show one archived version\n"
+            "`memory diff [id] [id|current]` - Diff two versions, or one against the current memories\n\n"
             
             f"**Logging Features:**\n"
             "• Entity detection logs - Track multi-bot conversation coordination\n"
@@ -1124,8 +1401,42 @@ async def on_ready():
         )
         await log_channel.send(command_reference)
 
-    heartbeat_check.start()
-    periodic_save.start()
+    async def load_users():
+        if log_channel:
+            await log_channel.send("Loading user data...")
+        try:
+            await load_user_data()
+            if log_channel:
+                await log_channel.send("User data loaded successfully!")
+        except Exception as e:
+            if log_channel:
+                await log_channel.send(f"Error loading user data: {e}")
+        # Turns can run from here on; the remaining phases don't block replies.
+        periodic_save.start()
+        await bot.change_presence(status=discord.Status.online)
+
+    # Independent steps run concurrently; only replies wait, for user data.
+    started = time.perf_counter()
+    timings = {}
+    _, _, _, synced, renamed = await asyncio.gather(
+        timed_phase("announce", announce(), timings),
+        timed_phase("decision_cache", decision_cache.load(), timings),
+        timed_phase("user_data", load_users(), timings),
+        timed_phase("commands", sync_commands(), timings),
+        timed_phase("nicknames", update_nicknames(), timings),
+    )
+    details = {
+        "commands": "synced" if synced else "unchanged",
+        "nicknames": f"{renamed or 0} changed",
+    }
+    phases = ", ".join(
+        f"{name} {seconds:.2f}s" + (f" ({details[name]})" if name in details else "")
+        for name, seconds in timings.items()
+    )
+    summary = f"Startup finished in {time.perf_counter() - started:.2f}s: {phases}"
+    log_info(summary)
+    if log_channel:
+        await log_channel.send(summary)
 
 @bot.event
 async def on_member_join(member: discord.Member):
@@ -1137,11 +1448,7 @@ async def on_member_join(member: discord.Member):
             "conversation_history": [],
             "core_memories": ""
         }
-    await save_user_data()
-
-@bot.event
-async def on_member_update(before: discord.Member, after: discord.Member):
-    await save_user_data()
+        user_data_saver.request("member_join")
 
 
 @bot.event
@@ -1174,15 +1481,17 @@ async def on_message(message: discord.Message):
         await process_admin_commands(message)
         return
 
-    # Create task for processing messages to avoid blocking
-    asyncio.create_task(process_message(message))
+    # Queue the message; bursts from the same author are answered as one turn
+    message_coalescer.submit(message)
 
 @tasks.loop(minutes=1)
 async def periodic_save():
-    await save_user_data()
+    user_data_saver.request("periodic")
+    await decision_cache.save()
 
 @periodic_save.before_loop
 async def before_periodic_save():
     await bot.wait_until_ready()
 
-bot.run(DISCORD_TOKEN)
+if __name__ == "__main__":
+    bot.run(DISCORD_TOKEN)
@@ -1,73 +1,193 @@
-import os
-import pickle
-import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
 from config import (
     CORE_MEMORY_PROMPT,
     CORE_MEMORY_DUMP_PROMPT,  # New: additional prompt when core memories get too long.
     PREMIUM_MODEL,
     DEFAULT_MODEL,
     SUMMARIZATION_PROMPT,
-    ENABLE_CORE_MEMORY_PICKLE_LOG,  # New: toggle for logging core memories.
-    CORE_MEMORY_PICKLE_DIR  # New: directory path for pickle dumps.
+    CONVERSATION_TOKEN_THRESHOLD,
+    CORE_MEMORY_TOKEN_THRESHOLD,
+    SUMMARY_CHUNK_TOKENS,
 )
-from token_utils import anthropic_token_count
+from token_utils import estimate_text_tokens, content_units, units_to_tokens
+from history import ConversationHistory
 from ai import call_claude
+from memory_archive import core_memory_archive
+from utils import log_info, log_error
+from prompts import build_system_prompt, SUMMARY_PREFIX
+from scheduler import Priority
 
 def estimate_tokens(text: str) -> int:
-    """Estimate token count by assuming one token is roughly 4 characters."""
-    return len(text) // 4
-
-async def maybe_summarize_conversation(
-    user_id: str,
-    user_data: dict,
-    # These parameters are no longer used because we use estimated token counts.
-    # max_unsummary_messages: int = 10,
-    # token_limit: int = 3000
-):
+    """Estimate token count locally with the calibrated estimator in token_utils."""
+    return estimate_text_tokens(text)
+
+def conversation_tokens(conversation, model: str = None) -> int:
     """
-    If the user's conversation is too large (by estimated token count),
-    call the summarizer to update core memories and replace older messages with a summary.
+    Estimated tokens of a conversation history. A ConversationHistory keeps a
+    running tally of its turns' units as they are appended, truncated or
+    replaced, so this is O(1) instead of re-reading the whole history.
     """
+    if isinstance(conversation, ConversationHistory):
+        units = conversation.units()
+    else:
+        units = sum(content_units(msg["content"]) for msg in conversation)
+    return units_to_tokens(units, model)
+
+def needs_summary(user_id: str, user_data) -> bool:
+    """Whether the user's conversation is over conversation_token_threshold. O(1)."""
     if user_id not in user_data:
-        user_data[user_id] = {
-            "token_usage": 0,
-            "premium": False,
-            "conversation_history": [],
-            "core_memories": ""
-        }
-
-    conversation = user_data[user_id]["conversation_history"]
+        return False
+    record = user_data[user_id]
+    conversation = record.get("conversation_history", [])
     if not conversation:
-        return
+        return False
+    model = PREMIUM_MODEL if record.get("premium", False) else DEFAULT_MODEL
+    return conversation_tokens(conversation, model) >= CONVERSATION_TOKEN_THRESHOLD
+
+_summary_locks = {}  # user_id -> asyncio.Lock, while a summary for that user runs or waits
+
+# Summaries of conversation parts, kept until the user's summary is spliced in
+# so a run that timed out reuses the parts it finished:
+# user_id -> {hash of the part: summary}, least recently used user first.
+_part_summaries = OrderedDict()
+_PART_SUMMARY_USERS = 256
+_PART_SUMMARY_MAX_TOKENS = 500
+
+_PART_REQUEST = (
+    "Below is part {index} of {count} of a conversation (or of earlier summaries of it), oldest first. "
+    "Summarize this part in a few short paragraphs. Keep everything that matters for long-term memory: "
+    "facts about the people involved, events, decisions, and how the relationship developed.\n\n"
+    "PART {index} OF {count}:\n{text}"
+)
+
+def format_turns(turns) -> str:
+    """A block of "ROLE: content" lines, as the summarizer reads a conversation."""
+    return "\n".join(f"{msg['role'].upper()}: {msg['content']}" for msg in turns)
+
+def split_turns(turns: list, units: list, max_tokens: int, model: str = None) -> list:
+    """
+    Splits turns into consecutive chunks of at most max_tokens estimated tokens
+    (units holds each turn's estimator units). A turn larger than that is a
+    chunk of its own.
+    """
+    chunks, chunk, chunk_units = [], [], 0
+    for turn, turn_units in zip(turns, units):
+        if chunk and units_to_tokens(chunk_units + turn_units, model) > max_tokens:
+            chunks.append(chunk)
+            chunk, chunk_units = [], 0
+        chunk.append(turn)
+        chunk_units += turn_units
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def _group_texts(texts: list, max_tokens: int, model: str = None) -> list:
+    """Joins consecutive texts into groups of at most max_tokens estimated tokens."""
+    groups = split_turns(texts, [content_units(text) for text in texts], max_tokens, model)
+    return ["\n\n".join(group) for group in groups]
+
+async def _summarize_parts(user_id: str, user_data, model: str, texts: list) -> list:
+    """Summarizes each text concurrently; finished ones are cached in _part_summaries."""
+    cache = _part_summaries.setdefault(user_id, {})
+    _part_summaries.move_to_end(user_id)
+    while len(_part_summaries) > _PART_SUMMARY_USERS:
+        _part_summaries.popitem(last=False)
+
+    async def summarize_part(index: int, text: str) -> str:
+        key = hashlib.blake2b(text.encode("utf-8", "replace"), digest_size=16).digest()
+        if key in cache:
+            return cache[key]
+        response = await call_claude(
+            user_id=user_id,
+            user_dict=user_data,
+            model=model,
+            system_prompt=build_system_prompt(SUMMARIZATION_PROMPT),
+            user_content=None,
+            temperature=0.5,
+            max_tokens=_PART_SUMMARY_MAX_TOKENS,
+            priority=Priority.SUMMARIZATION,
+            conversation=[{"role": "user", "content": _PART_REQUEST.format(
+                index=index + 1, count=len(texts), text=text
+            )}]
+        )
+        if getattr(response, "error", False):
+            raise RuntimeError(f"summarizer call failed for part {index + 1} of {len(texts)}")
+        cache[key] = response.choices[0].message["content"].strip()
+        return cache[key]
+
+    return await asyncio.gather(*(summarize_part(i, text) for i, text in enumerate(texts)))
+
+async def _conversation_text(user_id: str, user_data, model: str, conversation: list, units: list) -> str:
+    """
+    The conversation as the final summarization request reads it. Up to
+    summary_chunk_tokens it is the turns themselves; longer conversations are
+    split into parts of that size, which are summarized concurrently, and the
+    part summaries are summarized again the same way until they fit in one part.
+    """
+    if SUMMARY_CHUNK_TOKENS <= 0:
+        return format_turns(conversation)
+    texts = [format_turns(chunk) for chunk in split_turns(conversation, units, SUMMARY_CHUNK_TOKENS, model)]
+    if len(texts) == 1:
+        return texts[0]
+    while True:
+        summaries = await _summarize_parts(user_id, user_data, model, texts)
+        texts = _group_texts(summaries, SUMMARY_CHUNK_TOKENS, model)
+        # Stop once they fit, or if the summaries didn't get any shorter.
+        if len(texts) == 1 or len(texts) == len(summaries):
+            return "(Summaries of the conversation, oldest first)\n\n" + "\n\n".join(texts)
+
+async def summarize_conversation(user_id: str, user_data) -> bool:
+    """
+    If the user's conversation is too large (by estimated token count),
+    call the summarizer to update core memories and replace older messages with a summary.
+
+    Works on a snapshot of the history taken at the start; the live history is
+    only touched at the end, in one step with no await in between. Turns added
+    while the summarizer ran are kept after the summary. If the snapshotted
+    turns changed meanwhile (reset, forget, another summary) the summary is
+    dropped. Summaries of the same user are serialized by a per-user lock.
+    Returns True if a summary was spliced in.
+    """
+    lock = _summary_locks.setdefault(user_id, asyncio.Lock())
+    try:
+        async with lock:
+            return await _summarize(user_id, user_data)
+    finally:
+        if not lock.locked() and _summary_locks.get(user_id) is lock:
+            del _summary_locks[user_id]
+
+async def _summarize(user_id: str, user_data) -> bool:
+    # Checked again under the lock: a summary that just finished may have shrunk it.
+    await user_data.prefetch(user_id)
+    if not needs_summary(user_id, user_data):
+        return False
 
-    premium = user_data[user_id].get("premium", False)
+    record = user_data[user_id]
+    premium = record.get("premium", False)
     model_to_use = PREMIUM_MODEL if premium else DEFAULT_MODEL
 
-    # Build a single text block from conversation messages.
-    conversation_text = "\n".join(f"{msg['role'].upper()}: {msg['content']}" for msg in conversation)
-    estimated_conv_tokens = estimate_tokens(conversation_text)
+    # Immutable snapshot: plain copies of the turns, their cached estimates
+    # and the core memories.
+    history = record["conversation_history"]
+    conversation = history[:]
+    if isinstance(history, ConversationHistory):
+        units = [history.turn_units(i) for i in range(len(history))]
+    else:
+        units = [content_units(msg["content"]) for msg in conversation]
+    old_core = record.get("core_memories", "")
 
-    # If the estimated token count of the conversation is less than 25,000, do nothing.
-    if estimated_conv_tokens < 25000:
-        return
+    # The conversation, or for long ones the summaries of its parts.
+    conversation_text = await _conversation_text(user_id, user_data, model_to_use, conversation, units)
 
-    old_core = user_data[user_id].get("core_memories", "")
     # If the core memories are too long, add an extra prompt.
-    if estimate_tokens(old_core) >= 25000:
+    if estimate_tokens(old_core) >= CORE_MEMORY_TOKEN_THRESHOLD:
         core_prompt = f"{CORE_MEMORY_PROMPT}\n\n{CORE_MEMORY_DUMP_PROMPT}"
     else:
         core_prompt = CORE_MEMORY_PROMPT
 
-    # Dump old core memories to a pickle file if enabled.
-    if ENABLE_CORE_MEMORY_PICKLE_LOG:
-        os.makedirs(CORE_MEMORY_PICKLE_DIR, exist_ok=True)
-        pickle_filename = os.path.join(
-            CORE_MEMORY_PICKLE_DIR,
-            f"{user_id}_core_memories_{int(time.time())}.pickle"
-        )
-        with open(pickle_filename, "wb") as f:
-            pickle.dump(old_core, f)
-
     # Build the summarization request.
     summarization_request = (
         f"{core_prompt}\n\n"
@@ -77,28 +197,23 @@ async def maybe_summarize_conversation(
         "CORE MEMORIES:\n<updated core memories>\n\nSUMMARY:\n<short summary>"
     )
 
-    # Backup the conversation.
-    backup_convo = conversation[:]
-    # Replace conversation_history with a single summarization request.
-    user_data[user_id]["conversation_history"] = [
-        {"role": "user", "content": summarization_request}
-    ]
-
-    # Call the summarizer using the SUMMARIZATION_PROMPT as the system prompt.
+    # Call the summarizer using the SUMMARIZATION_PROMPT as the system prompt,
+    # with the summarization request as the only turn.
     response = await call_claude(
         user_id=user_id,
         user_dict=user_data,
         model=model_to_use,
-        system_prompt=SUMMARIZATION_PROMPT,
+        system_prompt=build_system_prompt(SUMMARIZATION_PROMPT),
         user_content=None,
         temperature=0.5,
-        max_tokens=750
+        max_tokens=750,
+        priority=Priority.SUMMARIZATION,
+        conversation=[{"role": "user", "content": summarization_request}]
     )
+    if getattr(response, "error", False):
+        raise RuntimeError("summarizer call failed")
     raw_output = response.choices[0].message["content"]
 
-    # Restore the original conversation.
-    user_data[user_id]["conversation_history"] = backup_convo
-
     # Parse the summarizer's output.
     updated_core = old_core
     short_summary = ""
@@ -114,14 +229,112 @@ async def maybe_summarize_conversation(
     else:
         updated_core = raw_output.strip()
 
-    user_data[user_id]["core_memories"] += "\n" + updated_core
+    # Archive the old core memories if enabled (enable_core_memory_pickle_log).
+    if core_memory_archive is not None and old_core:
+        try:
+            await core_memory_archive.add(user_id, old_core)
+        except Exception as e:
+            log_error(f"Failed to archive core memories for user {user_id}: {e}")
+
+    # Splice the summary in. From here to the end there is no await, so no
+    # other handler can change the history between the check and the update.
+    history = user_data[user_id]["conversation_history"] if user_id in user_data else []
+    if len(history) < len(conversation) or history[:len(conversation)] != conversation:
+        log_info(f"Conversation of user {user_id} changed during summarization; summary discarded.")
+        return False
+
+    user_data.append_core_memories(user_id, "\n" + updated_core)
 
     # Determine how many recent messages to keep
     # This ensures we keep complete exchanges (pairs of user-assistant messages)
     messages_to_keep = 4  # Keep last 2 exchanges (2 user + 2 assistant messages)
-    recent_messages = conversation[-messages_to_keep:] if len(conversation) >= messages_to_keep else conversation[:]
+    keep_from = max(0, len(conversation) - messages_to_keep)
+
+    # Replace the older conversation with a summary message followed by recent
+    # exchanges and any turns added since the snapshot
+    user_data.set_history(user_id, [
+        {"role": "assistant", "content": SUMMARY_PREFIX + short_summary}
+    ] + history[keep_from:])
+    # Only now are the part summaries used up; a discarded run keeps them for the next attempt.
+    _part_summaries.pop(user_id, None)
+    return True
+
+
+class SummarizationWorker:
+    """
+    Runs conversation summaries in the background, off the reply path.
+
+    request() is called after a reply has been sent. If the conversation is
+    over the threshold, the user is queued (at most once) and up to
+    `concurrency` summaries run at a time, each bounded by `timeout` seconds.
+    A summary that times out or fails changes nothing, and the next reply
+    requests it again.
+    """
+
+    def __init__(self, user_data, concurrency: int, timeout: float):
+        self.user_data = user_data
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.completed = 0
+        self.discarded = 0
+        self.failed = 0
+        self._queue = None
+        self._workers = []
+        self._pending = set()  # users queued or being summarized
+
+    def request(self, user_id: str) -> bool:
+        """
+        Queues a summary for the user if one is due. Returns True if queued.
+        A user whose record isn't loaded is queued unchecked; the worker reads
+        the record in a thread and checks then.
+        """
+        if user_id in self._pending:
+            return False
+        if self.user_data.is_loaded(user_id) and not needs_summary(user_id, self.user_data):
+            return False
+        if not self._workers:
+            self._queue = asyncio.Queue()
+            loop = asyncio.get_running_loop()
+            self._workers = [loop.create_task(self._run()) for _ in range(self.concurrency)]
+        self._pending.add(user_id)
+        self._queue.put_nowait(user_id)
+        return True
+
+    async def _run(self):
+        while True:
+            user_id = await self._queue.get()
+            try:
+                await self.summarize(user_id)
+            finally:
+                self._pending.discard(user_id)
+
+    async def summarize(self, user_id: str):
+        """Summarizes one user's conversation now, with the timeout; errors are logged."""
+        try:
+            if await asyncio.wait_for(summarize_conversation(user_id, self.user_data), timeout=self.timeout):
+                self.completed += 1
+            else:
+                self.discarded += 1
+        except asyncio.TimeoutError:
+            self.failed += 1
+            log_error(f"Summarization timed out for user {user_id}")
+        except Exception as e:
+            self.failed += 1
+            log_error(f"Summarization failed for user {user_id}: {e}")
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def close(self):
+        """Stops the workers; unfinished summaries are dropped and requested again later."""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._pending.clear()
 
-    # Replace the older conversation with a summary message followed by recent exchanges
-    user_data[user_id]["conversation_history"] = [
-        {"role": "assistant", "content": f"(Summary) {short_summary}"}
-    ] + recent_messages
+    def summary(self) -> str:
+        """One-line summary for the admin status command."""
+        return (f"{self.completed} done, {self.discarded} discarded, {self.failed} failed, "
+                f"{self.pending} pending")
@@ -0,0 +1,227 @@
+# memory_archive.py
+import os
+import re
+import glob
+import time
+import zlib
+import pickle
+import sqlite3
+import asyncio
+import difflib
+import argparse
+import threading
+
+from config import (
+    DEFAULT_NAME,
+    ENABLE_CORE_MEMORY_PICKLE_LOG,
+    CORE_MEMORY_PICKLE_DIR,
+    CORE_MEMORY_ARCHIVE_RETENTION_DAYS,
+    CORE_MEMORY_ARCHIVE_MAX_PER_USER
+)
+from utils import log_info, log_error
+
+_GC_INTERVAL = 3600  # seconds between retention sweeps
+_LEGACY_NAME = re.compile(r"^(?P<user>.+)_core_memories_(?P<ts>\d+)\.pickle$")
+
+
+class CoreMemoryArchive:
+    """
+    Archive of earlier core-memory versions, one SQLite file per character.
+
+    Every summarization adds the user's previous core memories as a
+    zlib-compressed row, indexed by user and time, so an admin can list,
+    read and diff a user's memory history. Writes happen in a worker thread.
+    Rows older than retention_days, and all but the newest max_per_user rows
+    of a user, are removed (0 disables either policy).
+    """
+
+    def __init__(self, path: str, retention_days: float = 0, max_per_user: int = 0):
+        self.path = path
+        self.retention_days = retention_days
+        self.max_per_user = max_per_user
+        self._conn = None
+        self._lock = threading.Lock()
+        self._last_gc = 0.0
+        self.added = 0
+        self.removed = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS archive ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, created_at REAL NOT NULL, "
+                "size INTEGER NOT NULL, data BLOB NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS archive_user ON archive (user_id, created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS archive_created ON archive (created_at)")
+            self._conn.commit()
+        return self._conn
+
+    # Worker-thread operations
+
+    def _insert(self, rows: list) -> list:
+        """rows: (user_id, created_at, text). Returns the new ids."""
+        ids = []
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                for user_id, created_at, text in rows:
+                    raw = text.encode("utf-8")
+                    cursor = conn.execute(
+                        "INSERT INTO archive (user_id, created_at, size, data) VALUES (?, ?, ?, ?)",
+                        (user_id, created_at, len(raw), zlib.compress(raw))
+                    )
+                    ids.append(cursor.lastrowid)
+                if self.max_per_user > 0:
+                    for user_id in {row[0] for row in rows}:
+                        self.removed += conn.execute(
+                            "DELETE FROM archive WHERE user_id = ? AND id NOT IN "
+                            "(SELECT id FROM archive WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?)",
+                            (user_id, user_id, self.max_per_user)
+                        ).rowcount
+        self.added += len(ids)
+        return ids
+
+    def _entries(self, user_id: str, limit: int) -> list:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT id, created_at, size FROM archive WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?",
+                (user_id, limit)
+            ).fetchall()
+        return [{"id": i, "created_at": created_at, "size": size} for i, created_at, size in rows]
+
+    def _get(self, entry_id: int):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT id, user_id, created_at, data FROM archive WHERE id = ?", (entry_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "user_id": row[1], "created_at": row[2], "text": zlib.decompress(row[3]).decode("utf-8")}
+
+    def _expire(self, cutoff: float) -> int:
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                removed = conn.execute("DELETE FROM archive WHERE created_at < ?", (cutoff,)).rowcount
+        self.removed += removed
+        return removed
+
+    def _stats(self) -> tuple:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*), COUNT(DISTINCT user_id), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0) "
+                "FROM archive"
+            ).fetchone()
+
+    # Async API
+
+    async def add(self, user_id: str, text: str, created_at: float = None) -> int:
+        """Archives one version of a user's core memories. Returns its id."""
+        ids = await asyncio.to_thread(self._insert, [(user_id, created_at or time.time(), text)])
+        await self.gc()
+        return ids[0]
+
+    async def entries(self, user_id: str, limit: int = 20) -> list:
+        """The user's archived versions, newest first: dicts with id, created_at and size."""
+        return await asyncio.to_thread(self._entries, user_id, limit)
+
+    async def get(self, entry_id: int):
+        """One archived version (id, user_id, created_at, text), or None."""
+        return await asyncio.to_thread(self._get, entry_id)
+
+    async def diff(self, old_id: int, new_id: int = None, current: str = None) -> str:
+        """
+        Unified diff from archived version old_id to version new_id, or to
+        current (e.g. the user's live core memories) when new_id is None.
+        """
+        old = await self.get(old_id)
+        if old is None:
+            raise KeyError(old_id)
+        if new_id is not None:
+            new = await self.get(new_id)
+            if new is None:
+                raise KeyError(new_id)
+            new_text, new_label = new["text"], f"#{new_id}"
+        else:
+            new_text, new_label = current or "", "current"
+        lines = difflib.unified_diff(
+            old["text"].splitlines(), new_text.splitlines(), f"#{old_id}", new_label, lineterm=""
+        )
+        return "\n".join(lines)
+
+    async def gc(self, force: bool = False) -> int:
+        """Removes rows past retention_days; runs at most hourly unless forced."""
+        if self.retention_days <= 0 or (not force and time.monotonic() - self._last_gc < _GC_INTERVAL):
+            return 0
+        self._last_gc = time.monotonic()
+        removed = await asyncio.to_thread(self._expire, time.time() - self.retention_days * 86400)
+        if removed:
+            log_info(f"Core memory archive: removed {removed} versions older than {self.retention_days} days.")
+        return removed
+
+    async def import_pickles(self, directory: str, delete: bool = False) -> int:
+        """
+        Imports the {user_id}_core_memories_{timestamp}.pickle files written by
+        earlier versions, optionally deleting each file once it is archived.
+        """
+        rows, paths = [], []
+        for path in sorted(glob.glob(os.path.join(directory, "*_core_memories_*.pickle"))):
+            match = _LEGACY_NAME.match(os.path.basename(path))
+            if not match:
+                continue
+            try:
+                with open(path, "rb") as f:
+                    text = pickle.load(f)
+            except Exception as e:
+                log_error(f"Skipping unreadable core memory dump {path}: {e}")
+                continue
+            rows.append((match["user"], float(match["ts"]), str(text or "")))
+            paths.append(path)
+        if rows:
+            await asyncio.to_thread(self._insert, rows)
+        if delete:
+            for path in paths:
+                os.remove(path)
+        log_info(f"Imported {len(rows)} core memory dumps from {directory} into {self.path}.")
+        return len(rows)
+
+    async def summary(self) -> str:
+        """One-line summary for the admin status command."""
+        count, users, raw, stored = await asyncio.to_thread(self._stats)
+        return f"{count} versions of {users} users, {stored / 1024:.0f} KiB ({raw / 1024:.0f} KiB uncompressed)"
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def _archive_path(character: str) -> str:
+    safe_name = re.sub(r"[^\w.-]+", "_", character) or "character"
+    return os.path.join(CORE_MEMORY_PICKLE_DIR, f"core_memories_{safe_name}.sqlite3")
+
+
+# Archive for this character; None when enable_core_memory_pickle_log is off.
+core_memory_archive = CoreMemoryArchive(
+    _archive_path(DEFAULT_NAME),
+    retention_days=CORE_MEMORY_ARCHIVE_RETENTION_DAYS,
+    max_per_user=CORE_MEMORY_ARCHIVE_MAX_PER_USER
+) if ENABLE_CORE_MEMORY_PICKLE_LOG else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import old core memory pickle dumps into the archive.")
+    parser.add_argument("directory", nargs="?", default=CORE_MEMORY_PICKLE_DIR, help="Directory with the dumps")
+    parser.add_argument("--archive", default=_archive_path(DEFAULT_NAME), help="Archive file to import into")
+    parser.add_argument("--delete", action="store_true", help="Delete each dump once it is archived")
+    args = parser.parse_args()
+    archive = CoreMemoryArchive(args.archive)
+    asyncio.run(archive.import_pickles(args.directory, args.delete))
+    archive.close()
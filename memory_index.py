@@ -0,0 +1,131 @@
+# memory_index.py
+import re
+import math
+import heapq
+from collections import Counter, OrderedDict
+
+from config import CORE_MEMORY_PROMPT_TOKENS, CORE_MEMORY_TOP_K, CORE_MEMORY_PINNED
+from token_utils import estimate_text_tokens
+
+# Core memories are one text per user; each non-blank line is an entry. Each
+# entry's creation time is kept alongside in record["core_memory_times"].
+_TERM_PATTERN = re.compile(r"\w+")
+_INDEX_CACHE_USERS = 256
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+
+
+def split_entries(core_memories: str) -> list:
+    """The entries of a core memories text: its non-blank lines, stripped."""
+    return [line.strip() for line in core_memories.splitlines() if line.strip()]
+
+
+def entry_times(record: dict) -> list:
+    """
+    Creation time of each entry in record["core_memories"], 0 where unknown
+    (entries written before times were kept, or by code that set the text directly).
+    """
+    count = len(split_entries(record.get("core_memories", "")))
+    times = list(record.get("core_memory_times") or [])[:count]
+    return times + [0.0] * (count - len(times))
+
+
+def updated_times(old_text: str, old_times: list, new_text: str, now: float) -> list:
+    """
+    Entry times after the core memories change from old_text to new_text:
+    entries that were already there keep their time, new ones get now.
+    """
+    known = {}
+    for entry, created_at in zip(split_entries(old_text), old_times):
+        known.setdefault(entry, []).append(created_at)
+    times = []
+    for entry in split_entries(new_text):
+        previous = known.get(entry)
+        times.append(previous.pop(0) if previous else now)
+    return times
+
+
+def _terms(text: str) -> list:
+    return _TERM_PATTERN.findall(text.lower())
+
+
+class CoreMemoryIndex:
+    """
+    BM25 index over the entries of one user's core memories. search() only
+    visits the entries that contain a query term, through per-term postings.
+    pinned holds the indexes of the newest entries (by time, then position).
+    """
+
+    def __init__(self, entries: list, times: list = None, pinned: int = CORE_MEMORY_PINNED):
+        self.entries = entries
+        times = times or [0.0] * len(entries)
+        self.pinned = heapq.nlargest(pinned, range(len(entries)), key=lambda i: (times[i], i))
+        self._lengths = []
+        self._postings = {}  # term -> [(entry index, term frequency)]
+        for i, entry in enumerate(entries):
+            counts = Counter(_terms(entry))
+            self._lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self._postings.setdefault(term, []).append((i, tf))
+        self._average_length = sum(self._lengths) / len(entries) if entries else 0.0
+
+    def search(self, query: str, limit: int) -> list:
+        """Indexes of the entries most relevant to query, best first (only those that match)."""
+        scores = {}
+        count = len(self.entries)
+        for term in set(_terms(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, tf in postings:
+                norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * self._lengths[i] / (self._average_length or 1))
+                scores[i] = scores.get(i, 0.0) + idf * tf * (_BM25_K1 + 1) / (tf + norm)
+        return sorted(scores, key=lambda i: (-scores[i], -i))[:limit]
+
+
+_indexes = OrderedDict()  # user_id -> (core memories text, CoreMemoryIndex), least recently used first
+
+
+def _index_for(user_id: str, record: dict) -> CoreMemoryIndex:
+    core_memories = record.get("core_memories", "")
+    cached = _indexes.get(user_id)
+    if cached is None or cached[0] != core_memories:
+        index = CoreMemoryIndex(split_entries(core_memories), entry_times(record))
+        cached = _indexes[user_id] = (core_memories, index)
+    _indexes.move_to_end(user_id)
+    while len(_indexes) > _INDEX_CACHE_USERS:
+        _indexes.popitem(last=False)
+    return cached[1]
+
+
+def relevant_memories(user_id: str, record: dict, query: str, model: str = None) -> tuple:
+    """
+    The core memories to send with a message, as (pinned, relevant).
+
+    Up to core_memory_prompt_tokens, pinned is all of them and relevant is
+    empty. Beyond that, pinned is the core_memory_pinned newest entries, which
+    only change when memories are added, so they can stay in the cached system
+    prompt. relevant is the core_memory_top_k entries that rank highest for
+    query, which change with every message and belong in the live context
+    after the history. Together they stay within core_memory_prompt_tokens,
+    each in original order, and repeated entries are only sent once.
+    """
+    core_memories = record.get("core_memories", "")
+    if CORE_MEMORY_PROMPT_TOKENS <= 0 or estimate_text_tokens(core_memories, model) <= CORE_MEMORY_PROMPT_TOKENS:
+        return core_memories, ""
+    index = _index_for(user_id, record)
+    entries = index.entries
+
+    pinned, relevant, seen, tokens = [], [], set(), 0
+    for chosen, candidates in ((pinned, index.pinned), (relevant, index.search(query, CORE_MEMORY_TOP_K))):
+        for i in candidates:
+            if entries[i] in seen:
+                continue
+            entry_tokens = estimate_text_tokens(entries[i], model)
+            if tokens + entry_tokens > CORE_MEMORY_PROMPT_TOKENS:
+                continue
+            chosen.append(i)
+            seen.add(entries[i])
+            tokens += entry_tokens
+    return "\n".join(entries[i] for i in sorted(pinned)), "\n".join(entries[i] for i in sorted(relevant))
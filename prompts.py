@@ -0,0 +1,130 @@
+# prompts.py
+from config import (
+    ENABLE_PROMPT_CACHING,
+    PREMIUM_MODEL,
+    CONTEXT_TOKEN_BUDGET,
+    PREMIUM_CONTEXT_TOKEN_BUDGET
+)
+from history import ConversationHistory
+from token_utils import content_units, units_to_tokens
+
+# Prompt assembly.
+# Blocks are ordered from most static to least static so the provider's prompt
+# cache can serve the long shared prefix:
+#   1. character prompt            (system, cache breakpoint)
+#   2. core memories               (system, cache breakpoint)
+#   3. conversation history        (messages, breakpoint on the last turn)
+#   4. live channel context        (after every breakpoint, never cached)
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Summaries (memory.py) replace the older turns with one assistant turn
+# starting with this prefix.
+SUMMARY_PREFIX = "(Summary) "
+
+# The context window's first turn moves in steps of this many turns, so the
+# history prefix stays the same, and cached, for several turns in a row.
+_WINDOW_STEP = 8
+
+
+def _text_block(text: str, cache: bool = False) -> dict:
+    block = {"type": "text", "text": text}
+    if cache and ENABLE_PROMPT_CACHING:
+        block["cache_control"] = CACHE_CONTROL
+    return block
+
+
+def build_system_prompt(character_prompt: str, core_memories: str = None) -> list:
+    """
+    Returns the system prompt as a list of text blocks: the character (or task)
+    prompt, then the user's core memories, each ending in a cache breakpoint.
+    """
+    blocks = [_text_block(character_prompt, cache=True)]
+    if core_memories and core_memories.strip():
+        blocks.append(_text_block(f"Core Memories:\n{core_memories}", cache=True))
+    return blocks
+
+
+def context_budget(model: str = None) -> int:
+    """Estimated tokens of conversation history to send to model (0: no limit)."""
+    return PREMIUM_CONTEXT_TOKEN_BUDGET if model == PREMIUM_MODEL else CONTEXT_TOKEN_BUDGET
+
+
+def is_summary(turn: dict) -> bool:
+    content = turn["content"]
+    return turn["role"] == "assistant" and isinstance(content, str) and content.startswith(SUMMARY_PREFIX)
+
+
+def context_window(conversation: list, model: str = None, budget: int = None, end: int = None) -> list:
+    """
+    The turns of conversation[:end] to send with a request: the most recent
+    turns that fit in budget estimated tokens (context_budget(model) by
+    default), after the rolling summary if the window doesn't reach it. The
+    newest turn is always sent. The window starts on a user turn, so roles
+    still alternate after the summary, and its start only moves in steps of
+    _WINDOW_STEP turns. Per-turn estimates are read from a ConversationHistory's
+    cache, so older turns are not decompressed or re-counted.
+    """
+    end = len(conversation) if end is None else min(end, len(conversation))
+    budget = context_budget(model) if budget is None else budget
+    if budget <= 0 or end == 0:
+        return conversation[:end]
+    if isinstance(conversation, ConversationHistory):
+        turn_units = conversation.turn_units
+    else:
+        turn_units = lambda i: content_units(conversation[i]["content"])
+
+    first = conversation[0]
+    summary = is_summary(first)
+    floor = 1 if summary else 0
+    units = turn_units(0) if summary else 0
+    start = end
+    while start > floor:
+        turn = turn_units(start - 1)
+        if start < end and units_to_tokens(units + turn, model) > budget:
+            break
+        units += turn
+        start -= 1
+    if start == floor:
+        return conversation[:end]
+
+    start = min(-(-start // _WINDOW_STEP) * _WINDOW_STEP, end - 1)
+    while start < end - 1 and conversation[start]["role"] != "user":
+        start += 1
+    window = conversation[start:end]
+    return [first] + window if summary else window
+
+
+def build_messages(conversation: list, live_context: str = None) -> list:
+    """
+    Converts conversation history into the messages sent to the API.
+    The last turn carries a cache breakpoint so the history prefix is reused on
+    the next call; live_context is added after it, as a trailing block of the
+    final user turn. The history (a list or history.ConversationHistory) is
+    converted in a single pass.
+    """
+    if not conversation:
+        return []
+    messages = list(conversation)
+    last = messages[-1]
+    content = last["content"]
+    blocks = list(content) if isinstance(content, list) else [_text_block(content)]
+    if ENABLE_PROMPT_CACHING:
+        blocks[-1] = dict(blocks[-1], cache_control=CACHE_CONTROL)
+    if live_context and last["role"] == "user":
+        blocks.append(_text_block(live_context))
+    messages[-1] = {"role": last["role"], "content": blocks}
+    return messages
+
+
+def add_live_context(system_prompt, conversation: list, live_context: str):
+    """
+    Returns the system prompt to use when live_context cannot ride on the final
+    user turn (the history does not end with a user message): the context is
+    appended as a final, uncached system block.
+    """
+    if not live_context or (conversation and conversation[-1]["role"] == "user"):
+        return system_prompt
+    if isinstance(system_prompt, str):
+        system_prompt = [_text_block(system_prompt)]
+    return list(system_prompt) + [_text_block(live_context)]
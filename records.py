@@ -0,0 +1,193 @@
+# records.py
+import json
+import zlib
+import struct
+import pickle
+
+try:
+    import msgpack
+except ImportError:  # optional, only needed for user_data_codec=msgpack
+    msgpack = None
+
+from config import USER_DATA_CODEC, USER_DATA_COMPRESSION_LEVEL, USER_DATA_READ_PICKLE
+from history import ConversationHistory
+from memory_index import split_entries, entry_times
+
+# Version of the stored record layout (see to_schema). Version 1 is the
+# ad-hoc dict that earlier releases pickled; MIGRATIONS[n] turns version n
+# into version n + 1, so old rows are read without being rewritten first.
+SCHEMA_VERSION = 3
+
+# Encoded records start with a 9-byte header: magic, schema version, codec id,
+# flags and the uncompressed payload size. Legacy rows are bare pickles, which
+# start with b"\x80" instead.
+_MAGIC = b"HM"
+_HEADER = struct.Struct(">2sBBBI")
+_COMPRESSED = 0x01  # flag: the payload is zlib-compressed
+
+
+def new_record() -> dict:
+    return {
+        "token_usage": 0,
+        "premium": False,
+        "conversation_history": ConversationHistory(),
+        "core_memories": "",
+        "core_memory_times": []
+    }
+
+
+def normalize_record(record: dict) -> dict:
+    """
+    Fills in missing fields (e.g. core_memories, absent from records created
+    outside the reply path) and converts the history to a ConversationHistory,
+    in place. Other keys are left as they are.
+    """
+    for key, value in new_record().items():
+        record.setdefault(key, value)
+    history = record["conversation_history"]
+    if not isinstance(history, ConversationHistory):
+        record["conversation_history"] = ConversationHistory(history or [])
+    return record
+
+
+# Schema
+
+_FIELDS = ("token_usage", "premium", "conversation_history", "core_memories", "core_memory_times")
+
+def to_schema(record: dict) -> dict:
+    """The record as plain types in the current schema version."""
+    extra = {k: v for k, v in record.items() if k not in _FIELDS}
+    history = record.get("conversation_history") or []
+    if not isinstance(history, ConversationHistory):
+        history = ConversationHistory(history)
+    roles, contents, units = history.columns()
+    return {
+        "token_usage": int(record.get("token_usage", 0)),
+        "premium": bool(record.get("premium", False)),
+        "core_memories": record.get("core_memories", ""),
+        "core_memory_times": entry_times(record),
+        "history": {"roles": roles, "contents": contents, "units": units},
+        "extra": extra,
+    }
+
+
+def from_schema(data: dict, version: int = SCHEMA_VERSION) -> dict:
+    """Builds a record from schema data of the given version, migrating it first."""
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"User record schema version {version} is newer than this release ({SCHEMA_VERSION})")
+    while version < SCHEMA_VERSION:
+        data = MIGRATIONS[version](data)
+        version += 1
+    history = data["history"]
+    record = dict(data.get("extra") or {})
+    record.update(
+        token_usage=data["token_usage"],
+        premium=data["premium"],
+        conversation_history=ConversationHistory.from_columns(history["roles"], history["contents"], history["units"]),
+        core_memories=data["core_memories"],
+        core_memory_times=data["core_memory_times"],
+    )
+    return record
+
+
+def _migrate_v1(record: dict) -> dict:
+    """Version 1: the unpickled record dict, any of whose keys may be missing."""
+    return to_schema(normalize_record(dict(record)))
+
+
+def _migrate_v2(data: dict) -> dict:
+    """Version 2 had no entry times; they are unknown (0) for existing entries."""
+    return {"core_memory_times": [0.0] * len(split_entries(data["core_memories"])), **data}
+
+
+MIGRATIONS = {1: _migrate_v1, 2: _migrate_v2}
+
+
+# Codecs: schema data (plain dicts, lists, strings and numbers) <-> bytes
+
+class JsonCodec:
+    """Compact UTF-8 JSON. Always available."""
+
+    name = "json"
+    id = 1
+
+    def dumps(self, data: dict) -> bytes:
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, payload: bytes) -> dict:
+        return json.loads(payload)
+
+
+class MsgpackCodec:
+    """MessagePack, if the msgpack package is installed."""
+
+    name = "msgpack"
+    id = 2
+
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError("user_data_codec=msgpack needs the msgpack package (pip install msgpack)")
+
+    def dumps(self, data: dict) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, payload: bytes) -> dict:
+        return msgpack.unpackb(payload, raw=False)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, MsgpackCodec)}
+_CODECS_BY_ID = {codec.id: codec for codec in CODECS.values()}
+_instances = {}
+
+
+def get_codec(name: str = USER_DATA_CODEC):
+    """The codec called name; raises ValueError for unknown or unavailable codecs."""
+    if name not in CODECS:
+        raise ValueError(f"Unknown user_data_codec: {name!r} (expected one of {', '.join(CODECS)})")
+    if name not in _instances:
+        _instances[name] = CODECS[name]()
+    return _instances[name]
+
+
+def format_prefix(codec, level: int = USER_DATA_COMPRESSION_LEVEL) -> bytes:
+    """The bytes every record encoded with codec and level starts with (the header minus the size)."""
+    return _HEADER.pack(_MAGIC, SCHEMA_VERSION, codec.id, _COMPRESSED if level > 0 else 0, 0)[:5]
+
+
+def encode_record(record: dict, codec=None, level: int = USER_DATA_COMPRESSION_LEVEL) -> bytes:
+    """Encodes a record in the current schema with codec, zlib-compressed at level (0 for none)."""
+    codec = codec or get_codec()
+    payload = codec.dumps(to_schema(record))
+    header = _HEADER.pack(_MAGIC, SCHEMA_VERSION, codec.id, _COMPRESSED if level > 0 else 0, len(payload))
+    return header + (zlib.compress(payload, level) if level > 0 else payload)
+
+
+def record_size(blob: bytes) -> int:
+    """
+    Approximate in-memory size of an encoded record: its uncompressed payload
+    size (the blob size for legacy pickles). Used for the user cache budget.
+    """
+    if blob.startswith(_MAGIC):
+        return _HEADER.unpack_from(blob)[4]
+    return len(blob)
+
+
+def decode_record(blob: bytes, allow_pickle: bool = USER_DATA_READ_PICKLE) -> dict:
+    """
+    Decodes a record written by encode_record with any codec or schema
+    version, or a legacy pickled one if allow_pickle is set. Pickles can run
+    arbitrary code when loaded, so only allow them for trusted databases.
+    """
+    if not blob.startswith(_MAGIC):
+        if not allow_pickle:
+            raise ValueError("Refusing to unpickle a legacy user record (user_data_read_pickle=false); "
+                             "convert them with `python storage.py --upgrade`")
+        return from_schema(pickle.loads(blob), version=1)
+    _, version, codec_id, flags, _ = _HEADER.unpack_from(blob)
+    codec_class = _CODECS_BY_ID.get(codec_id)
+    if codec_class is None:
+        raise ValueError(f"Unknown user record codec id {codec_id}")
+    payload = blob[_HEADER.size:]
+    if flags & _COMPRESSED:
+        payload = zlib.decompress(payload)
+    return from_schema(get_codec(codec_class.name).loads(payload), version)
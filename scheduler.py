@@ -0,0 +1,251 @@
+# scheduler.py
+import json
+import time
+import enum
+import bisect
+import asyncio
+import itertools
+import contextlib
+from collections import deque
+
+from config import (
+    LLM_MAX_CONCURRENCY,
+    LLM_CLASSIFIER_SLOTS,
+    LLM_RATE_LIMITS,
+    DEFAULT_RPM_LIMIT,
+    DEFAULT_TPM_LIMIT
+)
+from utils import log_error
+
+
+class Priority(enum.IntEnum):
+    """Priority classes for outbound LLM requests (lower runs first)."""
+    DM_REPLY = 0
+    CHANNEL_REPLY = 1
+    REROLL = 2
+    CLASSIFIER = 3  # should_reply votes and entity detection
+    SUMMARIZATION = 4
+
+
+class TokenBucket:
+    """
+    Token bucket holding up to one minute of capacity, refilled continuously.
+    A rate of 0 means unlimited. The level may go negative when a request
+    turns out to cost more than was reserved; later requests then wait.
+    """
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be taken (0 if it can be taken now)."""
+        if not self.per_minute:
+            return 0.0
+        self._refill()
+        # A single request larger than the bucket only needs a full bucket.
+        needed = min(amount, self.per_minute) - self.level
+        return max(0.0, needed * 60 / self.per_minute)
+
+    def take(self, amount: float):
+        if self.per_minute:
+            self._refill()
+            self.level -= amount
+
+
+class _Ticket:
+    __slots__ = ("scheduler", "model", "priority", "tokens", "future", "enqueued", "wait", "reserved")
+
+    def __init__(self, scheduler, model: str, priority: int, tokens: int, future):
+        self.scheduler = scheduler
+        self.model = model
+        self.priority = priority
+        self.tokens = tokens
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.wait = 0.0
+        self.reserved = False  # admitted into a classifier slot
+
+    def settle(self, actual_tokens: int):
+        """Records the real token cost of the request, once known."""
+        if actual_tokens is not None:
+            self.scheduler._adjust(self, actual_tokens)
+            self.tokens = actual_tokens
+
+
+class RequestScheduler:
+    """
+    Central admission control for outbound LLM requests.
+
+    Requests wait in a single queue ordered by priority (then arrival) and are
+    admitted while fewer than max_concurrency are in flight and the model's
+    requests-per-minute and tokens-per-minute buckets allow it. A request that
+    is held back by its model's buckets does not block requests for other
+    models, but later requests for the same model never overtake it.
+
+    classifier_slots more requests may be in flight as long as they are
+    CLASSIFIER requests, so should_reply votes and entity detection (which a
+    reply waits for) don't queue behind the replies that fill every slot.
+    """
+
+    def __init__(self, max_concurrency: int, rate_limits: dict, default_rpm: int, default_tpm: int,
+                 classifier_slots: int = 0):
+        self.max_concurrency = max_concurrency
+        self.classifier_slots = classifier_slots
+        self.classifiers_reserved = 0  # classifier requests in flight in the reserved slots
+        self.rate_limits = rate_limits
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.in_flight = 0
+        self._waiting = []  # sorted (priority, seq, ticket)
+        self._seq = itertools.count()
+        self._buckets = {}  # model -> (rpm bucket, tpm bucket)
+        self._timer = None
+        self._waits = {p: deque(maxlen=500) for p in Priority}  # recent queue wait times
+        self._dispatched = {p: 0 for p in Priority}
+        self._timed_out = {p: 0 for p in Priority}  # requests that gave up waiting (max_wait)
+
+    def _model_buckets(self, model: str):
+        if model not in self._buckets:
+            limits = self.rate_limits.get(model, {})
+            self._buckets[model] = (
+                TokenBucket(int(limits.get("rpm", self.default_rpm))),
+                TokenBucket(int(limits.get("tpm", self.default_tpm)))
+            )
+        return self._buckets[model]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, model: str, priority: int, estimated_tokens: int, max_wait: float = None):
+        """
+        Waits for permission to send a request and holds a concurrency slot
+        until the block exits. Call ticket.settle() with the actual token usage
+        so the tokens-per-minute bucket matches reality. Raises
+        asyncio.TimeoutError if the request is still queued after max_wait
+        seconds (None waits as long as it takes).
+        """
+        loop = asyncio.get_running_loop()
+        ticket = _Ticket(self, model, Priority(priority), estimated_tokens, loop.create_future())
+        bisect.insort(self._waiting, (ticket.priority, next(self._seq), ticket))
+        self._dispatch()
+        try:
+            await asyncio.wait_for(ticket.future, max_wait)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self._release(ticket)  # admitted just as the caller gave up
+            else:
+                self._remove(ticket)
+                if isinstance(e, asyncio.TimeoutError):
+                    self._timed_out[ticket.priority] += 1
+            raise
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    def _remove(self, ticket):
+        self._waiting = [entry for entry in self._waiting if entry[2] is not ticket]
+
+    def _release(self, ticket):
+        if ticket.reserved:
+            self.classifiers_reserved -= 1
+        else:
+            self.in_flight -= 1
+        self._dispatch()
+
+    def _adjust(self, ticket, actual_tokens: int):
+        _, tpm = self._model_buckets(ticket.model)
+        tpm.take(actual_tokens - ticket.tokens)
+
+    def _dispatch(self):
+        """Admits waiting requests in priority order while capacity allows."""
+        blocked_models = set()
+        next_check = None
+        remaining = []
+        for entry in self._waiting:
+            ticket = entry[2]
+            if ticket.future.done():
+                continue
+            reserved = self.in_flight >= self.max_concurrency
+            if (reserved and (ticket.priority != Priority.CLASSIFIER
+                              or self.classifiers_reserved >= self.classifier_slots)) \
+                    or ticket.model in blocked_models:
+                remaining.append(entry)
+                continue
+            rpm, tpm = self._model_buckets(ticket.model)
+            delay = max(rpm.wait_time(1), tpm.wait_time(ticket.tokens))
+            if delay > 0:
+                blocked_models.add(ticket.model)
+                next_check = delay if next_check is None else min(next_check, delay)
+                remaining.append(entry)
+                continue
+            rpm.take(1)
+            tpm.take(ticket.tokens)
+            ticket.reserved = reserved
+            if reserved:
+                self.classifiers_reserved += 1
+            else:
+                self.in_flight += 1
+            ticket.wait = time.monotonic() - ticket.enqueued
+            self._waits[ticket.priority].append(ticket.wait)
+            self._dispatched[ticket.priority] += 1
+            ticket.future.set_result(None)
+        self._waiting = remaining
+
+        # Re-check once the earliest rate-limited bucket has refilled.
+        if next_check is not None:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = asyncio.get_running_loop().call_later(next_check, self._dispatch)
+
+    def metrics(self) -> dict:
+        """Queue depth, dispatch counts and recent wait times per priority class."""
+        depth = {p: 0 for p in Priority}
+        for priority, _, ticket in self._waiting:
+            if not ticket.future.done():
+                depth[priority] += 1
+        result = {"in_flight": self.in_flight, "classifiers_reserved": self.classifiers_reserved, "classes": {}}
+        for p in Priority:
+            waits = sorted(self._waits[p])
+            result["classes"][p.name] = {
+                "queued": depth[p],
+                "dispatched": self._dispatched[p],
+                "timed_out": self._timed_out[p],
+                "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+                "p95_wait": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+            }
+        return result
+
+    def summary(self) -> str:
+        """Multi-line summary for the admin status command."""
+        m = self.metrics()
+        lines = [f"{m['in_flight']}/{self.max_concurrency} in flight, "
+                 f"{m['classifiers_reserved']}/{self.classifier_slots} classifier slots"]
+        for name, c in m["classes"].items():
+            lines.append(
+                f"  {name}: {c['queued']} queued, {c['dispatched']} sent, {c['timed_out']} timed out in queue, "
+                f"wait avg {c['avg_wait']:.2f}s / p95 {c['p95_wait']:.2f}s"
+            )
+        return "\n".join(lines)
+
+
+def _parse_rate_limits(raw: str) -> dict:
+    try:
+        return json.loads(raw) if raw else {}
+    except json.JSONDecodeError as e:
+        log_error(f"Invalid llm_rate_limits setting, ignoring it: {e}")
+        return {}
+
+
+llm_scheduler = RequestScheduler(
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    rate_limits=_parse_rate_limits(LLM_RATE_LIMITS),
+    default_rpm=DEFAULT_RPM_LIMIT,
+    default_tpm=DEFAULT_TPM_LIMIT,
+    classifier_slots=LLM_CLASSIFIER_SLOTS
+)
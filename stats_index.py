@@ -0,0 +1,85 @@
+# stats_index.py
+from bisect import bisect_left, insort
+from collections.abc import MutableMapping
+
+# Fields users can be ranked by, largest first.
+SORT_FIELDS = ("token_usage", "conversation_length", "core_memories_bytes")
+
+
+class UserStatsIndex(MutableMapping):
+    """
+    user_id -> stats dict (storage.record_metadata) for every user, kept sorted.
+
+    For each field in SORT_FIELDS the users are also held in a sorted list of
+    (-value, user_id) keys, once for all users and once for premium users, so
+    page() returns the top users by any field in O(log n + page) instead of
+    scanning and sorting everyone. Setting a user's stats moves them in each
+    list whose key changed with a binary search and one list shift.
+    """
+
+    def __init__(self, stats: dict = None):
+        self._stats = {user_id: dict(s) for user_id, s in (stats or {}).items()}
+        self._sorted = {(field, premium): [] for field in SORT_FIELDS for premium in (False, True)}
+        for (field, premium), keys in self._sorted.items():
+            keys.extend((-s[field], user_id) for user_id, s in self._stats.items() if s["premium"] or not premium)
+            keys.sort()
+
+    def _keys(self, user_id: str, stats: dict) -> dict:
+        """The user's key in each sorted list they belong to."""
+        if stats is None:
+            return {}
+        return {
+            (field, premium): (-stats[field], user_id)
+            for field, premium in self._sorted if stats["premium"] or not premium
+        }
+
+    def _move(self, old: dict, new: dict):
+        """Replaces the keys in old with those in new, touching only the lists where they differ."""
+        for name, key in old.items():
+            if new.get(name) != key:
+                keys = self._sorted[name]
+                del keys[bisect_left(keys, key)]
+        for name, key in new.items():
+            if old.get(name) != key:
+                insort(self._sorted[name], key)
+
+    def __setitem__(self, user_id: str, stats: dict):
+        old = self._stats.get(user_id)
+        if old == stats:
+            return
+        self._move(self._keys(user_id, old), self._keys(user_id, stats))
+        self._stats[user_id] = dict(stats)
+
+    def __getitem__(self, user_id: str) -> dict:
+        return dict(self._stats[user_id])
+
+    def __delitem__(self, user_id: str):
+        self._move(self._keys(user_id, self._stats[user_id]), {})
+        del self._stats[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self._stats
+
+    def __iter__(self):
+        return iter(self._stats)
+
+    def __len__(self):
+        return len(self._stats)
+
+    def set_fields(self, user_id: str, **fields):
+        """Changes some of a user's stats, e.g. conversation_length after a new turn."""
+        stats = dict(self._stats[user_id])
+        stats.update(fields)
+        self[user_id] = stats
+
+    def count(self, premium_only: bool = False) -> int:
+        if premium_only:
+            return len(self._sorted[(SORT_FIELDS[0], True)])
+        return len(self._stats)
+
+    def page(self, field: str = "token_usage", offset: int = 0, limit: int = 20, premium_only: bool = False) -> list:
+        """(user_id, stats) for the users ranked offset to offset + limit by field, largest first."""
+        if field not in SORT_FIELDS:
+            raise ValueError(f"Cannot rank users by {field!r} (expected one of {', '.join(SORT_FIELDS)})")
+        keys = self._sorted[(field, premium_only)][offset:offset + limit]
+        return [(user_id, dict(self._stats[user_id])) for _, user_id in keys]
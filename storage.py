@@ -0,0 +1,835 @@
+# storage.py
+import os
+import time
+import pickle
+import sqlite3
+import asyncio
+import argparse
+import threading
+from collections import Counter, OrderedDict, deque
+from collections.abc import MutableMapping
+
+from config import (
+    USER_DATA_BACKEND,
+    USER_DATA_FILE,
+    USER_DATA_DB,
+    USER_DATA_COMPRESSION_LEVEL,
+    USER_DATA_JOURNAL,
+    JOURNAL_FLUSH_INTERVAL,
+    JOURNAL_COMPACT_BYTES,
+    JOURNAL_COMPACT_INTERVAL
+)
+from journal import Journal
+from history import ConversationHistory
+from stats_index import UserStatsIndex
+from memory_index import split_entries, entry_times, updated_times
+from records import new_record, normalize_record, encode_record, decode_record, record_size, format_prefix, get_codec
+from utils import log_info, log_error
+
+
+def memory_entries(core_memories: str) -> int:
+    """Number of entries (non-blank lines) in a core memories text."""
+    return len(split_entries(core_memories))
+
+
+def record_metadata(record: dict) -> dict:
+    """The cheap per-user fields kept in memory for every user, loaded or not."""
+    core_memories = record.get("core_memories", "")
+    return {
+        "token_usage": record.get("token_usage", 0),
+        "premium": record.get("premium", False),
+        "conversation_length": len(record.get("conversation_history", [])),
+        "core_memories_bytes": len(core_memories),
+        "core_memory_entries": memory_entries(core_memories),
+    }
+
+
+def snapshot_record(record: dict) -> dict:
+    """
+    Copies a record deeply enough to encode it in another thread: the record,
+    its history and its lists/dicts are copied, the turn contents inside them
+    are shared (they are never modified in place).
+    """
+    snapshot = dict(record)
+    for key, value in snapshot.items():
+        if isinstance(value, ConversationHistory):
+            snapshot[key] = value.copy()
+        elif isinstance(value, list):
+            snapshot[key] = list(value)
+        elif isinstance(value, dict):
+            snapshot[key] = dict(value)
+    return snapshot
+
+
+class PickleBackend:
+    """
+    The original single-file format. Every save rewrites all users, streamed to
+    a temporary file in a worker thread and renamed into place. Histories are
+    written as plain lists of turn dicts and the journal checkpoint is pickled
+    after the records, so older releases still read the file as the records
+    dict they wrote.
+    """
+
+    name = "pickle"
+    writes_all = True
+    lazy = False  # the whole file is loaded at startup
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _load(self) -> tuple:
+        if not os.path.exists(self.path):
+            return {}, 0
+        with open(self.path, "rb") as f:
+            records = pickle.load(f)
+            try:
+                checkpoint = pickle.load(f)
+            except EOFError:
+                checkpoint = 0
+        return records, checkpoint
+
+    def _write(self, snapshot: dict, checkpoint: int) -> dict:
+        start = time.perf_counter()
+        tmp_path = f"{self.path}.tmp"
+        records = {
+            user_id: {
+                key: list(value) if isinstance(value, ConversationHistory) else value
+                for key, value in record.items()
+            }
+            for user_id, record in snapshot.items()
+        }
+        with open(tmp_path, "wb") as f:
+            pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+            serialized = time.perf_counter()
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp_path, self.path)
+        return {
+            "bytes": size,
+            "serialize_ms": (serialized - start) * 1000,
+            "write_ms": (time.perf_counter() - serialized) * 1000,
+            "sizes": {},
+        }
+
+    async def load(self) -> tuple:
+        """Returns (records, journal checkpoint)."""
+        return await asyncio.to_thread(self._load)
+
+    async def save(self, snapshot: dict, deleted: set, checkpoint: int) -> dict:
+        """Writes snapshot (every user) and returns bytes/serialize_ms/write_ms."""
+        return await asyncio.to_thread(self._write, snapshot, checkpoint)
+
+
+class SqliteBackend:
+    """
+    One row per user in an SQLite database in WAL mode. Saves upsert only the
+    users that changed, in a worker thread. Records are read one user at a
+    time; the user_meta table holds the fields from record_metadata() so all
+    users can be listed without reading their records.
+
+    Records are stored with records.encode_record (schema-versioned, codec
+    user_data_codec). Rows in an older version or codec, including pickled
+    rows from earlier releases, are still read and are rewritten in the
+    current format when the user next changes, or all at once by upgrade().
+    """
+
+    name = "sqlite"
+    writes_all = False
+    lazy = True  # users are read on first access
+
+    def __init__(self, path: str, codec=None):
+        self.path = path
+        self.codec = codec or get_codec()
+        self._conn = None
+        self._lock = threading.Lock()  # one connection, used from worker threads
+        self._reader = None
+        self._read_lock = threading.Lock()  # separate connection for single-user reads
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = self._open()
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "user_id TEXT PRIMARY KEY, record BLOB NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_meta ("
+                "user_id TEXT PRIMARY KEY, token_usage INTEGER NOT NULL, premium INTEGER NOT NULL, "
+                "conversation_length INTEGER NOT NULL, core_memories_bytes INTEGER NOT NULL, "
+                "core_memory_entries INTEGER NOT NULL DEFAULT -1)"
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(user_meta)")}
+            if "core_memory_entries" not in columns:
+                self._conn.execute("ALTER TABLE user_meta ADD COLUMN core_memory_entries INTEGER NOT NULL DEFAULT -1")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def _meta_row(user_id: str, record: dict) -> tuple:
+        meta = record_metadata(record)
+        return (user_id, meta["token_usage"], int(meta["premium"]), meta["conversation_length"],
+                meta["core_memories_bytes"], meta["core_memory_entries"])
+
+    def _load_index(self) -> tuple:
+        with self._lock:
+            conn = self._connect()
+            # Databases from before user_meta (or one of its columns) existed get it filled in once.
+            missing = conn.execute(
+                "SELECT user_id, record FROM users WHERE user_id NOT IN "
+                "(SELECT user_id FROM user_meta WHERE core_memory_entries >= 0)"
+            ).fetchall()
+            if missing:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO user_meta VALUES (?, ?, ?, ?, ?, ?)",
+                        [self._meta_row(user_id, decode_record(blob)) for user_id, blob in missing]
+                    )
+                log_info(f"Indexed metadata for {len(missing)} users.")
+            rows = conn.execute(
+                "SELECT user_id, token_usage, premium, conversation_length, core_memories_bytes, core_memory_entries "
+                "FROM user_meta"
+            ).fetchall()
+            checkpoint = conn.execute("SELECT value FROM meta WHERE key = 'journal_checkpoint'").fetchone()
+        index = {
+            user_id: {
+                "token_usage": token_usage,
+                "premium": bool(premium),
+                "conversation_length": conversation_length,
+                "core_memories_bytes": core_memories_bytes,
+                "core_memory_entries": core_memory_entries,
+            }
+            for user_id, token_usage, premium, conversation_length, core_memories_bytes, core_memory_entries in rows
+        }
+        return index, int(checkpoint[0]) if checkpoint else 0
+
+    def read(self, user_id: str) -> tuple:
+        """Returns (record, records.record_size) for one user, or (None, 0)."""
+        with self._read_lock:
+            if self._reader is None:
+                self._connect()
+                self._reader = self._open()
+            row = self._reader.execute("SELECT record FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None, 0
+        return decode_record(row[0]), record_size(row[0])
+
+    def _write(self, snapshot: dict, deleted: list, checkpoint: int) -> dict:
+        start = time.perf_counter()
+        now = time.time()
+        rows = [
+            (user_id, encode_record(record, self.codec), now)
+            for user_id, record in snapshot.items()
+        ]
+        meta_rows = [self._meta_row(user_id, record) for user_id, record in snapshot.items()]
+        serialized = time.perf_counter()
+        with self._lock:
+            conn = self._connect()
+            with conn:  # one transaction
+                conn.executemany(
+                    "INSERT INTO users (user_id, record, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET record = excluded.record, updated_at = excluded.updated_at",
+                    rows
+                )
+                conn.executemany("INSERT OR REPLACE INTO user_meta VALUES (?, ?, ?, ?, ?, ?)", meta_rows)
+                conn.executemany("DELETE FROM users WHERE user_id = ?", [(u,) for u in deleted])
+                conn.executemany("DELETE FROM user_meta WHERE user_id = ?", [(u,) for u in deleted])
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('journal_checkpoint', ?)", (str(checkpoint),)
+                )
+        return {
+            "bytes": sum(len(row[1]) for row in rows),
+            "serialize_ms": (serialized - start) * 1000,
+            "write_ms": (time.perf_counter() - serialized) * 1000,
+            "sizes": {row[0]: record_size(row[1]) for row in rows},
+        }
+
+    def _count(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def _upgrade(self, batch: int) -> int:
+        prefix = format_prefix(self.codec, USER_DATA_COMPRESSION_LEVEL)
+        with self._lock:
+            conn = self._connect()
+            user_ids = [row[0] for row in conn.execute(
+                "SELECT user_id FROM users WHERE substr(record, 1, ?) != ?", (len(prefix), prefix)
+            )]
+            for i in range(0, len(user_ids), batch):
+                chunk = user_ids[i:i + batch]
+                rows = conn.execute(
+                    f"SELECT user_id, record FROM users WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                with conn:
+                    conn.executemany(
+                        "UPDATE users SET record = ? WHERE user_id = ?",
+                        [(encode_record(decode_record(blob, allow_pickle=True), self.codec), user_id)
+                         for user_id, blob in rows]
+                    )
+        return len(user_ids)
+
+    async def load_index(self) -> tuple:
+        """Returns (user_id -> metadata for every user, journal checkpoint)."""
+        return await asyncio.to_thread(self._load_index)
+
+    async def fetch(self, user_id: str) -> tuple:
+        """read() in a worker thread."""
+        return await asyncio.to_thread(self.read, user_id)
+
+    async def save(self, snapshot: dict, deleted: set, checkpoint: int) -> dict:
+        """Upserts snapshot (the changed users), deletes deleted, and returns bytes/serialize_ms/write_ms."""
+        return await asyncio.to_thread(self._write, snapshot, list(deleted), checkpoint)
+
+    async def count(self) -> int:
+        return await asyncio.to_thread(self._count)
+
+    async def upgrade(self, batch: int = 500) -> int:
+        """
+        Rewrites every row not in the current schema version and codec; returns
+        how many. An explicit admin step, so legacy pickled rows are read even
+        with user_data_read_pickle off.
+        """
+        return await asyncio.to_thread(self._upgrade, batch)
+
+    def close(self):
+        with self._read_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+async def _watch_loop_lag(lags: list, interval: float = 0.005):
+    """Records how late each short sleep wakes up, i.e. how long the event loop was blocked."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+def create_journal() -> Journal:
+    return Journal(USER_DATA_JOURNAL, JOURNAL_FLUSH_INTERVAL)
+
+
+def create_backend(kind: str = USER_DATA_BACKEND):
+    """Returns the storage backend selected by the user_data_backend setting."""
+    if kind == "sqlite":
+        return SqliteBackend(USER_DATA_DB)
+    if kind == "pickle":
+        return PickleBackend(USER_DATA_FILE)
+    raise ValueError(f"Unknown user_data_backend: {kind!r} (expected 'sqlite' or 'pickle')")
+
+
+class UserStore(MutableMapping):
+    """
+    The user table (user_id -> record dict), persisted per user.
+
+    Records are plain dicts. Reading one with store[user_id] (or .get) does not
+    mark it changed; a record counts as changed once it is assigned, deleted or
+    updated through one of the methods below (or after mark_dirty() for other
+    in-place edits), and save() then writes only those users.
+
+    Changes to conversation_history and core_memories should go through the
+    mutation methods (append_turn, set_history, ...), which also record them in
+    the journal. Every save stores the journal sequence number it covers, so
+    after a crash load() replays only the newer journal entries.
+
+    With a lazy backend (SQLite) only the metadata of each user is loaded at
+    startup; a record is read the first time it is accessed, and once the
+    loaded records exceed memory_budget bytes (serialized size) the least
+    recently used saved ones are dropped again. A read from the backend blocks
+    the event loop, so handlers await prefetch(user_id) before touching a user
+    and scans use records(), which reads in a worker thread. metadata() and
+    metadata_items() answer admin queries without loading records.
+
+    The metadata lives in a UserStatsIndex, which top_users() pages through
+    sorted by tokens, history length or memory size. The mutation methods
+    keep a user's entry current as they go, so queries never re-read records;
+    mark_dirty() recomputes the entry of a record changed in place.
+    """
+
+    def __init__(self, backend, journal: Journal = None, memory_budget: int = 0):
+        self.backend = backend
+        self.journal = journal
+        self.memory_budget = memory_budget  # bytes, 0 for no limit
+        self._records = OrderedDict()  # loaded records, least recently used first
+        self._index = UserStatsIndex()  # user_id -> metadata for every user
+        self._sizes = {}  # user_id -> serialized size of loaded records
+        self._dirty = set()
+        self._deleted = set()
+        self._compacted_at = time.monotonic()
+        self.last_save = None  # stats of the most recent save, see save()
+        self.saves = 0
+        self.loads = 0
+        self.evictions = 0
+        self._save_lock = asyncio.Lock()  # saves finish in order, so an older snapshot never lands last
+
+    def _record(self, user_id):
+        """The loaded record for user_id, reading it from the backend if needed; None if unknown."""
+        record = self._records.get(user_id)
+        if record is not None:
+            self._records.move_to_end(user_id)
+            return record
+        if not self.backend.lazy or user_id not in self._index:
+            return None
+        record, size = self.backend.read(user_id)
+        if record is not None:
+            self._add_loaded(user_id, record, size)
+        return record
+
+    def _add_loaded(self, user_id, record, size: int):
+        self._records[user_id] = normalize_record(record)
+        self._sizes[user_id] = size
+        self.loads += 1
+        self._evict()
+
+    def _evict(self):
+        """Drops least recently used records that are saved until the budget is met."""
+        if not self.backend.lazy or self.memory_budget <= 0:
+            return
+        resident = sum(self._sizes.values())
+        for user_id in list(self._records)[:-1]:  # never the one just used
+            if resident <= self.memory_budget:
+                break
+            if user_id in self._dirty:
+                continue
+            self._records.pop(user_id)
+            resident -= self._sizes.pop(user_id, 0)
+            self.evictions += 1
+
+    def __getitem__(self, user_id):
+        record = self._record(user_id)
+        if record is None:
+            raise KeyError(user_id)
+        return record
+
+    def __setitem__(self, user_id, record):
+        self._records[user_id] = normalize_record(record)
+        self._records.move_to_end(user_id)
+        self._sizes.setdefault(user_id, 0)
+        self._index[user_id] = record_metadata(record)
+        self._dirty.add(user_id)
+        self._deleted.discard(user_id)
+
+    def __delitem__(self, user_id):
+        if user_id not in self._index:
+            raise KeyError(user_id)
+        del self._index[user_id]
+        self._records.pop(user_id, None)
+        self._sizes.pop(user_id, None)
+        self._dirty.discard(user_id)
+        self._deleted.add(user_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._index
+
+    def __iter__(self):
+        return iter(list(self._index))
+
+    def __len__(self):
+        return len(self._index)
+
+    def items(self):
+        """
+        (user_id, record) for every user; records not loaded are read but not
+        kept. Reads block, so this is for offline tools; the bot uses records().
+        """
+        for user_id in list(self._index):
+            record = self._records.get(user_id)
+            if record is None:
+                record, _ = self.backend.read(user_id)
+            if record is not None:
+                yield user_id, record
+
+    def values(self):
+        for _, record in self.items():
+            yield record
+
+    async def records(self):
+        """Like items(), as an async iterator that reads unloaded records in a worker thread."""
+        for user_id in list(self._index):
+            record = self._records.get(user_id)
+            if record is None and self.backend.lazy:
+                record, _ = await self.backend.fetch(user_id)
+            if record is not None:
+                yield user_id, record
+
+    def metadata(self, user_id: str) -> dict:
+        """record_metadata() for one user without loading the record, or None if unknown."""
+        if user_id not in self._index:
+            return None
+        return self._index[user_id]
+
+    def metadata_items(self):
+        """(user_id, metadata) for every user, without loading records."""
+        for user_id in list(self._index):
+            yield user_id, self._index[user_id]
+
+    def top_users(self, field: str = "token_usage", offset: int = 0, limit: int = 20, premium_only: bool = False) -> list:
+        """
+        (user_id, metadata) for one page of users ranked by field (token_usage,
+        conversation_length or core_memories_bytes), largest first.
+        """
+        return self._index.page(field, offset, limit, premium_only)
+
+    def count_users(self, premium_only: bool = False) -> int:
+        return self._index.count(premium_only)
+
+    async def prefetch(self, user_id: str):
+        """Reads a user's record in a worker thread so the next access doesn't block the loop."""
+        if not self.backend.lazy or user_id in self._records or user_id not in self._index:
+            return
+        record, size = await self.backend.fetch(user_id)
+        if record is not None and user_id not in self._records and user_id in self._index:
+            self._add_loaded(user_id, record, size)
+
+    def mark_dirty(self, user_id: str):
+        """Marks a loaded record changed after an in-place edit, so the next save writes it."""
+        record = self._records.get(user_id)
+        if record is not None:
+            self._dirty.add(user_id)
+            self._index[user_id] = record_metadata(record)
+
+    def is_loaded(self, user_id: str) -> bool:
+        """Whether store[user_id] can be read without going to the backend."""
+        return user_id in self._records or (not self.backend.lazy and user_id in self._index)
+
+    def add_token_usage(self, user_id: str, tokens: int):
+        record = self._record(user_id)
+        if record is None:
+            return
+        record["token_usage"] = record.get("token_usage", 0) + tokens
+        self._index.set_fields(user_id, token_usage=record["token_usage"])
+        self._dirty.add(user_id)
+
+    def set_premium(self, user_id: str, premium: bool):
+        record = self._record(user_id)
+        if record is None:
+            raise KeyError(user_id)
+        record["premium"] = premium
+        self._index.set_fields(user_id, premium=premium)
+        self._dirty.add(user_id)
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self._dirty) + len(self._deleted)
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    # Journaled mutations
+
+    def _apply(self, entry: dict):
+        """Applies one mutation; used both live and when replaying the journal."""
+        user_id, op = entry["user"], entry["op"]
+        record = self._record(user_id)
+        if record is None:
+            record = self._records[user_id] = new_record()
+            self._sizes[user_id] = 0
+            self._index[user_id] = record_metadata(record)
+            self._deleted.discard(user_id)
+        if op == "append":
+            record["conversation_history"].append(entry["turn"])
+        elif op == "truncate":
+            del record["conversation_history"][entry["length"]:]
+        elif op == "set_history":
+            record["conversation_history"] = ConversationHistory(entry["history"])
+        elif op in ("set_core", "append_core"):
+            old = record.get("core_memories", "")
+            core_memories = entry["text"] if op == "set_core" else old + entry["text"]
+            record["core_memory_times"] = updated_times(old, entry_times(record), core_memories, entry.get("at", 0.0))
+            record["core_memories"] = core_memories
+        else:
+            raise ValueError(f"Unknown journal operation: {op}")
+        if op in ("set_core", "append_core"):
+            self._index.set_fields(user_id, core_memories_bytes=len(core_memories),
+                                   core_memory_entries=memory_entries(core_memories))
+        else:
+            self._index.set_fields(user_id, conversation_length=len(record["conversation_history"]))
+        self._dirty.add(user_id)
+
+    def _mutate(self, user_id: str, op: str, **fields):
+        entry = {"user": user_id, "op": op, **fields}
+        self._apply(entry)
+        if self.journal is not None:
+            self.journal.append(entry)
+
+    def append_turn(self, user_id: str, turn: dict):
+        """Appends a {"role", "content"} turn to the user's conversation history."""
+        self._mutate(user_id, "append", turn=turn)
+
+    def truncate_history(self, user_id: str, length: int):
+        """Drops every turn from index length on."""
+        self._mutate(user_id, "truncate", length=length)
+
+    def set_history(self, user_id: str, history: list):
+        """Replaces the whole conversation history (summarize, forget, reset)."""
+        self._mutate(user_id, "set_history", history=list(history))
+
+    def set_core_memories(self, user_id: str, text: str):
+        self._mutate(user_id, "set_core", text=text, at=time.time())
+
+    def append_core_memories(self, user_id: str, text: str):
+        """Appends text to the user's core memories (remember, summarize); new entries are timestamped now."""
+        self._mutate(user_id, "append_core", text=text, at=time.time())
+
+    # Persistence
+
+    async def load(self):
+        """
+        Loads the user index (or, for the pickle backend, every record) and
+        replays journal entries newer than the last save. On first use of the
+        SQLite backend, an existing pickle file (user_data_file) is imported once.
+        """
+        if self.backend.lazy:
+            index, checkpoint = await self.backend.load_index()
+            self._index = UserStatsIndex(index)
+            self._records = OrderedDict()
+        else:
+            records, checkpoint = await self.backend.load()
+            self._records = OrderedDict((user_id, normalize_record(record)) for user_id, record in records.items())
+            self._index = UserStatsIndex({user_id: record_metadata(record) for user_id, record in self._records.items()})
+        self._sizes = dict.fromkeys(self._records, 0)
+        self._dirty.clear()
+        self._deleted.clear()
+        if self.journal is not None:
+            entries = await asyncio.to_thread(self.journal.read, checkpoint)
+            for entry in entries:
+                self._apply(entry)
+            if entries:
+                log_info(f"Replayed {len(entries)} journal entries after checkpoint {checkpoint}.")
+                await self.compact()
+        if not self._index and self.backend.name != "pickle" and os.path.exists(USER_DATA_FILE):
+            await self.import_pickle(USER_DATA_FILE)
+
+    async def import_pickle(self, path: str) -> int:
+        """
+        Copies every user from a legacy pickle file into this store and saves
+        them. The file is always unpickled, whatever user_data_read_pickle says.
+        """
+        records, _ = await PickleBackend(path).load()
+        for user_id, record in records.items():
+            self[user_id] = record
+        await self.save()
+        log_info(f"Imported {len(records)} users from {path} into the {self.backend.name} store.")
+        return len(records)
+
+    async def save(self) -> int:
+        """
+        Writes the users changed since the last save. Returns how many were written.
+
+        Only a snapshot copy is taken on the event loop; pickling and writing
+        happen in a worker thread. The stats are kept in last_save and logged.
+        """
+        async with self._save_lock:
+            return await self._save()
+
+    async def _save(self) -> int:
+        if not self._dirty and not self._deleted:
+            return 0
+        dirty, deleted = self._dirty, self._deleted
+        self._dirty, self._deleted = set(), set()
+        # Every journaled change so far is in a dirty record, so this save covers
+        # the journal up to the current sequence number.
+        checkpoint = self.journal.seq if self.journal is not None else 0
+        start = time.perf_counter()
+        users = self._records if self.backend.writes_all else dirty
+        snapshot = {user_id: snapshot_record(self._records[user_id]) for user_id in users if user_id in self._records}
+        snapshot_ms = (time.perf_counter() - start) * 1000
+
+        lags = []
+        watcher = asyncio.create_task(_watch_loop_lag(lags))
+        try:
+            stats = await self.backend.save(snapshot, deleted, checkpoint)
+        except Exception:
+            # Keep them dirty so the next save retries
+            self._dirty |= dirty
+            self._deleted |= deleted - self._index.keys()
+            raise
+        finally:
+            watcher.cancel()
+
+        for user_id, size in stats.pop("sizes").items():
+            if user_id in self._records:
+                self._sizes[user_id] = size
+        self._evict()
+
+        self.saves += 1
+        self.last_save = {
+            "users": len(snapshot) + len(deleted),
+            "snapshot_ms": snapshot_ms,
+            "max_loop_lag_ms": max(lags, default=0.0) * 1000,
+            "total_ms": (time.perf_counter() - start) * 1000,
+            **stats,
+        }
+        log_info(
+            f"Saved {self.last_save['users']} users ({stats['bytes'] / 1024:.0f} KiB) in "
+            f"{self.last_save['total_ms']:.0f}ms: snapshot {snapshot_ms:.1f}ms on the event loop, "
+            f"serialize {stats['serialize_ms']:.0f}ms and write {stats['write_ms']:.0f}ms in a worker thread, "
+            f"max loop lag {self.last_save['max_loop_lag_ms']:.1f}ms"
+        )
+        return len(dirty) + len(deleted)
+
+    async def compact(self):
+        """Folds the journal into a snapshot: rotate it, save, then drop the rotated part."""
+        self._compacted_at = time.monotonic()
+        if self.journal is None:
+            await self.save()
+            return
+        await self.journal.rotate()
+        await self.save()
+        self.journal.discard_rotated()
+
+    async def maybe_compact(self):
+        """Compacts once the journal exceeds journal_compact_bytes or journal_compact_interval."""
+        if self.journal is None:
+            await self.save()
+            return
+        age = time.monotonic() - self._compacted_at
+        if self.journal.size() >= JOURNAL_COMPACT_BYTES or age >= JOURNAL_COMPACT_INTERVAL:
+            await self.compact()
+
+    async def close(self):
+        """Final compaction on shutdown."""
+        await self.compact()
+        if self.journal is not None:
+            await self.journal.close()
+
+    def summary(self) -> str:
+        """One-line summary for the admin status command."""
+        text = f"{self.backend.name}, {len(self._index)} users, {self.dirty_count} unsaved"
+        if self.backend.lazy:
+            budget = f" of {self.memory_budget / 2**20:.0f}" if self.memory_budget else ""
+            text += (
+                f", {len(self._records)} loaded ({self.resident_bytes / 2**20:.1f}{budget} MiB, "
+                f"{self.loads} loads, {self.evictions} evictions)"
+            )
+        if self.journal is not None:
+            text += f", journal {self.journal.size() / 1024:.0f} KiB (seq {self.journal.seq})"
+        if self.last_save is not None:
+            text += (
+                f", last save {self.last_save['users']} users/{self.last_save['bytes'] / 1024:.0f} KiB "
+                f"in {self.last_save['total_ms']:.0f}ms (loop stall {self.last_save['snapshot_ms']:.1f}ms "
+                f"+ lag {self.last_save['max_loop_lag_ms']:.1f}ms)"
+            )
+        return text
+
+
+class SaveCoordinator:
+    """
+    Single entry point for saving user data.
+
+    Call sites signal with request() instead of saving directly. The first
+    request opens a window of `window` seconds; everything requested until it
+    closes, or while a save is running, is folded into the next save, so at
+    most one save is in flight. flush() saves pending requests immediately.
+    """
+
+    def __init__(self, save, window: float):
+        self.save = save  # async callable doing the actual save
+        self.window = window
+        self._task = None
+        self._pending_since = None  # monotonic time of the oldest unsaved request
+        self._flush_requested = asyncio.Event()
+        self.requests = 0
+        self.saves = 0  # successful saves
+        self.failures = 0
+        self.reasons = Counter()
+        self.lags = deque(maxlen=200)  # seconds from oldest request to save done
+
+    def request(self, reason: str = "change"):
+        """Asks for a save soon; never blocks."""
+        self.requests += 1
+        self.reasons[reason] += 1
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while self._pending_since is not None:
+            if not self._flush_requested.is_set():
+                try:
+                    await asyncio.wait_for(self._flush_requested.wait(), timeout=self.window)
+                except asyncio.TimeoutError:
+                    pass
+            since, self._pending_since = self._pending_since, None
+            try:
+                await self.save()
+            except Exception as e:
+                self.failures += 1
+                log_error(f"Coordinated user data save failed: {e}")
+                continue
+            self.saves += 1
+            self.lags.append(time.monotonic() - since)
+
+    async def flush(self):
+        """Runs any pending save now and waits for it (used on shutdown)."""
+        self._flush_requested.set()
+        try:
+            if self._task is not None:
+                await self._task
+        finally:
+            self._flush_requested.clear()
+
+    @property
+    def pending(self) -> bool:
+        return self._pending_since is not None
+
+    def metrics(self) -> dict:
+        lags = sorted(self.lags)
+        return {
+            "requests": self.requests,
+            "saves": self.saves,
+            "failures": self.failures,
+            "pending": self.pending,
+            "reasons": dict(self.reasons),
+            "lag_p50": lags[len(lags) // 2] if lags else 0.0,
+            "lag_max": lags[-1] if lags else 0.0,
+        }
+
+    def summary(self) -> str:
+        """One-line summary for the admin status command."""
+        m = self.metrics()
+        reasons = ", ".join(f"{name} {count}" for name, count in self.reasons.most_common())
+        failed = f"{m['failures']} failed, " if m["failures"] else ""
+        return (
+            f"{m['requests']} requests in {m['saves']} saves ({reasons or 'none'}), {failed}"
+            f"lag p50 {m['lag_p50']:.1f}s / max {m['lag_max']:.1f}s{', pending' if m['pending'] else ''}"
+        )
+
+
+async def _import_main(args):
+    store = UserStore(SqliteBackend(args.db))
+    if args.upgrade:
+        upgraded = await store.backend.upgrade()
+        log_info(f"Rewrote {upgraded} users in {args.db} in the current record format.")
+        store.backend.close()
+        return
+    if await store.backend.count() and not args.force:
+        log_error(f"{args.db} already contains users; use --force to import anyway.")
+        return
+    await store.import_pickle(args.pickle)
+    store.backend.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a user_info.pickle file into the SQLite user store.")
+    parser.add_argument("pickle", nargs="?", default=USER_DATA_FILE, help="Pickle file to import")
+    parser.add_argument("--db", default=USER_DATA_DB, help="SQLite database to import into")
+    parser.add_argument("--force", action="store_true", help="Import even if the database already has users")
+    parser.add_argument("--upgrade", action="store_true",
+                        help="Instead of importing, rewrite rows in an older record format or codec")
+    asyncio.run(_import_main(parser.parse_args()))
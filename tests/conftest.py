@@ -0,0 +1,8 @@
+# tests/conftest.py
+import os
+import sys
+
+# The modules live at the repository root, next to config.env.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
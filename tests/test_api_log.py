@@ -0,0 +1,56 @@
+# tests/test_api_log.py
+import os
+import asyncio
+
+from api_log import ApiLogWriter
+
+
+def writer(path: str, **kwargs) -> ApiLogWriter:
+    settings = dict(queue_size=100, batch_size=10, flush_interval=0.01, max_bytes=0,
+                    rotate_interval=0, compress=False, backup_count=0)
+    settings.update(kwargs)
+    return ApiLogWriter(str(path), **settings)
+
+
+def test_records_are_written_as_json_lines(tmp_path):
+    async def run():
+        log = writer(tmp_path / "api.log")
+        for i in range(25):
+            log.submit({"i": i})
+        await log.close()
+        return log
+
+    log = asyncio.run(run())
+    assert log.written == 25
+    assert len((tmp_path / "api.log").read_text().splitlines()) == 25
+
+
+def test_full_queue_drops_records(tmp_path):
+    async def run():
+        log = writer(tmp_path / "api.log", queue_size=2)
+        results = [log.submit({"i": i}) for i in range(5)]
+        await log.close()
+        return log, results
+
+    log, results = asyncio.run(run())
+    assert results.count(False) == log.dropped == 3
+    assert "3 dropped" in log.summary()
+
+
+def test_rotation_prunes_only_its_own_backups(tmp_path):
+    path = tmp_path / "api.log"
+    for name in ("api.log.bak", "api.log.old.gz", "api.log.20200101-000000-000", "api.log.20200101-000000-001.gz"):
+        (tmp_path / name).write_text("x")
+
+    async def run():
+        log = writer(path, max_bytes=1, compress=True, backup_count=1)
+        for i in range(3):
+            log.submit({"i": i})
+            await asyncio.sleep(0.05)
+        await log.close()
+
+    asyncio.run(run())
+    names = sorted(os.listdir(tmp_path))
+    assert "api.log.bak" in names and "api.log.old.gz" in names
+    backups = [n for n in names if n.startswith("api.log.2")]
+    assert len(backups) == 1 and backups[0].endswith(".gz") and not backups[0].startswith("api.log.2020")
@@ -0,0 +1,51 @@
+# tests/test_decision_cache.py
+import asyncio
+import time
+
+from decision_cache import DecisionCache
+
+
+def test_keys_ignore_case_and_whitespace():
+    assert DecisionCache.make_key("vote", "Hello  World", 1) == DecisionCache.make_key("vote", " hello world ", "1")
+    assert DecisionCache.make_key("vote", "a") != DecisionCache.make_key("entities", "a")
+
+
+def test_entries_expire():
+    cache = DecisionCache(ttl=60, max_entries=10, max_bytes=10**6)
+    cache.put("vote:a", ["yes"])
+    cache.put("vote:b", ["no"], expires_at=time.time() - 1)
+    assert cache.get("vote:a") == ["yes"]
+    assert cache.get("vote:b") is None
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["by_kind"]["vote"] == {"hits": 1, "misses": 1}
+
+
+def test_least_recently_used_are_evicted():
+    cache = DecisionCache(ttl=60, max_entries=2, max_bytes=10**6)
+    cache.put("vote:a", 1)
+    cache.put("vote:b", 2)
+    cache.get("vote:a")
+    cache.put("vote:c", 3)
+    assert cache.get("vote:b") is None
+    assert cache.get("vote:a") == 1
+
+
+def test_byte_budget():
+    cache = DecisionCache(ttl=60, max_entries=100, max_bytes=500)
+    for i in range(10):
+        cache.put(f"vote:{i}", "x" * 50)
+    assert cache.stats()["bytes"] <= 500
+    assert cache.get("vote:9") is not None
+
+
+def test_persistence_keeps_unexpired_entries(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = DecisionCache(ttl=60, max_entries=10, max_bytes=10**6, path=path)
+    cache.put("vote:a", ["yes", "no"])
+    cache.put("vote:b", ["no"], expires_at=time.time() + 0.01)
+    asyncio.run(cache.save())
+    time.sleep(0.02)
+    loaded = DecisionCache(ttl=60, max_entries=10, max_bytes=10**6, path=path)
+    asyncio.run(loaded.load())
+    assert loaded.get("vote:a") == ["yes", "no"]
+    assert loaded.get("vote:b") is None
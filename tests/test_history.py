@@ -0,0 +1,66 @@
+# tests/test_history.py
+import pickle
+
+from history import ConversationHistory
+from token_utils import content_units
+
+
+def turns(count: int, size: int = 10) -> list:
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} " + "word " * size}
+            for i in range(count)]
+
+
+def test_behaves_like_a_list():
+    plain = turns(6)
+    history = ConversationHistory(plain)
+    assert len(history) == 6
+    assert list(history) == plain
+    assert history[-1] == plain[-1]
+    assert history[1:3] == plain[1:3]
+
+    history.append({"role": "user", "content": "new"})
+    del history[0]
+    history[0] = {"role": "assistant", "content": "changed"}
+    history.insert(1, {"role": "user", "content": "inserted"})
+    expected = plain[1:] + [{"role": "user", "content": "new"}]
+    expected[0] = {"role": "assistant", "content": "changed"}
+    expected.insert(1, {"role": "user", "content": "inserted"})
+    assert list(history) == expected
+
+
+def test_units_track_every_change():
+    history = ConversationHistory(turns(5))
+    history.append({"role": "user", "content": "one more turn"})
+    del history[1:3]
+    history[0] = {"role": "assistant", "content": "replaced"}
+    assert history.units() == sum(content_units(t["content"]) for t in history)
+
+
+def test_old_turns_are_compressed_transparently():
+    plain = turns(10, size=200)
+    history = ConversationHistory(plain, compress_after=2, compress_min_bytes=64)
+    assert any(type(c) is not str for c in history._contents)
+    assert list(history) == plain
+
+
+def test_columns_round_trip():
+    history = ConversationHistory(turns(4) + [{"role": "narrator", "content": "aside"}])
+    history.units()
+    copy = ConversationHistory.from_columns(*history.columns())
+    assert list(copy) == list(history)
+    assert copy.units() == history.units()
+
+
+def test_copy_is_independent():
+    history = ConversationHistory(turns(3))
+    copy = history.copy()
+    copy.append({"role": "user", "content": "only in the copy"})
+    assert len(history) == 3
+    assert len(copy) == 4
+
+
+def test_pickle_round_trip():
+    history = ConversationHistory(turns(30, size=100), compress_after=5, compress_min_bytes=64)
+    restored = pickle.loads(pickle.dumps(history))
+    assert list(restored) == list(history)
+    assert restored.units() == history.units()
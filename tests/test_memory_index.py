@@ -0,0 +1,42 @@
+# tests/test_memory_index.py
+from memory_index import CoreMemoryIndex, split_entries, entry_times, updated_times
+
+ENTRIES = [
+    "- likes green tea in the morning",
+    "- has a cat called Miso",
+    "- works as a nurse on night shifts",
+    "- is learning Japanese",
+    "- the cat Miso is afraid of the vacuum cleaner",
+]
+
+
+def test_split_entries_skips_blank_lines():
+    assert split_entries("\n- a\n\n  - b  \n") == ["- a", "- b"]
+
+
+def test_search_ranks_matching_entries():
+    index = CoreMemoryIndex(ENTRIES)
+    results = index.search("my cat called", 3)
+    assert set(results) == {1, 4}
+    assert results[0] == 1  # the shorter entry scores higher for the same term
+    assert index.search("nothing relevant here xyz", 3) == []
+    assert len(index.search("the cat Miso", 1)) == 1
+
+
+def test_pinned_are_the_newest_entries():
+    times = [5.0, 1.0, 3.0, 0.0, 4.0]
+    assert sorted(CoreMemoryIndex(ENTRIES, times, pinned=2).pinned) == [0, 4]
+    # Without times, later entries count as newer.
+    assert sorted(CoreMemoryIndex(ENTRIES, pinned=2).pinned) == [3, 4]
+
+
+def test_entry_times_pad_and_trim():
+    record = {"core_memories": "- a\n- b\n- c", "core_memory_times": [1.0]}
+    assert entry_times(record) == [1.0, 0.0, 0.0]
+    record["core_memory_times"] = [1.0, 2.0, 3.0, 4.0]
+    assert entry_times(record) == [1.0, 2.0, 3.0]
+
+
+def test_updated_times_keep_existing_entries():
+    old = "- a\n- b"
+    assert updated_times(old, [1.0, 2.0], "- b\n- c\n- a", now=9.0) == [2.0, 9.0, 1.0]
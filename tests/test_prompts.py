@@ -0,0 +1,67 @@
+# tests/test_prompts.py
+from history import ConversationHistory
+from prompts import SUMMARY_PREFIX, context_window, build_messages, add_live_context
+from token_utils import content_units, units_to_tokens
+
+
+def conversation(count: int, summary: bool = False) -> list:
+    turns = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} " + "word " * 40}
+             for i in range(count)]
+    if summary:
+        turns[0] = {"role": "assistant", "content": SUMMARY_PREFIX + "earlier talk"}
+    return turns
+
+
+def tokens(turns: list) -> int:
+    return units_to_tokens(sum(content_units(t["content"]) for t in turns))
+
+
+def test_everything_fits():
+    turns = conversation(6)
+    assert context_window(turns, budget=10**6) == turns
+    assert context_window(turns, budget=0) == turns
+
+
+def test_window_starts_on_a_user_turn():
+    turns = conversation(60)
+    for budget in (50, 300, 1000, 2500):
+        window = context_window(turns, budget=budget)
+        assert window[-1] == turns[-1]
+        assert window[0]["role"] == "user" or len(window) == 1
+        assert window == turns[len(turns) - len(window):]
+
+
+def test_window_stays_within_budget():
+    turns = conversation(60)
+    window = context_window(turns, budget=1000)
+    assert len(window) < len(turns)
+    assert tokens(window) <= 1000
+
+
+def test_summary_is_kept_and_roles_alternate():
+    turns = conversation(61, summary=True)
+    window = context_window(turns, budget=800)
+    assert window[0] == turns[0]
+    assert window[1]["role"] == "user"
+    roles = [t["role"] for t in window]
+    assert all(a != b for a, b in zip(roles, roles[1:]))
+
+
+def test_history_and_list_agree():
+    turns = conversation(40, summary=True)
+    history = ConversationHistory(turns)
+    for budget in (200, 700, 5000):
+        assert context_window(history, budget=budget) == context_window(turns, budget=budget)
+
+
+def test_end_excludes_later_turns():
+    turns = conversation(10)
+    assert context_window(turns, budget=10**6, end=7) == turns[:7]
+
+
+def test_live_context_rides_on_the_last_user_turn():
+    messages = build_messages([{"role": "user", "content": "hi"}], live_context="channel: #general")
+    assert messages[-1]["content"][-1]["text"] == "channel: #general"
+    assert add_live_context("system", [{"role": "user", "content": "hi"}], "ctx") == "system"
+    system = add_live_context("system", [{"role": "assistant", "content": "hi"}], "ctx")
+    assert system[-1]["text"] == "ctx"
@@ -0,0 +1,64 @@
+# tests/test_records.py
+import pickle
+
+import pytest
+
+from history import ConversationHistory
+from records import (
+    SCHEMA_VERSION, new_record, normalize_record, encode_record, decode_record, record_size, get_codec
+)
+
+
+def sample_record() -> dict:
+    record = new_record()
+    record.update(token_usage=1234, premium=True, core_memories="- likes tea\n- has a cat",
+                  core_memory_times=[1.0, 2.0], nickname="Miso")
+    record["conversation_history"].append({"role": "user", "content": "hello"})
+    record["conversation_history"].append({"role": "assistant", "content": "hi there"})
+    return record
+
+
+@pytest.mark.parametrize("level", [0, 1, 6])
+def test_json_round_trip(level):
+    record = sample_record()
+    decoded = decode_record(encode_record(record, get_codec("json"), level))
+    assert isinstance(decoded["conversation_history"], ConversationHistory)
+    assert list(decoded["conversation_history"]) == list(record["conversation_history"])
+    for key in ("token_usage", "premium", "core_memories", "core_memory_times", "nickname"):
+        assert decoded[key] == record[key]
+
+
+def test_record_size_is_the_uncompressed_payload():
+    record = sample_record()
+    plain = encode_record(record, get_codec("json"), 0)
+    compressed = encode_record(record, get_codec("json"), 6)
+    assert record_size(plain) == record_size(compressed) == len(plain) - 9
+
+
+def test_legacy_pickles_need_permission():
+    legacy = pickle.dumps({"token_usage": 5, "conversation_history": [{"role": "user", "content": "hi"}]})
+    with pytest.raises(ValueError):
+        decode_record(legacy, allow_pickle=False)
+    record = decode_record(legacy, allow_pickle=True)
+    assert record["token_usage"] == 5
+    assert record["core_memories"] == ""
+    assert list(record["conversation_history"]) == [{"role": "user", "content": "hi"}]
+
+
+def test_newer_schema_is_rejected():
+    blob = bytearray(encode_record(sample_record(), get_codec("json"), 0))
+    blob[2] = SCHEMA_VERSION + 1
+    with pytest.raises(ValueError):
+        decode_record(bytes(blob))
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        get_codec("yaml")
+
+
+def test_normalize_fills_missing_fields():
+    record = normalize_record({"conversation_history": [{"role": "user", "content": "hi"}]})
+    assert record["token_usage"] == 0
+    assert record["premium"] is False
+    assert isinstance(record["conversation_history"], ConversationHistory)
@@ -0,0 +1,74 @@
+# tests/test_scheduler.py
+import asyncio
+
+import pytest
+
+from scheduler import TokenBucket, RequestScheduler, Priority
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(60)  # one per second
+    assert bucket.wait_time(60) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0, abs=0.05)
+    assert TokenBucket(0).wait_time(10**9) == 0  # unlimited
+
+
+def test_higher_priority_is_admitted_first():
+    async def run():
+        scheduler = RequestScheduler(1, {}, 0, 0)
+        order = []
+
+        async def request(name, priority):
+            async with scheduler.slot("model", priority, 0):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        first = asyncio.create_task(request("first", Priority.SUMMARIZATION))
+        await asyncio.sleep(0)
+        queued = [asyncio.create_task(request(name, priority)) for name, priority in
+                  (("summary", Priority.SUMMARIZATION), ("channel", Priority.CHANNEL_REPLY), ("dm", Priority.DM_REPLY))]
+        await asyncio.gather(first, *queued)
+        return order
+
+    assert asyncio.run(run()) == ["first", "dm", "channel", "summary"]
+
+
+def test_classifier_slots_bypass_busy_replies():
+    async def run():
+        scheduler = RequestScheduler(1, {}, 0, 0, classifier_slots=1)
+        async with scheduler.slot("model", Priority.CHANNEL_REPLY, 0):
+            async with scheduler.slot("model", Priority.CLASSIFIER, 0, max_wait=0.5) as ticket:
+                return ticket.reserved, scheduler.classifiers_reserved
+
+    assert asyncio.run(run()) == (True, 1)
+
+
+def test_max_wait_gives_up_and_frees_the_queue():
+    async def run():
+        scheduler = RequestScheduler(1, {}, 0, 0)
+        async with scheduler.slot("model", Priority.CHANNEL_REPLY, 0):
+            with pytest.raises(asyncio.TimeoutError):
+                async with scheduler.slot("model", Priority.CLASSIFIER, 0, max_wait=0.05):
+                    pass
+        async with scheduler.slot("model", Priority.CLASSIFIER, 0, max_wait=0.05):
+            in_flight = scheduler.in_flight
+        return in_flight, scheduler.in_flight, scheduler.metrics()["classes"]["CLASSIFIER"]["timed_out"]
+
+    assert asyncio.run(run()) == (1, 0, 1)
+
+
+def test_rate_limited_model_does_not_block_others():
+    async def run():
+        scheduler = RequestScheduler(4, {"slow": {"rpm": 1}}, 0, 0)
+        async with scheduler.slot("slow", Priority.CHANNEL_REPLY, 0):
+            pass
+        blocked = asyncio.create_task(scheduler.slot("slow", Priority.DM_REPLY, 0).__aenter__())
+        await asyncio.sleep(0)
+        async with scheduler.slot("fast", Priority.SUMMARIZATION, 0, max_wait=0.1):
+            admitted = True
+        done = blocked.done()
+        blocked.cancel()
+        return admitted, done
+
+    assert asyncio.run(run()) == (True, False)
@@ -0,0 +1,51 @@
+# tests/test_stats_index.py
+import pytest
+
+from stats_index import UserStatsIndex
+
+
+def stats(tokens: int, premium: bool = False, length: int = 0) -> dict:
+    return {"token_usage": tokens, "premium": premium, "conversation_length": length,
+            "core_memories_bytes": 0, "core_memory_entries": 0}
+
+
+def ranked(index: UserStatsIndex, **kwargs) -> list:
+    return [user_id for user_id, _ in index.page(**kwargs)]
+
+
+def test_pages_are_sorted_largest_first():
+    index = UserStatsIndex({"a": stats(10), "b": stats(30), "c": stats(20, premium=True)})
+    assert ranked(index) == ["b", "c", "a"]
+    assert ranked(index, offset=1, limit=1) == ["c"]
+    assert ranked(index, premium_only=True) == ["c"]
+    assert index.count() == 3
+    assert index.count(premium_only=True) == 1
+
+
+def test_updates_move_users():
+    index = UserStatsIndex({"a": stats(10), "b": stats(30)})
+    index.set_fields("a", token_usage=50)
+    assert ranked(index) == ["a", "b"]
+    index.set_fields("b", premium=True)
+    assert ranked(index, premium_only=True) == ["b"]
+    index.set_fields("b", premium=False)
+    assert index.count(premium_only=True) == 0
+    index["c"] = stats(5, length=9)
+    assert ranked(index, field="conversation_length") == ["c", "a", "b"]
+    del index["a"]
+    assert ranked(index) == ["b", "c"]
+
+
+def test_sorted_lists_match_a_full_sort():
+    index = UserStatsIndex()
+    for i in range(50):
+        index[str(i)] = stats((i * 37) % 11, premium=i % 3 == 0)
+    for i in range(0, 50, 4):
+        index.set_fields(str(i), token_usage=i)
+    expected = sorted(index, key=lambda u: (-index[u]["token_usage"], u))
+    assert ranked(index, limit=50) == expected
+
+
+def test_unknown_field():
+    with pytest.raises(ValueError):
+        UserStatsIndex().page(field="premium")
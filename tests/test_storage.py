@@ -0,0 +1,64 @@
+# tests/test_storage.py
+import asyncio
+import pickle
+
+from storage import UserStore, SqliteBackend, PickleBackend
+
+
+def test_reads_do_not_mark_records_changed(tmp_path):
+    async def run():
+        store = UserStore(SqliteBackend(str(tmp_path / "users.db")))
+        await store.load()
+        store.append_turn("1", {"role": "user", "content": "hi"})
+        await store.save()
+        _ = store["1"]
+        _ = store.get("1")
+        clean = store.dirty_count
+        store.add_token_usage("1", 10)
+        return clean, store.dirty_count
+
+    assert asyncio.run(run()) == (0, 1)
+
+
+def test_index_follows_usage_and_premium(tmp_path):
+    async def run():
+        store = UserStore(SqliteBackend(str(tmp_path / "users.db")))
+        await store.load()
+        for user_id in ("a", "b"):
+            store.append_turn(user_id, {"role": "user", "content": "hi"})
+        store.add_token_usage("a", 5)
+        store.add_token_usage("b", 50)
+        store.set_premium("a", True)
+        return [u for u, _ in store.top_users()], store.count_users(premium_only=True)
+
+    assert asyncio.run(run()) == (["b", "a"], 1)
+
+
+def test_evicted_records_are_prefetched(tmp_path):
+    async def run():
+        store = UserStore(SqliteBackend(str(tmp_path / "users.db")), memory_budget=1)
+        await store.load()
+        for user_id in ("a", "b", "c"):
+            store.append_turn(user_id, {"role": "user", "content": "hi " * 100})
+        await store.save()
+        evicted = not store.is_loaded("a")
+        await store.prefetch("a")
+        scanned = [user_id async for user_id, _ in store.records()]
+        return evicted, store.is_loaded("a"), sorted(scanned)
+
+    assert asyncio.run(run()) == (True, True, ["a", "b", "c"])
+
+
+def test_pickle_file_holds_plain_histories(tmp_path):
+    path = str(tmp_path / "user_info.pickle")
+
+    async def run():
+        store = UserStore(PickleBackend(path))
+        await store.load()
+        store.append_turn("1", {"role": "user", "content": "hi"})
+        await store.save()
+
+    asyncio.run(run())
+    with open(path, "rb") as f:
+        records = pickle.load(f)
+    assert records["1"]["conversation_history"] == [{"role": "user", "content": "hi"}]
@@ -1,23 +1,131 @@
 # token_utils.py
-import anthropic
-from config import OAI_TOKEN
+import re
+import hashlib
+from collections import OrderedDict
 from utils import log_error
+from llm_client import count_tokens
+from scheduler import llm_scheduler, Priority
 
-def anthropic_token_count(model: str, system: str, messages: list):
+# Local token estimator.
+# Text is split into word/punctuation units (memoized per content hash) and
+# scaled by a per-model tokens-per-unit ratio that is calibrated against the
+# input_tokens reported in each Messages response.
+_UNIT_PATTERN = re.compile(r"\w+|[^\w\s]")
+_UNIT_CACHE_SIZE = 4096
+_unit_cache = OrderedDict()  # content hash -> unit count, LRU order
+
+_MESSAGE_OVERHEAD_UNITS = 4  # role markers and separators per message
+_DEFAULT_TOKENS_PER_UNIT = 1.3
+_CALIBRATION_WEIGHT = 0.1  # weight of each new observation in the moving average
+_MIN_TOKENS_PER_UNIT = 0.5  # clamp for outliers (e.g. non-text content)
+_MAX_TOKENS_PER_UNIT = 4.0
+_tokens_per_unit = {}  # model -> calibrated ratio
+
+
+def content_text(content) -> str:
+    """Returns the plain text of a message content (string or list of blocks)."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for block in content:
+            if isinstance(block, dict):
+                parts.append(block.get("text", ""))
+            else:
+                parts.append(getattr(block, "text", str(block)))
+        return "\n".join(parts)
+    return str(content or "")
+
+
+def _text_units(text: str) -> int:
+    """Counts estimator units in text, memoized by a hash of the content."""
+    if not text:
+        return 0
+    key = hashlib.blake2b(text.encode("utf-8", "replace"), digest_size=16).digest()
+    units = _unit_cache.get(key)
+    if units is not None:
+        _unit_cache.move_to_end(key)
+        return units
+    # Long words are split into several tokens by the tokenizer.
+    units = sum(1 + len(m) // 8 for m in _UNIT_PATTERN.findall(text))
+    _unit_cache[key] = units
+    if len(_unit_cache) > _UNIT_CACHE_SIZE:
+        _unit_cache.popitem(last=False)
+    return units
+
+
+def _request_units(system, messages: list) -> int:
+    units = _text_units(content_text(system))
+    for msg in messages or []:
+        units += _text_units(content_text(msg.get("content", ""))) + _MESSAGE_OVERHEAD_UNITS
+    return units
+
+
+def _ratio(model: str = None) -> float:
+    return _tokens_per_unit.get(model, _tokens_per_unit.get(None, _DEFAULT_TOKENS_PER_UNIT))
+
+
+def content_units(content) -> int:
+    """
+    Estimator units of one message: its text plus the per-message overhead.
+    Stable across calibration, so callers can cache it per turn.
+    """
+    return _text_units(content_text(content)) + _MESSAGE_OVERHEAD_UNITS
+
+
+def units_to_tokens(units: int, model: str = None) -> int:
+    """Converts estimator units (e.g. summed content_units) to estimated tokens."""
+    return int(units * _ratio(model))
+
+
+def estimate_text_tokens(text: str, model: str = None) -> int:
+    """Estimates the token count of a plain string without any API call."""
+    return int(_text_units(content_text(text)) * _ratio(model))
+
+
+def estimate_message_tokens(model: str, system, messages: list) -> int:
+    """
+    Estimates the input tokens of a Messages request without any API call.
+    Used for pre-flight budgeting; exact numbers come from the response usage.
+    """
+    return int(_request_units(system, messages) * _ratio(model))
+
+
+def calibrate_estimator(model: str, system, messages: list, input_tokens: int):
+    """
+    Updates the tokens-per-unit ratio for a model (and the global fallback)
+    from the input_tokens the API reported for a request.
+    """
+    units = _request_units(system, messages)
+    if not units or not input_tokens:
+        return
+    observed = min(max(input_tokens / units, _MIN_TOKENS_PER_UNIT), _MAX_TOKENS_PER_UNIT)
+    for key in (model, None):
+        current = _tokens_per_unit.get(key)
+        if current is None:
+            _tokens_per_unit[key] = observed
+        else:
+            _tokens_per_unit[key] = current + _CALIBRATION_WEIGHT * (observed - current)
+
+
+async def anthropic_token_count(model: str, system: str, messages: list):
     """
-    Uses client.beta.messages.count_tokens to get the token count.
+    Uses messages.count_tokens on the shared async client to get the token count.
     According to the docs, the returned object has an 'input_tokens' attribute.
     If an error occurs, returns 0.
+    Prefer estimate_message_tokens for budgeting; this costs an API round trip.
+    The call waits in the request scheduler like any other, at classifier
+    priority. It reserves no tokens: counting is not billed as input tokens.
     """
     if not messages:
         messages = []
     try:
-        client = anthropic.Anthropic(api_key=OAI_TOKEN)
-        result = client.beta.messages.count_tokens(
-            model=model,
-            system=system,
-            messages=messages
-        )
+        async with llm_scheduler.slot(model, Priority.CLASSIFIER, 0):
+            result = await count_tokens(
+                model=model,
+                system=system,
+                messages=messages
+            )
         return result.input_tokens
     except Exception as e:
         log_error(f"Error using Anthropic messages.count_tokens: {e}. Falling back to 0.")
@@ -36,6 +36,86 @@ async def send_large_message(channel: discord.TextChannel, message: str, max_len
         for part in parts:
             await channel.send(part)
 
+async def send_streaming_message(channel: discord.TextChannel, deltas, prefix: str = "",
+                                 max_length=2000, edit_interval: float = 1.0, reveal=None) -> str:
+    """
+    Sends a reply while it is still being generated.
+    Posts the first chunk as soon as text arrives, then edits the message with
+    new text at most every edit_interval seconds. When a message fills up it is
+    closed (split at a space, like send_large_message) and the rest continues
+    in a new message.
+    reveal: optional callable(elapsed_seconds) -> max visible characters, or
+    None for no limit. Used to pace the text at a simulated typing speed.
+    Returns the full generated text (without prefix). If generation or sending
+    fails (or is cancelled) partway, the messages posted so far are deleted and
+    the error is re-raised, so the caller's error message replaces them.
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    parts = []
+    generated = 0  # characters received so far
+    current = None  # the open message being edited
+    current_text = ""
+    closed_len = 0  # characters already closed into full messages
+    sent = []  # every message posted, to delete if the reply fails
+
+    async def show(text: str):
+        nonlocal current, current_text
+        if not text.strip() or text == current_text:
+            return
+        if current is None:
+            current = await channel.send(text)
+            sent.append(current)
+        else:
+            await current.edit(content=text)
+        current_text = text
+
+    async def flush(final: bool = False):
+        nonlocal current, current_text, closed_len
+        visible = prefix + "".join(parts)
+        limit = None if final or not reveal else reveal(loop.time() - start)
+        if limit is not None:
+            visible = visible[:len(prefix) + limit] if limit > 0 else ""
+        tail = visible[closed_len:]
+        while len(tail) > max_length:
+            split_index = tail[:max_length].rfind(" ")
+            if split_index <= 0:
+                split_index = max_length
+            await show(tail[:split_index])
+            closed_len += split_index
+            tail = tail[split_index:]
+            current, current_text = None, ""
+        await show(tail)
+
+    last_flush = None
+    try:
+        async for delta in deltas:
+            parts.append(delta)
+            generated += len(delta)
+            now = loop.time()
+            if last_flush is None or now - last_flush >= edit_interval:
+                await flush()
+                last_flush = now
+
+        # Generation finished; with a reveal pace, keep typing out the rest.
+        if reveal:
+            while True:
+                limit = reveal(loop.time() - start)
+                if limit is None or limit >= generated:
+                    break
+                await flush()
+                await asyncio.sleep(edit_interval)
+        await flush(final=True)
+    except (Exception, asyncio.CancelledError):
+        # Don't leave a reply that stops mid-sentence next to the error message.
+        for partial in sent:
+            try:
+                await partial.delete()
+            except discord.HTTPException:
+                pass
+        raise
+    return "".join(parts)
+
 def split_msg(msg: str):
     paragraphs = msg.split("\n")
     total_length = sum(len(p) for p in paragraphs)